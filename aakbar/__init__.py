@@ -15,7 +15,7 @@ from __future__ import print_function
 import warnings
 import functools
 import datetime
-from pkg_resources import iter_entry_points
+import importlib
 import locale
 
 
@@ -24,6 +24,8 @@ from click_plugins import with_plugins
 
 # Global defs
 from .common import *
+from .metrics import start_metrics, metrics_path, MEMORY_SIZE
+from .profiling import PROFILE_MODES, start_profiler
 
 # set locale so grouping works
 for localename in ['en_US', 'en_US.utf8', 'English_United_States']:
@@ -36,6 +38,159 @@ for localename in ['en_US', 'en_US.utf8', 'English_United_States']:
 # private context function
 _ctx = click.get_current_context
 
+# Commands and the modules that define them.  Modules are imported only
+# when one of their commands is invoked, so that small commands do not
+# pay for importing pandas, matplotlib, pyfaidx, or Biopython.
+LAZY_COMMAND_MODULES = {
+    'config': ['define_set',
+               'define_summary',
+               'init_config_file',
+               'label_set',
+               'set_plot_type',
+               'set_simplicity_object',
+               'show_config'],
+    'core': ['build_signatures',
+             'calculate_peptide_terms',
+             'filter_peptide_terms',
+             'gather_peptide_terms',
+             'install_demo_scripts',
+             'intersect_peptide_terms',
+             'peptide_simplicity_mask'],
+    'simplicity': ['demo_simplicity',
+                   'set_letterfreq_window'],
+    'search': ['search_peptide_occurrances'],
+    'plot': ['conserved_signature_stats'],
+    'plotting': ['render_plots'],
+    'hits': ['convert_hit_table'],
+    'sigindex': ['compile_signatures'],
+    'server': ['serve'],
+    'suffixindex': ['index_peptide_terms',
+                    'index_proteome',
+                    'query_peptides'],
+    'tasks': ['plan_signatures',
+              'run_task',
+              'show_tasks']
+}
+
+# Modules whose public names were imported into the package, in the
+# order they were imported, so that later ones take precedence.
+EXPORTED_MODULES = ['config', 'core', 'simplicity', 'search', 'plot']
+
+
+def iter_entry_points(group):
+    '''Iterate over installed entry points in a group.
+
+    Uses importlib.metadata where available, since importing
+    pkg_resources scans every installed distribution.
+
+    :param group: Entry point group name.
+    :return: Iterable of entry points.
+    '''
+    try:
+        from importlib.metadata import entry_points
+    except ImportError: # python < 3.8
+        from pkg_resources import iter_entry_points as pkg_iter_entry_points
+        return pkg_iter_entry_points(group)
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        return all_entry_points.select(group=group)
+    return all_entry_points.get(group, [])
+
+
+def __getattr__(name):
+    '''Find names of the package in the modules that define them.
+
+    Modules are no longer imported with the package, but their commands
+    and public names, such as SimplicityObject for plugins, are still
+    found as attributes of the package, importing the module on first
+    use.
+
+    :param name: Attribute name.
+    :return: Attribute.
+    '''
+    if name.startswith('_'):
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    if name in LAZY_COMMAND_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    for module_name, command_names in LAZY_COMMAND_MODULES.items():
+        if name in command_names:
+            return getattr(importlib.import_module('.' + module_name, __name__), name)
+    for module_name in reversed(EXPORTED_MODULES):
+        module = importlib.import_module('.' + module_name, __name__)
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+class LazyCommandGroup(click.Group):
+    '''Command group that imports the module defining a command on first use.
+    '''
+    def __init__(self, *args, lazy_command_modules=None, **kwargs):
+        click.Group.__init__(self, *args, **kwargs)
+        self.lazy_commands = {}
+        if lazy_command_modules is not None:
+            for module_name, command_names in lazy_command_modules.items():
+                for command_name in command_names:
+                    self.lazy_commands[command_name] = module_name
+
+    def list_commands(self, ctx):
+        # click 7 and later register commands with dashes for underscores
+        registered = click.Group.list_commands(self, ctx)
+        normalized = set([name.replace('-', '_') for name in registered])
+        return sorted(set(registered) |
+                      set([name for name in self.lazy_commands.keys()
+                           if name not in normalized]))
+
+    def get_command(self, ctx, cmd_name):
+        command = click.Group.get_command(self, ctx, cmd_name)
+        module_name = self.lazy_commands.get(cmd_name.replace('-', '_'))
+        if command is None and module_name is not None:
+            # importing the module registers its commands with this group
+            importlib.import_module('.' + module_name, __name__)
+            for name in [cmd_name, cmd_name.replace('_', '-')]:
+                command = click.Group.get_command(self, ctx, name)
+                if command is not None:
+                    break
+        return command
+
+
+class UserContextObject(dict):
+    '''User context dictionary that finds simplicity objects on first use.
+
+    Finding them imports numpy and pandas, which most commands don't need.
+    '''
+    def __missing__(self, key):
+        if key not in ['simplicity_objects', 'simplicity_object']:
+            raise KeyError(key)
+        self._find_simplicity_objects()
+        return self[key]
+
+    def _find_simplicity_objects(self):
+        global config_obj
+        from . import simplicity
+        self['simplicity_objects'] = [obj for key, obj in vars(simplicity).items()
+                                      if key.endswith('SIMPLICITY')
+                                      if isinstance(obj, simplicity.SimplicityObject)]
+        #
+        # simplicity objects in plugins
+        #
+        for entry_point in iter_entry_points('aakbar.simplicity_plugins'):
+            self['simplicity_objects'].append(entry_point.load())
+        # selected simplicity object
+        try:
+            simplicity_object_label = config_obj.config_dict['simplicity_object_label']
+        except KeyError:
+            simplicity_object_label = None
+        if simplicity_object_label != None:
+            for obj in self['simplicity_objects']:
+                if obj.label == simplicity_object_label:
+                    self['simplicity_object'] = obj
+        else:
+            try:
+                self['simplicity_object'] = self['simplicity_objects'][0]
+            except IndexError:
+                self['simplicity_object'] = None
+
 
 class CleanInfoFormatter(logging.Formatter):
     def __init__(self, fmt = '%(levelname)s: %(message)s'):
@@ -67,6 +222,10 @@ def init_dual_logger(file_log_level=DEFAULT_FILE_LOGLEVEL,
             stderrHandler.setFormatter(stderrFormatter)
             stderrHandler.setLevel(_log_level)
             logger.addHandler(stderrHandler)
+            metrics = start_metrics(_ctx().invoked_subcommand,
+                                    sample_memory=_ctx().invoked_subcommand is not None,
+                                    max_memory=_ctx().params['max_memory'])
+            _ctx().call_on_close(metrics.stop_sampler)
 
             if not _ctx().params['no_log']: # start a log file
                 # If a subcommand was used, log to a file in the
@@ -96,9 +255,16 @@ def init_dual_logger(file_log_level=DEFAULT_FILE_LOGLEVEL,
                     logfileHandler.setFormatter(logfileFormatter)
                     logfileHandler.setLevel(file_log_level)
                     logger.addHandler(logfileHandler)
+                    # write stage metrics next to the log when done
+                    _ctx().call_on_close(functools.partial(
+                        metrics.write, metrics_path(logfile_path)))
             logger.debug('Command line: "%s"', ' '.join(sys.argv))
             logger.debug('%s version %s', PROGRAM_NAME, VERSION)
             logger.debug('Run started at %s', str(STARTTIME)[:-7])
+            if _ctx().params['profile'] and _ctx().invoked_subcommand is not None:
+                profiler = start_profiler(_ctx().params['profile'],
+                                          _ctx().invoked_subcommand)
+                _ctx().call_on_close(profiler.stop)
 
             return f(*args, **kwargs)
         return wrapper
@@ -111,11 +277,10 @@ def init_user_context_obj(initial_obj=None):
     def decorator(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            global config_obj
             if initial_obj is None:
-                _ctx().obj = {}
+                _ctx().obj = UserContextObject()
             else:
-                _ctx().obj = initial_obj
+                _ctx().obj = UserContextObject(initial_obj)
             ctx_dict = _ctx().obj
             if _ctx().params['verbose']:
                 ctx_dict['logLevel'] = 'verbose'
@@ -123,33 +288,10 @@ def init_user_context_obj(initial_obj=None):
                 ctx_dict['logLevel'] = 'quiet'
             else:
                 ctx_dict['logLevel'] = 'default'
-            for key in ['progress', 'first_n']:
+            for key in ['progress', 'first_n', 'plots', 'rebuild',
+                        'compress', 'compress_level']:
                 ctx_dict[key] = _ctx().params[key]
-            #
-            # simplicity objects
-            #
-            ctx_dict['simplicity_objects'] = [globals()[key] for key in
-                                                globals().keys() if key.endswith('SIMPLICITY')
-                                              if isinstance(globals()[key], SimplicityObject)]
-            #
-            # simplicity objects in plugins
-            #
-            for entry_point in iter_entry_points('aakbar.simplicity_plugins'):
-                ctx_dict['simplicity_objects'].append(entry_point.load())
-            # selected simplicity object
-            try:
-                simplicity_object_label = config_obj.config_dict['simplicity_object_label']
-            except KeyError:
-                simplicity_object_label = None
-            if simplicity_object_label != None:
-                for obj in ctx_dict['simplicity_objects']:
-                    if obj.label == simplicity_object_label:
-                        ctx_dict['simplicity_object'] = obj
-            else:
-                try:
-                    ctx_dict['simplicity_object'] = ctx_dict['simplicity_objects'][0]
-                except IndexError:
-                    ctx_dict['simplicity_object'] = None
+            # simplicity objects are found when first looked up
             return f(*args, **kwargs)
         return wrapper
     return decorator
@@ -168,7 +310,9 @@ def log_elapsed_time():
 
 
 @with_plugins(iter_entry_points('aakbar.cli_plugins'))
-@click.group(epilog=AUTHOR+' <'+EMAIL+'>.  '+COPYRIGHT)
+@click.group(cls=LazyCommandGroup,
+             lazy_command_modules=LAZY_COMMAND_MODULES,
+             epilog=AUTHOR+' <'+EMAIL+'>.  '+COPYRIGHT)
 @click.option('--warnings_as_errors', is_flag=True, show_default=True,
               default=False, help='Warnings cause exceptions.')
 @click.option('-v', '--verbose', is_flag=True, show_default=True,
@@ -181,20 +325,54 @@ def log_elapsed_time():
               default=False, help='Show a progress bar, if supported.')
 @click.option('--first_n', default=DEFAULT_FIRST_N,
                help='Process only this many records. [default: all]')
+@click.option('--plots/--no-plots', default=True, show_default=True,
+              help='Render plots in the background, else only write plot data.')
+@click.option('--rebuild', is_flag=True, show_default=True,
+              default=False, help='Remake outputs even if up to date.')
+@click.option('--max_memory', type=MEMORY_SIZE, default=None,
+              help='Stop if resident memory exceeds this size, e.g. 8G.')
+@click.option('--profile', type=click.Choice(PROFILE_MODES), default=None,
+              help='Profile COMMAND, writing results in ./logs/.')
+@click.option('--compress', type=click.Choice(['gzip', 'bgzf']), default=None,
+              help='Compress TSV and FASTA outputs.')
+@click.option('--compress_level', type=click.IntRange(1, 9), default=6,
+              show_default=True, help='Level of output compression.')
 @click.version_option(version=VERSION, prog_name=PROGRAM_NAME)
 @init_dual_logger()
 @init_user_context_obj()
 def cli(warnings_as_errors, verbose, quiet,
-        progress, first_n, no_log):
+        progress, first_n, plots, rebuild, max_memory, profile,
+        compress, compress_level, no_log):
     """aakbar -- amino-acid k-mer signature tools
 
     If COMMAND is present, and --no_log was not invoked,
-    a log file named akbar-COMMAND.log
+    a log file named akbar-COMMAND.log and a JSON file of per-stage
+    timings and counts named aakbar-COMMAND-metrics.json
     will be written in the ./logs/ directory.
+
+    Peak memory of each stage is logged.  With --max_memory, COMMAND
+    stops with an error once its resident memory exceeds the limit,
+    instead of being killed by the system.
+
+    With --profile cprofile, COMMAND is run under cProfile.  With
+    --profile sample, its stack is sampled with little overhead.  Stats
+    and a summary of the top functions are written in ./logs/.
+
+    Plots are described by COMMAND in *_plotspec.yaml files and rendered
+    in the background.  With --no-plots they are not rendered, and may
+    be rendered later with render_plots.
+
+    With --compress gzip or bgzf, TSV and FASTA outputs are compressed
+    under their usual names.  Compressed inputs are detected by all
+    commands.
     """
     if warnings_as_errors:
         logger.debug('Runtime warnings (e.g., from pandas) will cause exceptions')
         warnings.filterwarnings('error')
+    if compress is not None:
+        # imported here, as it imports pyfaidx
+        from .compression import set_output_compression
+        set_output_compression(compress, compress_level)
 
 
 @cli.command()
@@ -220,10 +398,5 @@ def show_context_object():
     for key in user_ctx.keys():
         logger.info('   %s: %s', key, user_ctx[key])
 
-#import other cli functions
-from .config import *
-from .core import *
-from .simplicity import *
-from .search import *
-from .plot import *
+# Other cli functions are imported on demand by LazyCommandGroup.
 
@@ -7,6 +7,6 @@ aakbar -- amino-acid k-mer signature tools
 # python3 -m aakbar
 # from the directory above this one.
 
-from .__init__ import cli
+from . import cli
 if __name__ == '__main__':
     cli(auto_envvar_prefix='AAKBAR')
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''Per-sequence assignment to sets from signature hits.
+
+Each distinct signature hit in a sequence casts one vote, split equally
+among the sets that contain it according to the presence bits of the
+signature index.  The sequence is assigned to the set with the most
+votes, with confidence equal to that set's share of the votes.
+'''
+
+# standard library imports
+import os
+import csv
+
+# external packages
+import numpy as np
+
+# module imports
+from .common import *
+from . import logger
+from .compression import open_output
+
+#
+# Global constants
+#
+CLASSIFICATION_FIELDS = ['key',
+                         'length',
+                         'n_hits',
+                         'n_signatures',
+                         'assignment',
+                         'confidence',
+                         'runner_up',
+                         'runner_up_confidence']
+
+#
+# Helper functions begin here.
+#
+def presence_votes(index, ordinals):
+    '''Split a vote from each distinct signature among sets containing it.
+
+    :param index: SignatureIndex object with presence bits.
+    :param ordinals: Array of signature ordinals hit, with repeats.
+    :return: Tuple of (array of votes per set, number of distinct signatures).
+    '''
+    n_sets = len(index.presence_sets)
+    distinct = np.unique(ordinals)
+    if len(distinct) == 0:
+        return np.zeros(n_sets), 0
+    bits = np.unpackbits(index.presence[distinct], axis=1)[:, :n_sets]
+    n_present = bits.sum(axis=1)
+    in_any = n_present > 0
+    votes = (bits[in_any]/n_present[in_any, np.newaxis].astype(np.float64)).sum(axis=0)
+    return votes, len(distinct)
+
+
+def assign_from_votes(votes):
+    '''Pick the best and runner-up sets from votes.
+
+    :param votes: Array of votes per set.
+    :return: Tuple of (best set number, confidence, runner-up set number,
+             runner-up confidence), with None for sets if no votes.
+    '''
+    total = votes.sum()
+    if total == 0.:
+        return None, 0., None, 0.
+    order = np.argsort(votes, kind='mergesort')[::-1]
+    best = order[0]
+    if len(order) > 1 and votes[order[1]] > 0.:
+        runner_up = order[1]
+        runner_up_confidence = votes[runner_up]/total
+    else:
+        runner_up = None
+        runner_up_confidence = 0.
+    return best, votes[best]/total, runner_up, runner_up_confidence
+
+#
+# Classes begin here.
+#
+class SignatureClassifier(object):
+    '''Assign each sequence to a set while searching.
+
+    Has the same per-set and per-sequence interface as
+    PeptideSignatureSearcher, but writes only a compact per-sequence
+    classification table.
+    '''
+    def __init__(self, filestem, index):
+        self.filestem = filestem
+        self.index = index
+        self.k = index.k
+        if index.presence is None:
+            logger.error('Signature index "%s" has no set presence information.',
+                         index.indexdir)
+            logger.error('Rerun compile_signatures with --presence_stem and a set list.')
+            sys.exit(1)
+        self.sets = index.presence_sets
+        logger.info('%d %d-mer terms in %d sets defined in signature file.',
+                    len(self.index), self.k, len(self.sets))
+        # attributes to be initialized per set
+        self.code = None
+        self.n_seqs = None
+        self.n_assigned = None
+        self.assignment_counts = None
+        self.classfh = None
+        self.classwriter = None
+
+
+    def output_paths(self, dir):
+        '''Paths of the outputs written for a set.
+
+        :param dir: Set directory.
+        :return: List of paths.
+        '''
+        return [os.path.join(dir, self.filestem + '_classes.tsv')]
+
+
+    def init_set(self, input_dict, code, dir, footprintpath=None, n_recs=0):
+        '''Initialize output for a set.  Footprints are not written.
+        '''
+        self.code = code
+        self.n_seqs = 0
+        self.n_assigned = 0
+        self.assignment_counts = np.zeros(len(self.sets), dtype=np.int64)
+        classpath = os.path.join(dir, self.filestem + '_classes.tsv')
+        logger.debug('Writing classifications to "%s".', classpath)
+        self.classfh = open_output(classpath)
+        self.classwriter = csv.writer(self.classfh, delimiter='\t',
+                                      lineterminator='\n')
+        self.classwriter.writerow(CLASSIFICATION_FIELDS)
+
+
+    def search_windows(self, key, s, frame_windows):
+        '''Classify one sequence from the packed windows of its frames.
+
+        :param key: Sequence key.
+        :param s: Sequence string.
+        :param frame_windows: List of (keys, valid) tuples, in frame order.
+        :return: None
+        '''
+        self.n_seqs += 1
+        hit_ordinals = []
+        for keys, valid in frame_windows:
+            ordinals, found = self.index.lookup(keys)
+            hit_ordinals.append(ordinals[found & valid])
+        if len(hit_ordinals):
+            hit_ordinals = np.concatenate(hit_ordinals)
+        else:
+            hit_ordinals = np.zeros(0, dtype=np.intp)
+        votes, n_signatures = presence_votes(self.index, hit_ordinals)
+        best, confidence, runner_up, runner_up_confidence = assign_from_votes(votes)
+        if best is None:
+            assignment = ''
+        else:
+            assignment = self.sets[best]
+            self.n_assigned += 1
+            self.assignment_counts[best] += 1
+        if runner_up is None:
+            runner_up_name = ''
+        else:
+            runner_up_name = self.sets[runner_up]
+        self.classwriter.writerow([key,
+                                   len(s),
+                                   len(hit_ordinals),
+                                   n_signatures,
+                                   assignment,
+                                   '%.4f' % confidence,
+                                   runner_up_name,
+                                   '%.4f' % runner_up_confidence])
+
+
+    def close_set(self):
+        self.classfh.close()
+        logger.info('   %d of %d sequences in %s assigned.',
+                    self.n_assigned, self.n_seqs, self.code)
+        for i in np.argsort(self.assignment_counts, kind='mergesort')[::-1]:
+            if self.assignment_counts[i] == 0:
+                break
+            logger.info('      %s: %d (%.1f%%)',
+                        self.sets[i],
+                        self.assignment_counts[i],
+                        100.*self.assignment_counts[i]/self.n_seqs)
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+'''Reading and writing of gzip- and BGZF-compressed files.
+
+Compressed inputs are recognized by their contents, not their names.
+Every command reads FASTA records in file order, so compressed files
+are streamed rather than indexed: a reader thread decompresses the file
+into a bounded queue, from which records are parsed while the next
+chunks are being decompressed.  BGZF files are made of independent
+blocks, which are decompressed by a pool of threads at once.
+
+Uncompressed files are read with pyfaidx, as before.
+
+TSV and FASTA outputs are compressed when the global --compress option
+is given.  File names are kept, so that manifests, file stems, and the
+commands that follow find the same files; readers of tables and FASTA
+detect compression from contents.  Data are compressed by a background
+thread while the command goes on producing them.
+'''
+
+# standard library imports
+import io
+import os
+import zlib
+import gzip
+import struct
+import queue
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+# external packages
+import pyfaidx
+
+# module imports
+from .common import *
+
+#
+# Global constants
+#
+COMPRESSED_EXTENSIONS = ['.gz', '.bgz', '.bgzf']
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_HEADER_SIZE = 12 # through XLEN
+BGZF_HEADER = struct.Struct('<4BI2BH2BH') # through the BC subfield length
+BGZF_BLOCK_SIZE = struct.Struct('<H')
+READ_SIZE = 2**20 # compressed bytes per read of plain gzip
+QUEUE_CHUNKS = 64 # decompressed chunks or pending blocks held in memory
+DECOMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+OUTPUT_COMPRESSIONS = ['gzip', 'bgzf']
+DEFAULT_COMPRESSION_LEVEL = 6
+BGZF_MAX_DATA = 65280 # uncompressed bytes per BGZF block, as htslib
+BGZF_TRAILER = struct.Struct('<2I') # CRC32 and uncompressed size
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+WRITE_BUFFER_SIZE = 2**20 # uncompressed bytes per chunk queued
+_output_compression = None
+_output_level = DEFAULT_COMPRESSION_LEVEL
+
+#
+# Helper functions begin here.
+#
+def compression_type(path):
+    '''Find how a file is compressed, from its first bytes.
+
+    :param path: Path to file.
+    :return: 'bgzf', 'gzip', or None if not compressed.
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(BGZF_HEADER.size)
+    if not header.startswith(GZIP_MAGIC):
+        return None
+    if len(header) == BGZF_HEADER.size:
+        fields = BGZF_HEADER.unpack(header)
+        # FEXTRA flag, and a first extra subfield of 'BC' with length 2
+        if fields[3] & 4 and fields[8:10] == (66, 67) and fields[10] == 2:
+            return 'bgzf'
+    return 'gzip'
+
+
+def table_compression(path):
+    '''Compression of a table, as the compression argument of pd.read_csv.
+
+    BGZF files are gzip files of many members, so both are read as gzip.
+
+    :param path: Path to table.
+    :return: 'gzip' or None.
+    '''
+    if compression_type(path) is None:
+        return None
+    return 'gzip'
+
+
+def open_text(path):
+    '''Open a text file for reading, compressed or not.
+
+    :param path: Path to file.
+    :return: File object.
+    '''
+    if compression_type(path) is None:
+        return open(path, 'rt')
+    return gzip.open(path, 'rt')
+
+
+def set_output_compression(compression, level=DEFAULT_COMPRESSION_LEVEL):
+    '''Set how outputs opened by open_output are compressed.
+
+    :param compression: One of OUTPUT_COMPRESSIONS, or None.
+    :param level: Compression level, from 1 (fastest) to 9 (smallest).
+    :return: None
+    '''
+    global _output_compression, _output_level
+    if compression is not None and compression not in OUTPUT_COMPRESSIONS:
+        raise ValueError('unknown output compression "%s"' % compression)
+    _output_compression = compression
+    _output_level = level
+
+
+def open_output(path):
+    '''Open a TSV or FASTA output for writing text.
+
+    :param path: Path to output file.
+    :return: File object, compressed as set by set_output_compression.
+    '''
+    if _output_compression is None:
+        return open(path, 'wt')
+    logger.debug('Writing %s-compressed "%s" at level %d.',
+                 _output_compression, path, _output_level)
+    return io.TextIOWrapper(io.BufferedWriter(CompressedWriter(path,
+                                                               _output_compression,
+                                                               _output_level),
+                                              buffer_size=WRITE_BUFFER_SIZE))
+
+
+def bgzf_block(data, level):
+    '''Compress data into a BGZF block.
+
+    :param data: At most BGZF_MAX_DATA bytes.
+    :param level: Compression level.
+    :return: Bytes of block.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = (BGZF_HEADER.size + BGZF_BLOCK_SIZE.size + len(deflated) +
+                  BGZF_TRAILER.size)
+    return b''.join([BGZF_HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2),
+                     BGZF_BLOCK_SIZE.pack(block_size - 1),
+                     deflated,
+                     BGZF_TRAILER.pack(zlib.crc32(data), len(data))])
+
+
+def split_fasta_ext(filename):
+    '''Split a FASTA file name into stem and extension.
+
+    Compression extensions are dropped, so that 'protein.faa.gz' gives
+    ('protein', '.faa').
+
+    :param filename: File name.
+    :return: Tuple of (stem, extension).
+    '''
+    stem, ext = os.path.splitext(filename)
+    if ext.lower() in COMPRESSED_EXTENSIONS:
+        stem, ext = os.path.splitext(stem)
+    return stem, ext
+
+
+def gzip_chunks(fh):
+    '''Decompress a gzip file, of one or more members.
+
+    :param fh: File opened for binary reading.
+    :return: Generator of decompressed bytes.
+    '''
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while True:
+        data = fh.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            if not decompressor.eof:
+                break
+            # another member follows
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+
+def bgzf_blocks(fh):
+    '''Read the raw deflate data of each BGZF block.
+
+    :param fh: File opened for binary reading.
+    :return: Generator of compressed bytes, one per block.
+    '''
+    while True:
+        header = fh.read(BGZF_HEADER.size)
+        if not header:
+            break
+        if len(header) < BGZF_HEADER.size or not header.startswith(GZIP_MAGIC):
+            raise ValueError('truncated or invalid BGZF block')
+        extra_length = BGZF_HEADER.unpack(header)[7]
+        # BSIZE is the first extra subfield, the rest is skipped
+        block_size = BGZF_BLOCK_SIZE.unpack(fh.read(BGZF_BLOCK_SIZE.size))[0]
+        fh.read(GZIP_HEADER_SIZE + extra_length - BGZF_HEADER.size - BGZF_BLOCK_SIZE.size)
+        data_length = block_size + 1 - GZIP_HEADER_SIZE - extra_length
+        block = fh.read(data_length)
+        if len(block) < data_length:
+            raise ValueError('truncated BGZF block')
+        yield block[:-8] # less CRC and size
+
+
+def inflate_block(block):
+    '''Decompress the raw deflate data of a BGZF block.
+
+    :param block: Compressed bytes.
+    :return: Decompressed bytes.
+    '''
+    return zlib.decompress(block, -zlib.MAX_WBITS)
+
+
+def open_fasta(path):
+    '''Open a FASTA file, compressed or not.
+
+    :param path: Path to FASTA file.
+    :return: pyfaidx.Fasta object if uncompressed, else StreamedFasta,
+             from which records must be read in file order.
+    '''
+    compression = compression_type(path)
+    if compression is None:
+        return pyfaidx.Fasta(path)
+    logger.debug('Reading %s-compressed FASTA "%s".', compression, path)
+    return StreamedFasta(path, compression)
+
+
+def fasta_keys(fasta, first_n=None):
+    '''Keys of the records of a FASTA object, in file order.
+
+    :param fasta: Object returned by open_fasta.
+    :param first_n: Number of records to use, or None for all.
+    :return: List of keys, or iterator if the file is streamed.
+    '''
+    if isinstance(fasta, StreamedFasta):
+        return islice(fasta.keys(), first_n or None)
+    if first_n:
+        return list(fasta.keys())[:first_n]
+    return fasta.keys()
+
+
+def n_fasta_keys(keys):
+    '''Number of keys returned by fasta_keys.
+
+    :param keys: Keys from fasta_keys.
+    :return: Number of keys, or None if not known before reading.
+    '''
+    try:
+        return len(keys)
+    except TypeError:
+        return None
+
+#
+# Classes begin here.
+#
+class DecompressionThread(threading.Thread):
+    '''Decompress a file into a bounded queue of chunks.
+
+    Plain gzip is decompressed by this thread.  For BGZF, this thread
+    reads blocks and hands them to a pool of threads, queueing their
+    futures in order.
+
+    :param path: Path to compressed file.
+    :param compression: 'gzip' or 'bgzf'.
+    :param threads: Number of threads decompressing BGZF blocks.
+    '''
+    def __init__(self, path, compression, threads=DECOMPRESSION_THREADS):
+        threading.Thread.__init__(self, name='decompression', daemon=True)
+        self.path = path
+        self.compression = compression
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._stop_event = threading.Event()
+        self.start()
+
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def run(self):
+        try:
+            with open(self.path, 'rb') as fh:
+                if self.compression == 'bgzf':
+                    with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                        for block in bgzf_blocks(fh):
+                            if not self._put(executor.submit(inflate_block, block)):
+                                return
+                else:
+                    for chunk in gzip_chunks(fh):
+                        if not self._put(chunk):
+                            return
+        except Exception as error:
+            self._put(error)
+            return
+        self._put(None)
+
+
+    def chunks(self):
+        '''Decompressed chunks, in file order.
+
+        :return: Generator of bytes.
+        '''
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            elif not isinstance(item, bytes):
+                item = item.result()
+            yield item
+
+
+    def stop(self):
+        '''Stop decompressing, discarding queued chunks.
+        '''
+        self._stop_event.set()
+        self.join()
+
+
+class FastaRecord(object):
+    '''A FASTA record, read from a stream.
+
+    Behaves as the pyfaidx records used by commands: str() gives the
+    sequence, and long_name the whole header.
+
+    :param long_name: Header, less '>'.
+    :param seq: Sequence string.
+    '''
+    def __init__(self, long_name, seq):
+        self.long_name = long_name
+        self.name = long_name.split(None, 1)[0] if long_name.strip() else ''
+        self.seq = seq
+
+
+    def __str__(self):
+        return self.seq
+
+
+    def __len__(self):
+        return len(self.seq)
+
+
+class StreamedFasta(object):
+    '''FASTA records of a compressed file, read once in order.
+
+    Keys are generated as records are read, and a record may be looked
+    up by key when it is the current record or one still to come.
+
+    :param path: Path to compressed FASTA file.
+    :param compression: 'gzip' or 'bgzf'.
+    '''
+    def __init__(self, path, compression):
+        self.filename = path
+        self._thread = DecompressionThread(path, compression)
+        self._records = self._parse()
+        self._current = None
+
+
+    def _parse(self):
+        header = None
+        seq_lines = []
+        remainder = b''
+        for chunk in self._thread.chunks():
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if line.startswith(b'>'):
+                    if header is not None:
+                        yield FastaRecord(header, b''.join(seq_lines).decode('ascii'))
+                    header = line[1:].rstrip(b'\r').decode('utf-8')
+                    seq_lines = []
+                elif header is not None:
+                    seq_lines.append(line.strip())
+        if remainder.startswith(b'>'):
+            if header is not None:
+                yield FastaRecord(header, b''.join(seq_lines).decode('ascii'))
+            header = remainder[1:].rstrip(b'\r').decode('utf-8')
+            seq_lines = []
+        elif header is not None:
+            seq_lines.append(remainder.strip())
+        if header is not None:
+            yield FastaRecord(header, b''.join(seq_lines).decode('ascii'))
+
+
+    def keys(self):
+        '''Keys of records, read as they are generated.
+
+        :return: Generator of keys.
+        '''
+        for record in self._records:
+            self._current = record
+            yield record.name
+
+
+    def __getitem__(self, key):
+        if self._current is not None and self._current.name == key:
+            return self._current
+        for record in self._records:
+            self._current = record
+            if record.name == key:
+                return record
+        raise KeyError('%s not found after current record of "%s"' % (key, self.filename))
+
+
+    def close(self):
+        '''Stop reading.
+        '''
+        self._thread.stop()
+
+
+class CompressedWriter(io.RawIOBase):
+    '''Binary file whose data are compressed by a background thread.
+
+    Writes are queued, and the thread compresses them into the file as
+    a single gzip member or as BGZF blocks ending with an EOF block.
+
+    :param path: Path to output file.
+    :param compression: 'gzip' or 'bgzf'.
+    :param level: Compression level.
+    '''
+    def __init__(self, path, compression, level=DEFAULT_COMPRESSION_LEVEL):
+        io.RawIOBase.__init__(self)
+        self.path = path
+        self.compression = compression
+        self.level = level
+        self.queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self._error = None
+        self._fh = open(path, 'wb')
+        self._thread = threading.Thread(target=self._compress,
+                                        name='compression', daemon=True)
+        self._thread.start()
+
+
+    def _compress(self):
+        try:
+            if self.compression == 'bgzf':
+                pending = b''
+                for data in iter(self.queue.get, None):
+                    pending += data
+                    n_full = len(pending) - len(pending) % BGZF_MAX_DATA
+                    for start in range(0, n_full, BGZF_MAX_DATA):
+                        self._fh.write(bgzf_block(pending[start:start+BGZF_MAX_DATA],
+                                                  self.level))
+                    pending = pending[n_full:]
+                if pending:
+                    self._fh.write(bgzf_block(pending, self.level))
+                self._fh.write(BGZF_EOF)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                              zlib.MAX_WBITS | 16)
+                for data in iter(self.queue.get, None):
+                    self._fh.write(compressor.compress(data))
+                self._fh.write(compressor.flush())
+        except Exception as error:
+            self._error = error
+            # keep taking data, so that writers are not blocked
+            for data in iter(self.queue.get, None):
+                pass
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        data = bytes(data)
+        if data:
+            self.queue.put(data)
+        return len(data)
+
+
+    def close(self):
+        if not self.closed:
+            io.RawIOBase.close(self)
+            self.queue.put(None)
+            self._thread.join()
+            self._fh.close()
+            if self._error is not None:
+                raise self._error
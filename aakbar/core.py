@@ -7,21 +7,26 @@ import os
 import shutil
 import locale
 import stat
+from concurrent.futures import ProcessPoolExecutor
 
 # external packages
 import pkg_resources
 import numpy as np
 import pandas as pd
-import pyfaidx
-
-# Matplotlib -use non-interactive backend
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 # module imports
 from .common import *
 from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .plotting import plot_lines, plot_spec_path
+from .manifest import (OutputManifest, manifest_path, remove_manifest,
+                       simplicity_params)
+from .metrics import stage, count, count_read, count_written, report_size
+from .simplicity import SimplicityObject
+from .compression import (open_fasta, fasta_keys, n_fasta_keys, split_fasta_ext,
+                          table_compression, open_output)
+from .packing import (check_packable_k, residue_codes, pack_codes, minimizer_mask,
+                      minimizer_sampling, read_sampling, write_sampling,
+                      term_shards, shard_stem, read_shards, write_shards)
 
 # global definitions
 ALPHABETSIZE = 20 # number of coded amino acids
@@ -30,6 +35,9 @@ UNITMULTIPLIER = 3.E6
 AMBIGUOUS_RESIDUES = ['X', '.']
 NUM_HISTOGRAM_BINS = 25
 DEFAULT_MAX_SCORE = 0.3
+FASTA_LINE_LENGTH = 60
+DEFAULT_WORKERS = os.cpu_count() or 1
+MERGED_COLUMNS = ('intersections', 'count', 'max_count', 'score')
 
 #
 # Helper functions begin here.
@@ -72,38 +80,44 @@ def frequency_and_score_histograms(freqs, scores, dir, filestem):
     :return:
     '''
     # calculate frequency histogram
-    binvals, freq_hist = np.unique(freqs, return_counts=True)
+    with stage('histogram'):
+        binvals, freq_hist = np.unique(freqs, return_counts=True)
     max_freq = max(binvals)
     hist_filepath = os.path.join(dir, filestem+'_freqhist.csv')
     logger.debug('Writing frequency histogram to %s.', hist_filepath)
     cumulative = np.cumsum(freq_hist)
     total = np.sum(freq_hist)
-    pd.DataFrame({'abundance':binvals,
-                  'count':freq_hist,
-                  'cumulative':cumulative,
-                  'cumulative_fraction':cumulative/total},
-                  columns=('abundance',
-                           'count',
-                           'cumulative',
-                           'cumulative_fraction')).to_csv(hist_filepath,
-                                                         index=False,
-                                                         float_format='%.3f')
+    with stage('write'), open_output(hist_filepath) as fh:
+        pd.DataFrame({'abundance':binvals,
+                      'count':freq_hist,
+                      'cumulative':cumulative,
+                      'cumulative_fraction':cumulative/total},
+                      columns=('abundance',
+                               'count',
+                               'cumulative',
+                               'cumulative_fraction')).to_csv(fh,
+                                                             index=False,
+                                                             float_format='%.3f')
+    count_written(hist_filepath)
     logger.info('   Maximum term frequency is %d (%.2e per unique %s).',
                 max_freq,
                 max_freq*UNITMULTIPLIER/len(freqs),
                 UNITNAME)
 
     # calculate score histogram
-    (score_hist, bins) = np.histogram(scores, bins=[0.,
-                                                    0.01, 0.03,
-                                                    0.1, 0.3,
-                                                    1.0, 1.3,
-                                                    2.0,3.0,4.0,5.0,100.])
+    with stage('histogram'):
+        (score_hist, bins) = np.histogram(scores, bins=[0.,
+                                                        0.01, 0.03,
+                                                        0.1, 0.3,
+                                                        1.0, 1.3,
+                                                        2.0,3.0,4.0,5.0,100.])
     score_hist = score_hist*100./len(scores)
     score_filepath = os.path.join(dir, filestem+'_scorehist.tsv')
     logger.debug('Writing score histogram to file "%s".', score_filepath)
-    pd.Series(score_hist, index=bins[:-1]).to_csv(score_filepath, sep='\t',
-                                                  float_format='%.2f')
+    with stage('write'), open_output(score_filepath) as fh:
+        pd.Series(score_hist, index=bins[:-1]).to_csv(fh, sep='\t',
+                                                      float_format='%.2f')
+    count_written(score_filepath)
 
 
 def intersection_histogram(frame, dir, filestem, plot_type, n_sets, k):
@@ -122,23 +136,25 @@ def intersection_histogram(frame, dir, filestem, plot_type, n_sets, k):
     intersect_filepath = os.path.join(dir, filestem+'_intersect.tsv')
     logger.debug('Writing intersection frequency histograms to %s.', intersect_filepath)
     max_freq = max(frame['max_count'])
-    while nextbin < max_freq:
-        inrange = frame[frame['max_count'].isin([lastbin,nextbin])]
-        ibins, ifreqs = np.unique(inrange['intersections'], return_counts=True)
-        intersect_bins.append(nextbin)
-        hists[nextbin] = pd.Series(ifreqs, index=ibins)
-        lastbin = nextbin
-        nextbin *= 2
-    intersect_frame = pd.DataFrame(hists).transpose().fillna(0).astype(int)
-    intersect_frame.to_csv(intersect_filepath, sep='\t')
+    with stage('histogram'):
+        while nextbin < max_freq:
+            inrange = frame[frame['max_count'].isin([lastbin,nextbin])]
+            ibins, ifreqs = np.unique(inrange['intersections'], return_counts=True)
+            intersect_bins.append(nextbin)
+            hists[nextbin] = pd.Series(ifreqs, index=ibins)
+            lastbin = nextbin
+            nextbin *= 2
+        intersect_frame = pd.DataFrame(hists).transpose().fillna(0).astype(int)
+    with stage('write'), open_output(intersect_filepath) as fh:
+        intersect_frame.to_csv(fh, sep='\t')
+    count_written(intersect_filepath)
     #
     # plot intersection histograms
     #
     plot_filepath = os.path.join(dir, filestem+'_intersect.'+ plot_type)
     logger.debug('Plotting intersection histograms to %s.', plot_filepath)
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
     xvals = np.array(list(range(2, n_sets+1)), dtype=np.int32)
+    series = []
     for i in range(len(intersect_frame)):
         bin_edge = intersect_frame.index[i]
         data = intersect_frame.iloc[i]
@@ -152,30 +168,699 @@ def intersection_histogram(frame, dir, filestem, plot_type, n_sets, k):
                                       locale.format('%d',
                                                     sum,
                                                     grouping=True))
-        ax.plot(xvals,
-                data*100./sum,
-                '-',
-                label=label)
-    ax.legend(loc=9)
-    plt.xlim([2,n_sets])
-    plt.title('%d-mer Intersections Across %d Genomes' %(k, n_sets))
-    plt.xlabel('Number Intersecting')
-    plt.ylabel('% of Shared 10-mers in Bin')
-    plt.savefig(plot_filepath)
+        series.append({'x': xvals,
+                       'y': data.reindex(xvals, fill_value=0)*100./sum,
+                       'label': label})
+    plot_lines(plot_filepath, series,
+               '%d-mer Intersections Across %d Genomes' %(k, n_sets),
+               'Number Intersecting',
+               '%% of Shared %d-mers in Bin' % k,
+               xlim=[2, n_sets],
+               legend_loc=9)
+
+
+def term_lengths(k):
+    '''Parse term lengths given as a single length, range, or list.
+
+    :param k: Integer, or string such as '10', '8-14', or '8,10,12'.
+    :return: Sorted list of unique term lengths.
+    '''
+    if isinstance(k, int):
+        return [k]
+    ks = set()
+    for part in str(k).split(','):
+        if '-' in part:
+            low, high = part.split('-', 1)
+            ks.update(range(int(low), int(high)+1))
+        else:
+            ks.add(int(part))
+    if not ks:
+        raise ValueError('no term lengths in "%s"' % k)
+    return sorted(ks)
+
+
+def term_stem(outfilestem, k, ks):
+    '''Output file stem of terms of length k.
+
+    :param outfilestem: Output file stem, in which '{k}' is replaced by k.
+                        Without '{k}', '_k-K' is appended if there is
+                        more than one term length.
+    :param k: Term length.
+    :param ks: All term lengths being calculated.
+    :return: File stem.
+    '''
+    if '{k}' in outfilestem:
+        return outfilestem.replace('{k}', str(k))
+    elif len(ks) > 1:
+        return '%s_k-%d' % (outfilestem, k)
+    return outfilestem
+
+
+def check_minimizer_window(minimizer_window, k):
+    '''Check a minimizer window, exiting with an error message if invalid.
+
+    :param minimizer_window: Window in terms, or None.
+    :param k: Longest term length.
+    :return: Window, or None if terms are not to be sampled.
+    '''
+    if minimizer_window is None:
+        return None
+    if minimizer_window < 1:
+        logger.error('Minimizer window must be >=1.')
+        sys.exit(1)
+    check_packable_k(k)
+    if minimizer_window == 1:
+        return None
+    logger.info('Only minimizers of every %d terms will be kept.', minimizer_window)
+    return minimizer_window
+
+
+def sequence_terms(seq, ks, simplicity_obj, minimizer_window=None):
+    '''Find the unambiguous terms of a sequence for several term lengths.
+
+    Each term is the window of the longest length starting at a position,
+    with residues past the longest unambiguous term at that position set
+    to zero bytes.  Terms of a shorter length k are the first k residues
+    of windows with at least k usable residues.  As in scoring with a
+    single k, the window at the very end of the sequence is not used.
+
+    :param seq: Sequence, with masked positions in lower case.
+    :param ks: Sorted list of term lengths.
+    :param simplicity_obj: Simplicity object, used for scoring.
+    :param minimizer_window: If not None, also mark which terms of each
+                             length are minimizers in windows of this many
+                             terms, chosen as in searches.
+    :return: Tuple of (array of windows of shape (n, max(ks)) and dtype
+             uint8, array of usable lengths, array of scores of shape
+             (n, len(ks)), boolean array of minimizers of shape
+             (n, len(ks)) or None, list of number of windows per k).
+    '''
+    k_min = ks[0]
+    k_max = ks[-1]
+    n_windows = [max(len(seq) - k + 1, 0) for k in ks]
+    n_starts = len(seq) - k_min
+    if n_starts <= 0:
+        return (np.zeros((0, k_max), dtype=np.uint8),
+                np.zeros(0, dtype=np.uint8),
+                np.zeros((0, len(ks)), dtype=np.int16),
+                None if minimizer_window is None else np.zeros((0, len(ks)), dtype=bool),
+                n_windows)
+    seq_bytes = np.frombuffer(to_bytes(to_str(seq)), dtype=np.uint8)
+    residues = np.frombuffer(to_bytes(to_str(seq).upper()), dtype=np.uint8)
+    n_residues = len(residues)
+    #
+    # usable length at each start is limited by ambiguous residues and by
+    # the sequence end
+    #
+    starts = np.arange(n_starts)
+    ambiguous = np.flatnonzero(np.isin(residues,
+                                       np.frombuffer(to_bytes(''.join(AMBIGUOUS_RESIDUES)),
+                                                     dtype=np.uint8)))
+    next_ambiguous = np.append(ambiguous, n_residues)[np.searchsorted(ambiguous, starts)]
+    usable = np.minimum(np.minimum(next_ambiguous, n_residues - 1) - starts, k_max)
+    keep = usable >= k_min
+    starts = starts[keep]
+    usable = usable[keep].astype(np.uint8)
+    padded = np.concatenate((residues, np.zeros(k_max, dtype=np.uint8)))
+    windows = np.lib.stride_tricks.as_strided(padded,
+                                              shape=(n_starts, k_max),
+                                              strides=(padded.strides[0],)*2)[keep]
+    windows[np.arange(k_max)[np.newaxis, :] >= usable[:, np.newaxis]] = 0
+    #
+    # scores are counts of masked residues in each window
+    #
+    scores = np.zeros((len(starts), len(ks)), dtype=np.int16)
+    if type(simplicity_obj).score is SimplicityObject.score:
+        n_lower = np.concatenate(([0], np.cumsum((seq_bytes >= ord('a')) &
+                                                 (seq_bytes <= ord('z')))))
+        for j, k in enumerate(ks):
+            ends = np.minimum(starts + k, n_residues)
+            scores[:, j] = n_lower[ends] - n_lower[starts]
+    else:
+        for j, k in enumerate(ks):
+            simplicity_obj.set_k(k)
+            k_scores = np.array(simplicity_obj.score(seq))
+            valid = usable >= k
+            scores[valid, j] = k_scores[starts[valid]]
+    #
+    # minimizers are chosen on upper-case residues, as searches see them
+    #
+    if minimizer_window is None:
+        return windows, usable, scores, None, n_windows
+    minimizers = np.zeros((len(starts), len(ks)), dtype=bool)
+    codes = residue_codes(residues)
+    for j, k in enumerate(ks):
+        keys, valid = pack_codes(codes, k)
+        selected = np.append(minimizer_mask(keys, valid, minimizer_window), False)
+        minimizers[:, j] = selected[np.minimum(starts, len(keys))]
+    return windows, usable, scores, minimizers, n_windows
+
+
+def log_term_counts(k, n_recs, n_residues, n_raw_terms, n_terms, n_unique):
+    '''Log the numbers of input and unique terms of a set.
+
+    :param k: Term length.
+    :param n_recs: Number of sequences.
+    :param n_residues: Number of residues.
+    :param n_raw_terms: Number of windows, including ambiguous ones.
+    :param n_terms: Number of unambiguous terms.
+    :param n_unique: Number of unique terms.
+    :return: None
+    '''
+    n_skipped = n_raw_terms - n_terms
+    logger.info('   %s genes, %s residues, %s (%0.2f%%) ambiguous, and %s input %d-mers.',
+                locale.format('%d', n_recs, grouping=True),
+                locale.format('%d', n_residues, grouping=True),
+                locale.format('%d', n_skipped, grouping=True),
+                100*n_skipped/n_raw_terms,
+                locale.format('%d', n_terms, grouping=True),
+                k)
+    logger.info('   %s unique terms (%.2f%% of input, %.6f%% of %s possible %d-mers).',
+                locale.format('%d', n_unique, grouping=True),
+                100.*n_unique/n_terms,
+                100.*n_unique/(ALPHABETSIZE**k),
+                locale.format('%d', ALPHABETSIZE**k, grouping=True),
+                k)
+
+
+def run_beginnings(prefix_lengths, counted, k):
+    '''Find where runs of equal terms begin among sorted windows.
+
+    :param prefix_lengths: Array of the length of the prefix each sorted
+                           window shares with the one before, zero for
+                           the first.
+    :param counted: Boolean array of windows to be counted.
+    :param k: Term length.
+    :return: Tuple of (indexes of counted windows, positions in those
+             at which runs of equal terms begin).
+    '''
+    counted = np.flatnonzero(counted)
+    if len(counted) == 0:
+        return counted, np.zeros(0, dtype=np.intp)
+    # windows not counted may lie within a run, so take the least prefix
+    # length between each counted window and the one before
+    prefix_lengths = np.minimum.reduceat(prefix_lengths[:counted[-1]+1],
+                                         np.append(0, counted[:-1] + 1))
+    return counted, np.flatnonzero(prefix_lengths < k)
+
+
+def count_set_terms(seqs, ks, simplicity_obj, minimizer_window=None):
+    '''Count the unique terms in the sequences of a set for several term lengths.
+
+    Windows of the longest length are sorted once.  Because sorting is
+    lexical, terms of any shorter length that share a prefix are adjacent,
+    so unique terms of each length are found from the length of the
+    common prefix of adjacent windows.
+
+    :param seqs: Iterable of sequences.
+    :param ks: Sorted list of term lengths.
+    :param simplicity_obj: Simplicity object, used for scoring.
+    :param minimizer_window: If not None, count only terms that are
+                             minimizers in windows of this many terms.
+    :return: List, one per term length, of tuples of (sorted array of
+             unique terms, array of counts, array of mean scores).
+    '''
+    k_max = ks[-1]
+    window_arrays = []
+    usable_arrays = []
+    score_arrays = []
+    minimizer_arrays = []
+    n_recs = 0
+    n_residues = 0
+    n_raw_terms = np.zeros(len(ks), dtype=np.int64)
+    for seq in seqs:
+        with stage('extract'):
+            windows, usable, scores, minimizers, n_windows = sequence_terms(
+                seq, ks, simplicity_obj, minimizer_window=minimizer_window)
+            window_arrays.append(windows)
+            usable_arrays.append(usable)
+            score_arrays.append(scores)
+            minimizer_arrays.append(minimizers)
+            n_recs += 1
+            n_residues += len(seq)
+            n_raw_terms += n_windows
+    with stage('extract'):
+        term_arr = np.concatenate(window_arrays + [np.zeros((0, k_max), dtype=np.uint8)])
+        usable_arr = np.concatenate(usable_arrays + [np.zeros(0, dtype=np.uint8)])
+        score_arr = np.concatenate(score_arrays + [np.zeros((0, len(ks)), dtype=np.int16)])
+        if minimizer_window is not None:
+            minimizer_arr = np.concatenate(minimizer_arrays +
+                                           [np.zeros((0, len(ks)), dtype=bool)])
+    del window_arrays, usable_arrays, score_arrays, minimizer_arrays
+    report_size('term_arr', term_arr)
+    report_size('score_arr', score_arr)
+    #
+    # sort windows once, and find common prefix lengths of neighbors
+    #
+    with stage('sort'):
+        sort_arr = np.argsort(np.ascontiguousarray(term_arr).view(np.dtype(('S%d'%(k_max)))).ravel(),
+                              kind='mergesort')
+        report_size('sort_arr', sort_arr)
+        term_arr = term_arr[sort_arr]
+        usable_arr = usable_arr[sort_arr]
+        score_arr = score_arr[sort_arr]
+        if minimizer_window is not None:
+            minimizer_arr = minimizer_arr[sort_arr]
+        del sort_arr
+        differs = term_arr[1:] != term_arr[:-1]
+        prefix_lengths = np.where(differs.any(axis=1), differs.argmax(axis=1), k_max)
+        del differs
+        prefix_lengths = np.minimum(prefix_lengths,
+                                    np.minimum(usable_arr[1:], usable_arr[:-1]))
+        prefix_lengths = np.concatenate(([0], prefix_lengths))
+    results = []
+    for j, k in enumerate(ks):
+        with stage('sort'):
+            usable = usable_arr >= k
+            n_terms = int(usable.sum())
+            if minimizer_window is not None:
+                usable &= minimizer_arr[:, j]
+            counted, beginnings = run_beginnings(prefix_lengths, usable, k)
+            freqs = np.diff(np.append(beginnings, len(counted)))
+            unique_terms = np.ascontiguousarray(term_arr[counted[beginnings], :k]
+                                                ).view(np.dtype(('S%d'%(k)))).ravel()
+            if len(counted):
+                mean_scores = (np.add.reduceat(score_arr[counted, j].astype(np.float64),
+                                               beginnings)/freqs).astype(np.float32)
+            else:
+                mean_scores = np.zeros(0, dtype=np.float32)
+        count('kmers', len(counted))
+        log_term_counts(k, n_recs, n_residues, n_raw_terms[j], n_terms, len(unique_terms))
+        if minimizer_window is not None:
+            logger.info('   %s (%.2f%%) of input %d-mers are minimizers in windows of %d.',
+                        locale.format('%d', len(counted), grouping=True),
+                        100.*len(counted)/n_terms,
+                        k,
+                        minimizer_window)
+        results.append((unique_terms, freqs, mean_scores))
+    return results
+
+
+def write_set_terms(unique_terms, freqs, mean_scores, dir, outfilestem, n_shards=1):
+    '''Write the terms of a set, in order of count, and their histograms.
+
+    :param unique_terms: Array of unique terms.
+    :param freqs: Array of counts.
+    :param mean_scores: Array of mean scores.
+    :param dir: Output directory.
+    :param outfilestem: Output file stem.
+    :param n_shards: If more than 1, terms are written to this many
+                     shard files instead of one file, and histograms
+                     are of all shards.
+    :return: None
+    '''
+    if n_shards > 1:
+        with stage('shard'):
+            shards = term_shards(unique_terms, n_shards)
+        stems = [(shard_stem(outfilestem, p, n_shards), shards == p)
+                 for p in range(n_shards)]
+    else:
+        stems = [(outfilestem, slice(None))]
+    for stem, selected in stems:
+        term_filepath = os.path.join(dir, stem+'_terms.tsv')
+        logger.debug('writing unique terms and counts to %s', term_filepath)
+        with stage('write'), open_output(term_filepath) as fh:
+            terms = unique_terms[selected]
+            term_freqs = freqs[selected]
+            sort_arr = np.argsort(term_freqs)
+            pd.DataFrame({'count':term_freqs[sort_arr],
+                          'score':mean_scores[selected][sort_arr]},
+                         index=[i.decode('UTF-8') for i in terms[sort_arr]],
+                         ).to_csv(fh,
+                                  sep='\t',
+                                  float_format='%.2f')
+            del terms, term_freqs, sort_arr
+        count_written(term_filepath)
+    # histograms
+    frequency_and_score_histograms(freqs, mean_scores, dir, outfilestem)
+
+
+def read_set_terms(termfilepath):
+    '''Read the terms of a set as arrays.
+
+    :param termfilepath: Path to per-set terms file.
+    :return: Tuple of (array of terms, array of counts, array of scores).
+    '''
+    with stage('read'):
+        term_frame = pd.read_csv(termfilepath,
+                                 sep='\t',
+                                 compression=table_compression(termfilepath),
+                                 index_col=0,
+                                 keep_default_na=False)
+    count_read(termfilepath)
+    k = len(term_frame.index[0]) if len(term_frame) else 1
+    return (np.array(term_frame.index, dtype=np.dtype(('S%d'%(k)))),
+            term_frame['count'].values,
+            term_frame['score'].values)
+
+
+def merge_set_terms(set_terms, setlist):
+    '''Merge the terms of multiple sets and keep those found in two or more.
+
+    As when the sets were joined onto the first one, only terms of the
+    first set are kept.
+
+    :param set_terms: List of (terms, counts, scores) tuples, one per set,
+                      with terms unique within each set.
+    :param setlist: Names of sets, for logging.
+    :return: Merged term frame.
+    '''
+    with stage('merge'):
+        all_terms = np.concatenate([terms for terms, counts, scores in set_terms])
+        all_counts = np.concatenate([counts for terms, counts, scores in set_terms])
+        all_scores = np.concatenate([scores for terms, counts, scores in set_terms])
+        unique_terms, inverse = np.unique(all_terms, return_inverse=True)
+        inverse = inverse.ravel()
+        in_first = np.zeros(len(unique_terms), dtype=bool)
+        in_first[inverse[:len(set_terms[0][0])]] = True
+        report_size('all_terms', all_terms)
+        report_size('inverse', inverse)
+        del all_terms
+    n_unique_terms = int(in_first.sum())
+    n_terms_total = len(inverse)
+    for calc_set, (terms, counts, scores) in zip(setlist, set_terms):
+        logger.info('   %s: %s terms in (%.0f%% of %s unique, %.0f%% of %s total read)',
+                    calc_set,
+                    locale.format("%d", len(terms), grouping=True),
+                    100.*len(terms)/n_unique_terms,
+                    locale.format("%d", n_unique_terms, grouping=True),
+                    100.*len(terms)/n_terms_total,
+                    locale.format('%d', n_terms_total, grouping=True))
+    k = unique_terms.dtype.itemsize
+    logger.info('%s unique %d-mers (%0.1f%% of %s total in).',
+                locale.format("%d", n_unique_terms, grouping=True),
+                k,
+                100.*n_unique_terms/n_terms_total,
+                locale.format('%d', n_terms_total, grouping=True))
+    with stage('merge'):
+        intersections = np.bincount(inverse, minlength=len(unique_terms))
+        total_count = np.bincount(inverse, weights=all_counts, minlength=len(unique_terms))
+        max_count = np.zeros(len(unique_terms), dtype=np.int64)
+        np.maximum.at(max_count, inverse, all_counts.astype(np.int64))
+        score = np.bincount(inverse, weights=all_scores*all_counts,
+                            minlength=len(unique_terms))
+    #
+    # drop terms that don't intersect in two sets
+    #
+    intersecting = in_first & (intersections > 1)
+    n_intersecting_terms = int(intersecting.sum())
+    logger.info('%s intersecting terms (%.1f%% of unique).',
+                locale.format('%d', n_intersecting_terms, grouping=True),
+                100.*n_intersecting_terms/n_unique_terms)
+    #
+    # clean up and normalize
+    #
+    with stage('merge'):
+        merged_frame = pd.DataFrame({'intersections': intersections[intersecting],
+                                     'count': total_count[intersecting].astype(np.int32),
+                                     'max_count': max_count[intersecting].astype(np.int32),
+                                     'score': score[intersecting]/total_count[intersecting]},
+                                    index=[term.decode('UTF-8') for term in unique_terms[intersecting]],
+                                    columns=MERGED_COLUMNS)
+    report_size('merged_frame', merged_frame)
+    return merged_frame
+
+
+def filter_terms(term_frame, cutoff):
+    '''Drop terms with simplicity scores above a cutoff.
+
+    :param term_frame: Merged term frame.
+    :param cutoff: Maximum simplicity score to keep.
+    :return: Filtered term frame.
+    '''
+    n_intersecting_terms = len(term_frame)
+    k = len(term_frame.index[0])
+    logger.info('   %d %d-mer terms initially.', n_intersecting_terms,
+                k)
+    with stage('filter'):
+        term_frame = term_frame[term_frame['score'] <= cutoff]
+    n_scored_terms = len(term_frame)
+    logger.info('   %s terms passing cutoff, representing',
+                locale.format('%d', n_scored_terms, grouping=True))
+    logger.info('       %.2f%% of %s intersecting terms, and',
+                n_scored_terms * 100. / n_intersecting_terms,
+                locale.format("%d", n_intersecting_terms, grouping=True))
+    logger.info('       %.6f%% of possible %d-mers.',
+                n_scored_terms * 100. / (ALPHABETSIZE ** k), k)
+    return term_frame
+
+
+def write_term_table(term_frame, dir, filestem):
+    '''Write merged terms, in order of max_count and intersections.
+
+    :param term_frame: Merged term frame.
+    :param dir: Output directory.
+    :param filestem: Output file stem.
+    :return: Sorted term frame.
+    '''
+    with stage('sort'):
+        term_frame = term_frame.sort_values(by=['max_count', 'intersections'])
+    term_filepath = os.path.join(dir, filestem+'_terms.tsv')
+    logger.debug('Writing merged terms to "%s".', term_filepath)
+    with stage('write'), open_output(term_filepath) as fh:
+        term_frame.to_csv(fh, sep='\t',
+                          float_format='%0.2f')
+    count_written(term_filepath)
+    return term_frame
+
+
+def merge_shard(shard, n_shards, dirs, filestem, setlist, outdir):
+    '''Merge one shard of the terms of multiple sets and write it.
+
+    :param shard: Shard number.
+    :param n_shards: Number of shards.
+    :param dirs: Directories of sets.
+    :param filestem: Term file stem, less shard and '_terms.tsv'.
+    :param setlist: Names of sets, for logging.
+    :param outdir: Output directory.
+    :return: Merged term frame of shard, or None if the shard is empty.
+    '''
+    stem = shard_stem(filestem, shard, n_shards)
+    set_terms = [read_set_terms(os.path.join(dir, stem+'_terms.tsv'))
+                 for dir in dirs]
+    if not len(set_terms[0][0]):
+        logger.info('Shard %d of %d is empty.', shard, n_shards)
+        return None
+    logger.info('Shard %d of %d:', shard, n_shards)
+    merged_frame = merge_set_terms(set_terms, setlist)
+    del set_terms
+    return write_term_table(merged_frame, outdir, stem)
+
+
+def filter_shard(shard, n_shards, dir, infilestem, outfilestem, cutoff):
+    '''Filter one shard of merged terms and write it.
+
+    :param shard: Shard number.
+    :param n_shards: Number of shards.
+    :param dir: Directory of merged terms.
+    :param infilestem: Input file stem, less shard and '_terms.tsv'.
+    :param outfilestem: Output file stem, less shard and '_terms.tsv'.
+    :param cutoff: Maximum simplicity score to keep.
+    :return: Filtered term frame of shard, or None if the shard is empty.
+    '''
+    infilepath = os.path.join(dir, shard_stem(infilestem, shard, n_shards)+'_terms.tsv')
+    with stage('read'):
+        term_frame = pd.read_csv(infilepath,
+                                 sep='\t',
+                                 compression=table_compression(infilepath),
+                                 index_col=0,
+                                 keep_default_na=False)
+    count_read(infilepath)
+    if not len(term_frame):
+        logger.info('Shard %d of %d is empty.', shard, n_shards)
+        return None
+    logger.info('Shard %d of %d:', shard, n_shards)
+    term_frame = filter_terms(term_frame, cutoff)
+    return write_term_table(term_frame, dir, shard_stem(outfilestem, shard, n_shards))
+
+
+def check_shard(shard, n_shards, filestem):
+    '''Check a shard number, exiting with an error message if invalid.
+
+    :param shard: Shard number, or None for all shards.
+    :param n_shards: Number of shards of input terms.
+    :param filestem: Input file stem, for messages.
+    :return: List of shard numbers to process.
+    '''
+    if shard is None:
+        return list(range(n_shards))
+    if n_shards == 1:
+        logger.error('Terms "%s" are not sharded; rerun calculate_peptide_terms with --shards.',
+                     filestem)
+        sys.exit(1)
+    if shard < 0 or shard >= n_shards:
+        logger.error('Shard must be from 0 to %d.', n_shards - 1)
+        sys.exit(1)
+    return [shard]
+
+
+def concat_term_frames(frames):
+    '''Concatenate term frames in order of term.
+
+    :param frames: List of merged term frames, possibly empty.
+    :return: Term frame, with no rows if frames is empty.
+    '''
+    if not frames:
+        return pd.DataFrame(columns=MERGED_COLUMNS)
+    return pd.concat(frames).sort_index()
+
+
+def read_shard_frames(dir, filestem, n_shards):
+    '''Read and concatenate the shards of a merged term table.
+
+    :param dir: Directory of merged terms.
+    :param filestem: File stem, less shard and '_terms.tsv'.
+    :param n_shards: Number of shards.
+    :return: Term frame of all shards, in order of term.
+    '''
+    frames = []
+    for p in range(n_shards):
+        infilepath = os.path.join(dir, shard_stem(filestem, p, n_shards)+'_terms.tsv')
+        if not os.path.exists(infilepath):
+            logger.error('input file "%s" does not exist.', infilepath)
+            sys.exit(1)
+        with stage('read'):
+            frames.append(pd.read_csv(infilepath,
+                                      sep='\t',
+                                      compression=table_compression(infilepath),
+                                      index_col=0,
+                                      keep_default_na=False))
+        count_read(infilepath)
+    with stage('merge'):
+        return concat_term_frames([frame for frame in frames
+                                   if len(frame)])
+
+
+def map_shards(function, shard_args, workers):
+    '''Call a function on each shard, in parallel if more than one worker.
+
+    :param function: Function of a shard, defined at module level.
+    :param shard_args: List of argument tuples, one per shard.
+    :param workers: Number of shards to process in parallel.
+    :return: Term frame of all shards, in order of term.
+    '''
+    workers = max(1, min(workers, len(shard_args)))
+    if workers == 1:
+        frames = [function(*args) for args in shard_args]
+    else:
+        logger.debug('Processing %d shards with %d workers.', len(shard_args), workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            frames = list(executor.map(function, *zip(*shard_args)))
+    with stage('merge'):
+        return concat_term_frames([frame for frame in frames
+                                   if frame is not None])
+
+
+def write_merged_terms(term_frame, dir, filestem, n_sets):
+    '''Write merged terms with their frequency, score, and intersection histograms.
+
+    :param term_frame: Merged term frame.
+    :param dir: Output directory.
+    :param filestem: Output file stem.
+    :param n_sets: Number of sets merged.
+    :return: None
+    '''
+    global config_obj
+    if not len(term_frame):
+        logger.error('No terms to write to "%s".',
+                     os.path.join(dir, filestem+'_terms.tsv'))
+        sys.exit(1)
+    k = len(term_frame.index[0])
+    #
+    # calculate frequency and score histograms
+    #
+    frequency_and_score_histograms(term_frame['count'],
+                                   term_frame['score'],
+                                   dir,
+                                   filestem)
+    #
+    # write terms
+    #
+    term_frame = write_term_table(term_frame, dir, filestem)
+    #
+    # calculate histogram of intersections
+    #
+    intersection_histogram(term_frame, dir, filestem,
+                           config_obj.config_dict['plot_type'],
+                           n_sets, k)
+
+
+def fasta_sequences(fasta, keys):
+    '''Generate sequences of FASTA records, counting records and residues.
+
+    :param fasta: Fasta object.
+    :param keys: Iterable of record keys.
+    :return: Generator of sequence strings.
+    '''
+    for key in keys:
+        with stage('read'):
+            seq = str(fasta[key])
+        count('records')
+        count('residues', len(seq))
+        yield seq
+
+
+def masked_sequences(fasta, keys, simplicity_obj, fh=None):
+    '''Generate masked sequences, optionally writing them as FASTA.
+
+    :param fasta: Fasta object.
+    :param keys: Iterable of record keys.
+    :param simplicity_obj: Simplicity object with cutoff set.
+    :param fh: If not None, open file to which masked records are written.
+    :return: Generator of masked sequence strings.
+    '''
+    for key in keys:
+        with stage('read'):
+            record = fasta[key]
+            seq = str(record)
+        count('records')
+        count('residues', len(seq))
+        with stage('mask'):
+            seq = simplicity_obj.mask(seq)
+        if fh is not None:
+            with stage('write'):
+                fh.write('>%s\n' % record.long_name)
+                for i in range(0, len(seq), FASTA_LINE_LENGTH):
+                    fh.write(seq[i:i+FASTA_LINE_LENGTH] + '\n')
+        yield seq
 
 
 #
 # Cli commands begin here.
 #
 @cli.command()
-@click.option('-k', default=DEFAULT_K, show_default=True, help='Term length')
+@click.option('-k', default=str(DEFAULT_K), show_default=True,
+              help='Term length, or range of lengths such as 8-14.')
+@click.option('--minimizer_window', type=int, default=None,
+              help='Keep only minimizers of every W consecutive terms.')
+@click.option('--shards', default=1, show_default=True,
+              help='Number of files into which terms are split by hash.')
 @click.argument('infilename', type=str)
 @click.argument('outfilestem', type=str)
 @click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
 @log_elapsed_time()
-def calculate_peptide_terms(k, infilename, outfilestem, setlist):
+def calculate_peptide_terms(k, minimizer_window, shards, infilename, outfilestem, setlist):
     '''Write peptide terms and histograms.
 
+    With a range of term lengths, terms of all lengths are found from
+    a single pass over the input, and written under OUTFILESTEM with
+    '{k}' replaced by each length, or with '_k-K' appended if OUTFILESTEM
+    does not contain '{k}'.
+
+    With --minimizer_window W, only terms that are minimizers (those with
+    the smallest hash among W consecutive terms) are counted, shrinking
+    term tables by about W/2.  Sampling is recorded in
+    OUTFILESTEM_sampling.yaml, and carried through intersect_peptide_terms,
+    filter_peptide_terms, and compile_signatures, so that
+    search_peptide_occurrances samples its windows the same way.
+
+    With --shards P, terms are split by a hash of each term into files
+    OUTFILESTEM_shard-p-of-P_terms.tsv, so that intersect_peptide_terms
+    and filter_peptide_terms can work on each shard separately.  The
+    number of shards is recorded in OUTFILESTEM_shards.yaml.
+
+    Example:
+        aakbar calculate_peptide_terms -k 8-14 protein_letterfreq10-5.faa protein_letterfreq10-5_k-{k} all
     '''
     # context inputs
     user_ctx = get_user_context_obj()
@@ -184,9 +869,24 @@ def calculate_peptide_terms(k, infilename, outfilestem, setlist):
     simplicity_obj = user_ctx['simplicity_object']
     logger.info('Simplicity function is %s.',
                 simplicity_obj.desc)
-    simplicity_obj.set_k(k)
+    try:
+        ks = term_lengths(k)
+    except ValueError:
+        logger.error('Term length "%s" is not a length or range such as 8-14.', k)
+        sys.exit(1)
+    for term_k in ks:
+        simplicity_obj.set_k(term_k)
+    minimizer_window = check_minimizer_window(minimizer_window, ks[-1])
+    if shards < 1:
+        logger.error('Number of shards must be >=1.')
+        sys.exit(1)
+    elif shards > 1:
+        logger.info('Terms will be split into %d shards.', shards)
     # parameter inputs
-    logger.info('Term size is %d characters.', k)
+    if len(ks) == 1:
+        logger.info('Term size is %d characters.', ks[0])
+    else:
+        logger.info('Term sizes are %s characters.', ', '.join([str(i) for i in ks]))
     logger.info('Input file name is "%s".', infilename)
     logger.info('Output file stem is "%s".', outfilestem)
     setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
@@ -200,105 +900,85 @@ def calculate_peptide_terms(k, infilename, outfilestem, setlist):
         if not os.path.exists(infilepath):
             logger.error('Input file "%s" does not exist.', infilepath)
             sys.exit(1)
+        manifests = {}
+        for term_k in ks:
+            stem = term_stem(outfilestem, term_k, ks)
+            params = simplicity_params(simplicity_obj)
+            params.update({'k': term_k,
+                           'first_n': user_ctx['first_n']})
+            if minimizer_window is not None:
+                params['minimizer_window'] = minimizer_window
+            if shards > 1:
+                params['shards'] = shards
+                table_stems = [shard_stem(stem, p, shards) for p in range(shards)]
+            else:
+                table_stems = [stem]
+            manifest = OutputManifest(manifest_path(dir, stem),
+                                      [infilepath],
+                                      params,
+                                      [os.path.join(dir, table_stem + '_terms.tsv')
+                                       for table_stem in table_stems] +
+                                      [os.path.join(dir, stem + suffix)
+                                       for suffix in ['_freqhist.csv',
+                                                      '_scorehist.tsv']])
+            if not manifest.is_up_to_date():
+                manifests[term_k] = manifest
+        if not manifests:
+            logger.info('   %s is up to date, skipping.', calc_set)
+            continue
+        calc_ks = sorted(manifests.keys())
+        for manifest in manifests.values():
+            manifest.invalidate()
+        fasta  = open_fasta(infilepath)
+        keys = fasta_keys(fasta, user_ctx['first_n'])
+        n_recs = n_fasta_keys(keys)
         #
-        # calculate each unambiguous term and its score
-        #
-        term_score_list = []
-        n_residues = 0
-        n_raw_terms = 0
-        fasta  = pyfaidx.Fasta(infilepath, mutable=True)
-        if user_ctx['first_n']:
-            keys = list(fasta.keys())[:user_ctx['first_n']]
-        else:
-            keys = fasta.keys()
-        n_recs = len(keys)
-        #
-        # loop on genes, with or without progress bars
+        # calculate each unambiguous term and its score,
+        # with or without progress bars
         #
         if user_ctx['progress']:
             with click.progressbar(keys, label='   %s genes processed' %calc_set,
                                    length=n_recs) as bar:
-                for key in bar:
-                    seq = fasta[key]
-                    s_scores = np.array(simplicity_obj.score(seq))
-                    seq = to_str(seq).upper()
-                    n_residues += len(seq)
-                    n_raw_terms += len(seq) - k + 1
-                    term_score_list += [ (str(seq[i:i+k]), s_scores[i])
-                                         for i in range(len(seq)-k)
-                                         if is_unambiguous(str(seq[i:i+k]))]
+                k_terms = count_set_terms(fasta_sequences(fasta, bar),
+                                          calc_ks, simplicity_obj,
+                                          minimizer_window=minimizer_window)
         else:
             logger.info('  %s: ', calc_set)
-            for key in keys:
-                seq = fasta[key]
-                s_scores = np.array(simplicity_obj.score(seq))
-                seq = to_str(seq).upper()
-                n_residues += len(seq)
-                n_raw_terms += len(seq) - k + 1
-                term_score_list += [ (str(seq[i:i+k]), s_scores[i])
-                                     for i in range(len(seq)-k)
-                                     if is_unambiguous(str(seq[i:i+k]))]
-
+            k_terms = count_set_terms(fasta_sequences(fasta, keys),
+                                      calc_ks, simplicity_obj,
+                                      minimizer_window=minimizer_window)
         fasta.close()
-        term_arr = np.array([term for term, score in term_score_list],
-                            dtype=np.dtype(('S%d'%(k))))
-        score_arr = np.array([score for term, score in term_score_list],
-                             dtype=np.int16)
-        del term_score_list
-        n_terms = len(term_arr)
-        n_skipped = n_raw_terms - n_terms
-        logger.info('   %s genes, %s residues, %s (%0.2f%%) ambiguous, and %s input terms.',
-                    locale.format('%d', n_recs, grouping=True),
-                    locale.format('%d', n_residues, grouping=True),
-                    locale.format('%d', n_skipped, grouping=True),
-                    100*n_skipped/n_raw_terms,
-                    locale.format('%d', n_terms, grouping=True),
-                    )
-        #
-        # calculate unique terms
-        #
-        sort_arr = np.argsort(term_arr)
-        term_arr = term_arr[sort_arr]
-        score_arr = score_arr[sort_arr]
-        unique_terms, beginnings, freqs = np.unique(term_arr,
-                                        return_index=True,
-                                        return_counts=True)
-        max_freq = max(freqs)
-        mean_scores = np.array([score_arr[beginnings[i]:beginnings[i]+freqs[i]].mean()
-                                for i in range(len(beginnings))], dtype=np.float32)
-        n_unique = len(unique_terms)
-        logger.info('   %s unique terms (%.2f%% of input, %.6f%% of %s possible %d-mers).',
-                    locale.format('%d', n_unique, grouping=True),
-                    100.*n_unique/n_terms,
-                    100.*n_unique/(ALPHABETSIZE**k),
-                    locale.format('%d', ALPHABETSIZE**k, grouping=True),
-                    k)
+        count_read(infilepath)
         #
         # write terms, counts, and scores in sorted form
         #
-        term_filepath = os.path.join(dir, outfilestem+'_terms.tsv')
-        logger.debug('writing unique terms and counts to %s', term_filepath)
-        sort_arr = np.argsort(freqs)
-        pd.DataFrame({'count':freqs[sort_arr],
-                      'score':mean_scores[sort_arr]},
-                     index=[i.decode('UTF-8') for i in unique_terms[sort_arr]],
-                     ).to_csv(term_filepath,
-                              sep='\t',
-                              float_format='%.2f')
-        del sort_arr
-        # histograms
-        frequency_and_score_histograms(freqs, mean_scores, dir, outfilestem)
+        for term_k, (unique_terms, freqs, mean_scores) in zip(calc_ks, k_terms):
+            stem = term_stem(outfilestem, term_k, ks)
+            write_set_terms(unique_terms, freqs, mean_scores, dir, stem,
+                            n_shards=shards)
+            write_sampling(dir, stem, minimizer_sampling(term_k, minimizer_window))
+            write_shards(dir, stem, shards)
+            manifests[term_k].write()
 
 
 @cli.command()
 @click.option('--cutoff', default=DEFAULT_MAX_SCORE, show_default=True,
               help='Maximum simplicity score to keep.')
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Number of shards to process in parallel.')
+@click.option('--shard', type=int, default=None,
+              help='Filter only this shard, without writing the whole output.')
 @click.argument('infilestem', type=str)
 @click.argument('outfilestem', type=str)
 @log_elapsed_time()
-def filter_peptide_terms(cutoff, infilestem, outfilestem):
+def filter_peptide_terms(cutoff, workers, shard, infilestem, outfilestem):
     '''Removes high-simplicity terms.
 
+    If the input terms are sharded, each shard is filtered separately
+    and written as a shard of the output, as well as to the whole
+    output.  With --shard, only that shard is filtered, and the whole
+    output may be written once all shards are done by
+    gather_peptide_terms.
     '''
     global config_obj
     dir = config_obj.config_dict['summary']['dir']
@@ -306,64 +986,78 @@ def filter_peptide_terms(cutoff, infilestem, outfilestem):
     logger.debug('Input file stem is "%s".', infilestem)
     logger.debug('Output file stem is "%s".', outfilestem)
     logger.info('Minimum simplicity value is %0.2f.', cutoff)
-    #
-    # Read input terms from merged set
-    #
-    infilepath = os.path.join(dir, infilestem+'_terms.tsv')
-    logger.debug('Filtering file "%s".', infilepath)
-    if not os.path.exists(infilepath):
-        logger.error('input file "%s" does not exist.', infilepath)
-        sys.exit(1)
-    term_frame = pd.DataFrame().from_csv(infilepath, sep='\t')
-    n_intersecting_terms = len(term_frame)
-    k = len(term_frame.index[0])
-    logger.info('   %d %d-mer terms initially.', n_intersecting_terms,
-                k)
-    #
-    # drop terms that don't meet cutoff
-    #
-    term_frame.drop(term_frame[term_frame['score'] > cutoff].index,
-                      inplace=True)
-    n_scored_terms = len(term_frame)
-    logger.info('   %s terms passing cutoff, representing',
-                locale.format('%d', n_scored_terms, grouping=True))
-    logger.info('       %.2f%% of %s intersecting terms, and',
-                n_scored_terms * 100. / n_intersecting_terms,
-                locale.format("%d", n_intersecting_terms, grouping=True))
-    logger.info('       %.6f%% of possible %d-mers.',
-                n_scored_terms * 100. / (ALPHABETSIZE ** k), k)
-    #
-    # write frequency and score histograms
-    frequency_and_score_histograms(term_frame['count'],
-                                   term_frame['score'],
-                                   dir,
-                                   outfilestem)
-    #
-    # write terms
-    #
-    term_frame.sort_values(by=['max_count', 'intersections'], inplace=True)
-    term_filepath = os.path.join(dir, outfilestem + '_terms.tsv')
-    logger.debug('Writing merged terms to "%s".', term_filepath)
-    term_frame.to_csv(term_filepath, sep='\t',
-                        float_format='%0.2f')
-    #
-    # calculate histogram of intersections
-    #
-    intersection_histogram(term_frame, dir, outfilestem,
-                           config_obj.config_dict['plot_type'],
-                           max(term_frame['intersections']), k)
+    n_shards = read_shards(dir, infilestem)
+    shards = check_shard(shard, n_shards, infilestem)
+    if n_shards > 1:
+        infilepaths = [os.path.join(dir, shard_stem(infilestem, p, n_shards)+'_terms.tsv')
+                       for p in shards]
+    else:
+        infilepaths = [os.path.join(dir, infilestem+'_terms.tsv')]
+    for infilepath in infilepaths:
+        if not os.path.exists(infilepath):
+            logger.error('input file "%s" does not exist.', infilepath)
+            sys.exit(1)
+    if shard is not None:
+        filter_shard(shard, n_shards, dir, infilestem, outfilestem, cutoff)
+        write_sampling(dir, outfilestem, read_sampling(dir, infilestem))
+        write_shards(dir, outfilestem, n_shards)
+        return
+    if n_shards > 1:
+        #
+        # filter each shard of merged set
+        #
+        logger.info('Filtering %d shards.', n_shards)
+        term_frame = map_shards(filter_shard,
+                                [(p, n_shards, dir, infilestem, outfilestem, cutoff)
+                                 for p in range(n_shards)],
+                                workers)
+        logger.info('%s terms in all shards pass cutoff.',
+                    locale.format('%d', len(term_frame), grouping=True))
+    else:
+        #
+        # Read input terms from merged set
+        #
+        infilepath = infilepaths[0]
+        logger.debug('Filtering file "%s".', infilepath)
+        with stage('read'):
+            term_frame = pd.read_csv(infilepath,
+                                     sep='\t',
+                                     compression=table_compression(infilepath),
+                                     index_col=0,
+                                     keep_default_na=False)
+        count_read(infilepath)
+        term_frame = filter_terms(term_frame, cutoff)
+    write_merged_terms(term_frame, dir, outfilestem,
+                       term_frame['intersections'].max())
+    write_sampling(dir, outfilestem, read_sampling(dir, infilestem))
+    write_shards(dir, outfilestem, n_shards)
 
 
 @cli.command()
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Number of shards to process in parallel.')
+@click.option('--shard', type=int, default=None,
+              help='Merge only this shard, without writing the whole output.')
 @click.argument('filestem', type=str)
 @click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
 @log_elapsed_time()
-def intersect_peptide_terms(filestem, setlist):
+def intersect_peptide_terms(workers, shard, filestem, setlist):
     '''Find intersecting terms from multiple sets.
 
+    :param workers: Number of shards to process in parallel.
+    :param shard: Shard to merge, or None for all.
     :param filestem: input and output filename less '_terms.tsv'
     :param setlist:
     :return:
+
+    Terms of the first set that are found in at least one other set
+    are kept.
+
+    If terms of sets were written in shards, shard p of every set is
+    merged separately and written as shard p of the output, and the
+    shards are concatenated into the whole output.  With --shard, only
+    that shard is merged, so that shards may be merged on different
+    nodes.
     '''
     #
     # get configuration inputs
@@ -382,92 +1076,223 @@ def intersect_peptide_terms(filestem, setlist):
     n_sets = len(setlist)
     logger.info('Joining terms from %d sets:', n_sets)
     #
-    # read and merge the term_lists
+    # check that sets were sampled and sharded alike
+    #
+    dirs = [config_obj.config_dict[calc_set]['dir'] for calc_set in setlist]
+    samplings = [read_sampling(dir, filestem) for dir in dirs]
+    if any([sampling != samplings[0] for sampling in samplings]):
+        logger.error('Terms of sets were not sampled alike; rerun calculate_peptide_terms.')
+        sys.exit(1)
+    sampling = samplings[0] if samplings else None
+    if sampling is not None:
+        logger.info('Terms are minimizers of every %d terms.', sampling['window'])
+    set_shards = [read_shards(dir, filestem) for dir in dirs]
+    if any([n != set_shards[0] for n in set_shards]):
+        logger.error('Terms of sets were not sharded alike; rerun calculate_peptide_terms.')
+        sys.exit(1)
+    n_shards = set_shards[0] if set_shards else 1
+    shards = check_shard(shard, n_shards, filestem)
+    if n_shards > 1:
+        infilenames = [shard_stem(filestem, p, n_shards)+'_terms.tsv'
+                       for p in shards]
+    else:
+        infilenames = [infilename]
+    for dir in dirs:
+        for name in infilenames:
+            infilepath = os.path.join(dir, name)
+            if not os.path.exists(infilepath):
+                logger.error('input file "%s" does not exist.', infilepath)
+                sys.exit(1)
+    if shard is not None:
+        merge_shard(shard, n_shards, dirs, filestem, setlist, outdir)
+        write_sampling(outdir, filestem, sampling)
+        write_shards(outdir, filestem, n_shards)
+        return
+    if n_shards > 1:
+        #
+        # merge each shard of the term lists
+        #
+        logger.info('Merging %d shards.', n_shards)
+        merged_frame = map_shards(merge_shard,
+                                  [(p, n_shards, dirs, filestem, setlist, outdir)
+                                   for p in range(n_shards)],
+                                  workers)
+        logger.info('%s intersecting terms in all shards.',
+                    locale.format('%d', len(merged_frame), grouping=True))
+    else:
+        #
+        # read and merge the term_lists
+        #
+        set_terms = [read_set_terms(os.path.join(dir, infilename)) for dir in dirs]
+        report_size('set_terms', set_terms)
+        merged_frame = merge_set_terms(set_terms, setlist)
+        del set_terms
+    write_merged_terms(merged_frame, outdir, filestem, n_sets)
+    write_sampling(outdir, filestem, sampling)
+    write_shards(outdir, filestem, n_shards)
+
+
+@cli.command()
+@click.argument('filestem', type=str)
+@log_elapsed_time()
+def gather_peptide_terms(filestem):
+    '''Concatenate shards of merged terms into one table.
+
+    :param filestem: Input and output file stem, less '_terms.tsv'.
+    :return:
+
+    Writes the whole table and its histograms from shards written by
+    intersect_peptide_terms --shard or filter_peptide_terms --shard.
+
+    Example:
+        aakbar gather_peptide_terms strep10
+    '''
+    global config_obj
+    dir = config_obj.config_dict['summary']['dir']
+    n_shards = read_shards(dir, filestem)
+    if n_shards == 1:
+        logger.error('Terms "%s" are not sharded.', filestem)
+        sys.exit(1)
+    logger.info('Gathering %d shards of "%s".', n_shards, filestem)
+    term_frame = read_shard_frames(dir, filestem, n_shards)
+    logger.info('%s terms in all shards.',
+                locale.format('%d', len(term_frame), grouping=True))
+    write_merged_terms(term_frame, dir, filestem,
+                       term_frame['intersections'].max())
+
+
+@cli.command()
+@click.option('-k', default=DEFAULT_K, show_default=True, help='Term length')
+@click.option('--cutoff', default=DEFAULT_SIMPLICITY_CUTOFF, show_default=True,
+              help='Minimum simplicity level to unmask.')
+@click.option('--score', default=DEFAULT_MAX_SCORE, show_default=True,
+              help='Maximum simplicity score to keep.')
+@click.option('--intermediates/--no-intermediates', default=False, show_default=True,
+              help='Also write masked FASTA and unfiltered terms.')
+@click.option('--minimizer_window', type=int, default=None,
+              help='Keep only minimizers of every W consecutive terms.')
+@click.argument('infilename', type=str)
+@click.argument('outfilestem', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def build_signatures(k, cutoff, score, intermediates, minimizer_window,
+                     infilename, outfilestem, setlist):
+    '''Mask, count, intersect, and filter terms.
+
+    :param k: Term length.
+    :param cutoff: Minimum simplicity level to unmask.
+    :param score: Maximum simplicity score to keep.
+    :param intermediates: If True, write outputs of intermediate stages.
+    :param minimizer_window: If given, keep only minimizer terms, as by
+                             calculate_peptide_terms --minimizer_window.
+    :param infilename: Name of input FASTA files for every directory in setlist.
+    :param outfilestem: Signature file stem, less '_terms.tsv'.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+
+    Does the work of peptide_simplicity_mask, calculate_peptide_terms,
+    intersect_peptide_terms, and filter_peptide_terms, passing masked
+    sequences and term arrays between stages in memory.  Only the
+    signature terms and their histograms are written to the summary
+    directory, unless --intermediates is given.  Then the masked FASTA
+    (INSTEM_SIMPLICITY-CUTOFF.EXT) and per-set terms
+    (INSTEM_SIMPLICITY-CUTOFF_k-K_terms.tsv) are written in each set
+    directory, and the unfiltered merged terms under the same stem in the
+    summary directory, as by examples/calculate_signatures.sh.  Manifests
+    left in the set directories by peptide_simplicity_mask and
+    calculate_peptide_terms for those stems are removed, so that those
+    commands remake the outputs rather than skip them.
+
+    Example:
+        aakbar build_signatures -k 10 --cutoff 5 --score 0.1 protein.faa strep10 all
+    '''
+    global config_obj
+    user_ctx = get_user_context_obj()
+    if user_ctx['first_n']:
+        logger.info('Only first %d records will be used', user_ctx['first_n'])
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    n_sets = len(setlist)
+    simplicity_obj = user_ctx['simplicity_object']
+    simplicity_obj.set_cutoff(cutoff)
+    simplicity_obj.set_k(k)
+    logger.info('Simplicity function is %s with cutoff of %d.',
+                simplicity_obj.desc, cutoff)
+    logger.info('Term size is %d characters.', k)
+    minimizer_window = check_minimizer_window(minimizer_window, k)
+    sampling = minimizer_sampling(k, minimizer_window)
+    instem, ext = split_fasta_ext(infilename)
+    maskedstem = '%s_%s-%d' % (instem, simplicity_obj.label, cutoff)
+    termstem = '%s_k-%d' % (maskedstem, k)
+    if intermediates:
+        logger.info('Intermediate outputs will use stems "%s" and "%s".',
+                    maskedstem, termstem)
+    outdir = config_obj.config_dict['summary']['dir']
+    if not os.path.exists(outdir) and not os.path.isdir(outdir):
+        logger.info('Making summary directory %s', outdir)
+        os.makedirs(outdir)
+    #
+    # mask and count terms in each set
     #
-    merged_frame = None
-    n_terms_total = 0
+    logger.info('Calculating terms for %d data sets:', n_sets)
+    set_terms = []
     for calc_set in setlist:
         dir = config_obj.config_dict[calc_set]['dir']
         infilepath = os.path.join(dir, infilename)
         if not os.path.exists(infilepath):
-            logger.error('input file "%s" does not exist.', infilepath)
+            logger.error('Input file "%s" does not exist.', infilepath)
             sys.exit(1)
-        working_frame = pd.DataFrame.from_csv(infilepath,
-                                              sep='\t',
-                                              index_col=0)
-        n_terms_set = len(working_frame)
-        n_terms_total += n_terms_set
-        if merged_frame is None:    # first one read
-            merged_frame = pd.DataFrame({'intersections': [1]*n_terms_set,
-                                         'count': working_frame['count'],
-                                         'max_count': working_frame['count'],
-                                         'score': working_frame['score']*working_frame['count']},
-                                        index=working_frame.index,
-                                        columns=('intersections', 'count', 'max_count', 'score')
-                                        )
-        else: # join this frame
-            working_frame.rename(columns={'count':'working_count',
-                                          'score':'working_score'},
-                                 inplace=True)
-            merged_frame = merged_frame.join(working_frame)
-            del working_frame
-            merged_frame = merged_frame.fillna(0)
-            merged_frame['count'] += merged_frame['working_count']
-            merged_frame['max_count'] = merged_frame[['max_count','working_count']].max(axis=1)
-            merged_frame['score'] += merged_frame['working_score']* merged_frame['working_count']
-            merged_frame['intersections'] += (merged_frame['working_count'] > 0).astype(np.int)
-            del merged_frame['working_count']
-            del merged_frame['working_score']
-        n_unique_terms = len(merged_frame)
-        logger.info('   %s: %s terms in (%.0f%% of %s unique, %.0f%% of %s total read)',
-                    calc_set,
-                    locale.format("%d", n_terms_set, grouping=True),
-                    100.*n_terms_set/n_unique_terms,
-                    locale.format("%d", n_unique_terms, grouping=True),
-                    100.*n_terms_set/n_terms_total,
-                    locale.format('%d', n_terms_total, grouping=True))
-    k = len(merged_frame.index[0])
-    logger.info('%s unique %d-mers (%0.1f%% of %s total in).',
-                locale.format("%d", n_unique_terms, grouping=True),
-                k,
-                100.*n_unique_terms/n_terms_total,
-                locale.format('%d', n_terms_total, grouping=True))
-    #
-    # drop terms that don't intersect in two sets
-    #
-    merged_frame.drop(merged_frame[merged_frame['intersections'] == 1].index,
-                      inplace=True)
-    n_intersecting_terms = len(merged_frame)
-    logger.info('%s intersecting terms (%.1f%% of unique).',
-                locale.format('%d', n_intersecting_terms, grouping=True),
-                100.*n_intersecting_terms/n_unique_terms)
-    #
-    # clean up and normazlize
-    #
-    merged_frame['count'] = merged_frame['count'].astype(np.int32)
-    merged_frame['max_count'] = merged_frame['max_count'].astype(np.int32)
-    merged_frame['score'] = merged_frame['score']/merged_frame['count']
-    #
-    # calculate frequency and score histograms
-    #
-    frequency_and_score_histograms(merged_frame['count'],
-                                   merged_frame['score'],
-                                   outdir,
-                                   filestem)
+        fasta = open_fasta(infilepath)
+        keys = fasta_keys(fasta, user_ctx['first_n'])
+        n_recs = n_fasta_keys(keys)
+        if intermediates:
+            remove_manifest(dir, maskedstem)
+            remove_manifest(dir, termstem)
+            maskedpath = os.path.join(dir, maskedstem + ext)
+            logger.debug('Writing masked sequences to "%s".', maskedpath)
+            maskedfh = open_output(maskedpath)
+        else:
+            maskedfh = None
+        if user_ctx['progress']:
+            with click.progressbar(keys, label='   %s genes processed' %calc_set,
+                                   length=n_recs) as bar:
+                (unique_terms, freqs, mean_scores), = count_set_terms(
+                    masked_sequences(fasta, bar, simplicity_obj, fh=maskedfh),
+                    [k], simplicity_obj, minimizer_window=minimizer_window)
+        else:
+            logger.info('  %s: ', calc_set)
+            (unique_terms, freqs, mean_scores), = count_set_terms(
+                masked_sequences(fasta, keys, simplicity_obj, fh=maskedfh),
+                [k], simplicity_obj, minimizer_window=minimizer_window)
+        fasta.close()
+        count_read(infilepath)
+        if intermediates:
+            maskedfh.close()
+            count_written(maskedpath)
+            write_set_terms(unique_terms, freqs, mean_scores, dir, termstem)
+            write_sampling(dir, termstem, sampling)
+            write_shards(dir, termstem, 1)
+        set_terms.append((unique_terms, freqs, mean_scores))
+    report_size('set_terms', set_terms)
     #
-    # write terms
+    # intersect across sets
     #
-    merged_frame.sort_values(by=['max_count', 'intersections'], inplace=True)
-    term_filepath = os.path.join(outdir, filestem+'_terms.tsv')
-    logger.debug('Writing merged terms to "%s".', term_filepath)
-    merged_frame.to_csv(term_filepath, sep='\t',
-                        float_format='%0.2f')
+    logger.info('Joining terms from %d sets:', n_sets)
+    merged_frame = merge_set_terms(set_terms, setlist)
+    del set_terms
+    if intermediates:
+        write_merged_terms(merged_frame, outdir, termstem, n_sets)
+        write_sampling(outdir, termstem, sampling)
+        write_shards(outdir, termstem, 1)
     #
-    # calculate histogram of intersections
+    # filter on simplicity score
     #
-    intersection_histogram(merged_frame, outdir, filestem,
-                           config_obj.config_dict['plot_type'],
-                           n_sets, k)
+    logger.info('Minimum simplicity value is %0.2f.', score)
+    term_frame = filter_terms(merged_frame, score)
+    del merged_frame
+    write_merged_terms(term_frame, outdir, outfilestem,
+                       term_frame['intersections'].max())
+    write_sampling(outdir, outfilestem, sampling)
+    write_shards(outdir, outfilestem, 1)
 
 
 @cli.command()
@@ -488,6 +1313,9 @@ def peptide_simplicity_mask(cutoff, plot, infilename, outfilestem, setlist):
 
     Note that this calculation is single-threaded and may be time-consuming, so
     starting multiple processes may be a good idea.
+
+    Sets whose outputs were made from the same input and options are
+    skipped, unless the global --rebuild option is given.
     '''
     global config_obj
     user_ctx = get_user_context_obj()
@@ -497,7 +1325,7 @@ def peptide_simplicity_mask(cutoff, plot, infilename, outfilestem, setlist):
     logger.info('Simplicity function is %s with cutoff of %d.',
                 simplicity_obj.desc, cutoff)
     logger.debug('Reading from FASTA file "%s".', infilename)
-    instem, ext = os.path.splitext(infilename)
+    instem, ext = split_fasta_ext(infilename)
     outfilename = outfilestem + ext
     logger.debug('Output FASTA file name is "%s".', outfilename)
     histfilename = outfilestem + '-hist.tsv'
@@ -505,30 +1333,39 @@ def peptide_simplicity_mask(cutoff, plot, infilename, outfilestem, setlist):
     if plot:
         plotname = outfilestem + '.' + config_obj.config_dict['plot_type']
         logger.debug('Plot to file "%s".', plotname)
+    params = simplicity_params(simplicity_obj)
+    params['first_n'] = user_ctx['first_n']
     for calc_set in setlist:
         dir = config_obj.config_dict[calc_set]['dir']
         inpath = os.path.join(dir, infilename)
         outpath = os.path.join(dir, outfilename)
-        shutil.copy(inpath, outpath)
-        fasta  = pyfaidx.Fasta(outpath, mutable=True)
-        percent_masked_list = []
-        if user_ctx['first_n']:
-            keys = list(fasta.keys())[:user_ctx['first_n']]
-        else:
-            keys = fasta.keys()
-        if user_ctx['progress']:
-            with click.progressbar(keys, label='%s genes processed' %calc_set,
-                                   length=len(keys)) as bar:
-                for key in bar:
-                    masked_gene = simplicity_obj.mask(fasta[key])
-                    percent_masked = 100.*num_masked(masked_gene)/len(masked_gene)
-                    percent_masked_list.append(percent_masked)
-        else:
-            for key in keys:
-                masked_gene = simplicity_obj.mask(fasta[key])
-                percent_masked = 100.*num_masked(masked_gene)/len(masked_gene)
-                percent_masked_list.append(percent_masked)
+        outputs = [outpath, os.path.join(dir, histfilename)]
+        if plot:
+            outputs.append(plot_spec_path(os.path.join(dir, plotname)))
+        manifest = OutputManifest(manifest_path(dir, outfilestem),
+                                  [inpath],
+                                  params,
+                                  outputs)
+        if manifest.is_up_to_date():
+            logger.info('   %s is up to date, skipping.', calc_set)
+            continue
+        manifest.invalidate()
+        fasta = open_fasta(inpath)
+        keys = fasta_keys(fasta, user_ctx['first_n'])
+        with open_output(outpath) as outfh:
+            if user_ctx['progress']:
+                with click.progressbar(keys, label='%s genes processed' %calc_set,
+                                       length=n_fasta_keys(keys)) as bar:
+                    percent_masked_list = [100.*num_masked(masked_gene)/len(masked_gene)
+                                           for masked_gene in masked_sequences(
+                                               fasta, bar, simplicity_obj, fh=outfh)]
+            else:
+                percent_masked_list = [100.*num_masked(masked_gene)/len(masked_gene)
+                                       for masked_gene in masked_sequences(
+                                           fasta, keys, simplicity_obj, fh=outfh)]
         fasta.close()
+        count_read(inpath)
+        count_written(outpath)
         #
         # histogram masked regions
         #
@@ -537,21 +1374,21 @@ def peptide_simplicity_mask(cutoff, plot, infilename, outfilestem, setlist):
         hist = hist*100./len(percent_masked_list)
         hist_filepath = os.path.join(dir, histfilename)
         logger.debug('writing histogram to file "%s".', hist_filepath)
-        pd.Series(hist, index=bin_centers).to_csv(hist_filepath, sep='\t',
-                                                  float_format='%.3f')
+        with stage('write'), open_output(hist_filepath) as fh:
+            pd.Series(hist, index=bin_centers).to_csv(fh, sep='\t',
+                                                      float_format='%.3f')
+        count_written(hist_filepath)
         #
         # plot histogram, if requested
         #
         if plot:
             plotpath = os.path.join(dir, plotname)
-            fig = plt.figure()
-            ax = fig.add_subplot(111)
-            ax.plot(bin_centers, hist)
-            plt.title('Peptide %s Simplicity Distribution with Cutoff %d'%(simplicity_obj.label.capitalize()
-                                                                           ,cutoff))
-            plt.xlabel('Percent of Peptide Sequence Masked')
-            plt.ylabel('Percent of Peptide Sequences')
-            plt.savefig(plotpath)
+            plot_lines(plotpath, [{'x': bin_centers, 'y': hist}],
+                       'Peptide %s Simplicity Distribution with Cutoff %d'%(simplicity_obj.label.capitalize()
+                                                                            ,cutoff),
+                       'Percent of Peptide Sequence Masked',
+                       'Percent of Peptide Sequences')
+        manifest.write()
 
 @cli.command()
 @click.option('--force/--no-force', default=False, help='Force copy into non-empty directory.')
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+'''Binary hit tables for signature searches.
+
+A hit table is a directory holding one raw binary file per column
+(signature index, gene index, position, and frame), appended in chunks
+as hits are found, plus tab-separated key dictionaries for signatures
+and genes and a small YAML metadata file.  Columns may be loaded with
+a single memory map each via load_hit_table().
+'''
+
+# standard library imports
+import os
+import csv
+
+# external packages
+import numpy as np
+import pandas as pd
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .compression import open_output, split_fasta_ext
+
+#
+# Global constants
+#
+HIT_TABLE_VERSION = 1
+HIT_COLUMNS = (('signature', np.uint32),
+               ('gene', np.uint32),
+               ('position', np.uint32),
+               ('frame', np.uint8))
+MISMATCH_COLUMN = ('mismatches', np.uint8)
+DEFAULT_HIT_CHUNK = 1 << 20 # hits buffered before appending to disk
+SIGLIST_FIELDS = ['signature',
+                  'key',
+                  'length',
+                  'position',
+                  'intersections',
+                  'max_count',
+                  'frame']
+
+#
+# Helper functions begin here.
+#
+def hit_table_dir(dir, filestem):
+    '''Return the path of the hit table directory for a file stem.
+
+    :param dir: Set directory.
+    :param filestem: Output file stem.
+    :return: Path of hit table directory.
+    '''
+    return os.path.join(dir, filestem + '_hits')
+
+
+def load_hit_table(dirpath):
+    '''Memory-map a hit table.
+
+    :param dirpath: Hit table directory.
+    :return: Tuple of (meta dictionary, dictionary of column arrays,
+             signature frame, gene frame).
+    '''
+    with open(os.path.join(dirpath, 'meta.yaml'), 'rt') as f:
+        meta = yaml.safe_load(f)
+    n_hits = meta['n_hits']
+    columns = {}
+    for name, dtype in meta['columns']:
+        colpath = os.path.join(dirpath, name + '.bin')
+        if n_hits == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(colpath, dtype=dtype, mode='r',
+                                      shape=(n_hits,))
+    sig_frame = pd.read_csv(os.path.join(dirpath, 'signatures.tsv'),
+                            sep='\t', index_col=0,
+                            keep_default_na=False)
+    gene_frame = pd.read_csv(os.path.join(dirpath, 'genes.tsv'),
+                             sep='\t', index_col=0,
+                             keep_default_na=False,
+                             dtype={'key': str})
+    return meta, columns, sig_frame, gene_frame
+
+#
+# Classes begin here.
+#
+class HitTableWriter(object):
+    '''Append signature hits to a columnar binary hit table.
+    '''
+    def __init__(self, dirpath, chunk_size=DEFAULT_HIT_CHUNK, mismatches=False):
+        self.dirpath = dirpath
+        self.chunk_size = chunk_size
+        self.columns = list(HIT_COLUMNS)
+        if mismatches:
+            self.columns.append(MISMATCH_COLUMN)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        self.column_fhs = {}
+        self.buffers = {}
+        for name, dtype in self.columns:
+            self.column_fhs[name] = open(os.path.join(dirpath, name + '.bin'), 'wb')
+            self.buffers[name] = []
+        self.n_buffered = 0
+        self.n_hits = 0
+        self.n_genes = 0
+        self.genefh = open(os.path.join(dirpath, 'genes.tsv'), 'wt')
+        self.genewriter = csv.writer(self.genefh, delimiter='\t',
+                                     lineterminator='\n')
+        self.genewriter.writerow(['gene', 'key', 'length'])
+
+
+    def add_gene(self, key, length):
+        '''Add a gene to the key dictionary.
+
+        :param key: Sequence key.
+        :param length: Sequence length.
+        :return: Index of gene.
+        '''
+        gene_index = self.n_genes
+        self.genewriter.writerow([gene_index, key, length])
+        self.n_genes += 1
+        return gene_index
+
+
+    def add_hits(self, sig_index, gene_index, positions, frame, mismatches=0):
+        '''Buffer hits in one frame of one gene.
+
+        :param sig_index: Index of signature in key dictionary, or array
+                          of indexes parallel to positions.
+        :param gene_index: Index of gene in key dictionary.
+        :param positions: Array of hit positions.
+        :param frame: Frame number.
+        :param mismatches: Number of substitutions, if column is written.
+        :return: None
+        '''
+        n = len(positions)
+        if n == 0:
+            return
+        buffers = self.buffers
+        buffers['signature'].append(np.array(np.broadcast_to(sig_index, (n,)),
+                                             dtype=np.uint32))
+        buffers['gene'].append(np.full(n, gene_index, dtype=np.uint32))
+        buffers['position'].append(np.asarray(positions, dtype=np.uint32))
+        buffers['frame'].append(np.full(n, frame, dtype=np.uint8))
+        if 'mismatches' in buffers:
+            buffers['mismatches'].append(np.full(n, mismatches, dtype=np.uint8))
+        self.n_buffered += n
+        if self.n_buffered >= self.chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        '''Append buffered hits to column files.
+        '''
+        if self.n_buffered == 0:
+            return
+        for name, dtype in self.columns:
+            np.concatenate(self.buffers[name]).astype(dtype,
+                                                      copy=False).tofile(self.column_fhs[name])
+            self.buffers[name] = []
+        self.n_hits += self.n_buffered
+        self.n_buffered = 0
+
+
+    def close(self, signatures, intersections, max_counts, k):
+        '''Flush hits and write signature dictionary and metadata.
+
+        :param signatures: Array of signatures, in index order.
+        :param intersections: Array of intersections, in index order.
+        :param max_counts: Array of maximum counts, in index order.
+        :param k: Signature length.
+        :return: None
+        '''
+        self.flush()
+        for fh in self.column_fhs.values():
+            fh.close()
+        self.genefh.close()
+        with open(os.path.join(self.dirpath, 'signatures.tsv'), 'wt') as sigfh:
+            sigwriter = csv.writer(sigfh, delimiter='\t', lineterminator='\n')
+            sigwriter.writerow(['index', 'signature', 'intersections', 'max_count'])
+            for i in range(len(signatures)):
+                sigwriter.writerow([i,
+                                    to_str(signatures[i]),
+                                    intersections[i],
+                                    max_counts[i]])
+        meta = {'version': HIT_TABLE_VERSION,
+                'k': int(k),
+                'n_hits': int(self.n_hits),
+                'n_genes': int(self.n_genes),
+                'n_signatures': len(signatures),
+                'columns': [[name, np.dtype(dtype).name] for name, dtype in self.columns]}
+        with open(os.path.join(self.dirpath, 'meta.yaml'), 'wt') as f:
+            yaml.dump(meta, f)
+        logger.debug('Wrote %d hits in %d genes to hit table "%s".',
+                     self.n_hits, self.n_genes, self.dirpath)
+
+
+def write_siglist_from_hit_table(dirpath, siglistpath, chunk_size=DEFAULT_HIT_CHUNK):
+    '''Write a hit table in the tab-separated siglist layout.
+
+    :param dirpath: Hit table directory.
+    :param siglistpath: Output siglist path.
+    :param chunk_size: Number of hits converted at a time.
+    :return: Number of hits written.
+    '''
+    meta, columns, sig_frame, gene_frame = load_hit_table(dirpath)
+    mismatches = 'mismatches' in columns
+    signatures = sig_frame['signature'].values.astype(str)
+    intersections = sig_frame['intersections'].values
+    max_counts = sig_frame['max_count'].values
+    keys = gene_frame['key'].values.astype(str)
+    lengths = gene_frame['length'].values
+    n_hits = meta['n_hits']
+    fields = SIGLIST_FIELDS[:]
+    row_format = '%s\t%s\t%d\t%d\t%d\t%d\t%d'
+    if mismatches:
+        fields.append('mismatches')
+        row_format += '\t%d'
+    row_format += '\n'
+    with open_output(siglistpath) as fh:
+        fh.write('\t'.join(fields) + '\n')
+        for start in range(0, n_hits, chunk_size):
+            end = min(start + chunk_size, n_hits)
+            sig_index = np.asarray(columns['signature'][start:end], dtype=np.intp)
+            gene_index = np.asarray(columns['gene'][start:end], dtype=np.intp)
+            row_columns = [signatures[sig_index],
+                           keys[gene_index],
+                           lengths[gene_index],
+                           columns['position'][start:end],
+                           intersections[sig_index],
+                           max_counts[sig_index],
+                           columns['frame'][start:end]]
+            if mismatches:
+                row_columns.append(columns['mismatches'][start:end])
+            fh.writelines([row_format % row for row in zip(*row_columns)])
+    return n_hits
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.argument('infilename', type=str)
+@click.argument('filestem', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def convert_hit_table(infilename, filestem, setlist):
+    '''Convert binary hit tables to siglist TSV.
+
+    :param infilename: Name of FASTA file that was searched.
+    :param filestem: Signature file stem used in search.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+    '''
+    global config_obj
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    outfilestem = split_fasta_ext(infilename)[0]+'-'+filestem
+    logger.info('Converting hit tables for %d data sets:', len(setlist))
+    for calc_set in setlist:
+        dir = config_obj.config_dict[calc_set]['dir']
+        hitdir = hit_table_dir(dir, outfilestem)
+        if not os.path.isdir(hitdir):
+            logger.error('Hit table "%s" does not exist.', hitdir)
+            sys.exit(1)
+        siglistpath = os.path.join(dir, outfilestem + '_siglist.tsv')
+        logger.debug('Writing siglist file "%s".', siglistpath)
+        n_hits = write_siglist_from_hit_table(hitdir, siglistpath)
+        logger.info('   %s: %d hits.', calc_set, n_hits)
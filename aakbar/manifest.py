@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+'''Manifests of the inputs and parameters from which outputs were made.
+
+A manifest is written next to the outputs of a command for one set.  It
+holds a fingerprint of each input file (size, modification time, and
+SHA-256 of the contents) and the parameters that affect the outputs.
+The size and modification time of each output are recorded as well.
+When a command is rerun, sets whose manifest matches the current inputs
+and parameters, and whose outputs are unchanged since the manifest was
+written, are skipped.
+
+Inputs whose size and modification time are unchanged are not rehashed.
+'''
+
+# standard library imports
+import os
+import hashlib
+
+# module imports
+from .common import *
+from . import get_user_context_obj, logger
+from .metrics import path_size
+
+#
+# Global constants
+#
+MANIFEST_VERSION = 2
+MANIFEST_SUFFIX = '_manifest.yaml'
+HASH_BLOCK_SIZE = 1 << 20
+
+#
+# Helper functions begin here.
+#
+def manifest_path(dir, outfilestem):
+    '''Return the path of the manifest for outputs with a file stem.
+
+    :param dir: Output directory.
+    :param outfilestem: Output file stem.
+    :return: Path of manifest.
+    '''
+    return os.path.join(dir, outfilestem + MANIFEST_SUFFIX)
+
+
+def remove_manifest(dir, outfilestem):
+    '''Remove the manifest for outputs with a file stem, if one exists.
+
+    Used when outputs are overwritten by a command that does not write
+    manifests of its own, so the next run of the command that does will
+    not skip them.
+
+    :param dir: Output directory.
+    :param outfilestem: Output file stem.
+    '''
+    path = manifest_path(dir, outfilestem)
+    if os.path.exists(path):
+        logger.debug('Removing manifest "%s".', path)
+        os.remove(path)
+
+
+def file_hash(path):
+    '''Compute the SHA-256 of a file's contents.
+
+    :param path: File path.
+    :return: Hex digest.
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_fingerprint(path, previous=None):
+    '''Fingerprint a file, reusing a previous hash if size and mtime match.
+
+    :param path: File path.
+    :param previous: Optional previous fingerprint of the same path.
+    :return: Dictionary of path, size, mtime, and sha256.
+    '''
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path),
+                   'size': stat.st_size,
+                   'mtime': stat.st_mtime}
+    if (previous is not None and
+            previous['size'] == stat.st_size and
+            previous['mtime'] == stat.st_mtime):
+        fingerprint['sha256'] = previous['sha256']
+    else:
+        fingerprint['sha256'] = file_hash(path)
+    return fingerprint
+
+
+def output_fingerprint(path):
+    '''Fingerprint an output by size and modification time.
+
+    Directories are fingerprinted by the total size of their files and
+    the newest modification time of the directory or any file in it.
+
+    :param path: File or directory path.
+    :return: Dictionary of path, size, and mtime, or None if path does not exist.
+    '''
+    if not os.path.exists(path):
+        return None
+    mtime = os.stat(path).st_mtime
+    if os.path.isdir(path):
+        mtime = max([mtime] +
+                    [os.stat(os.path.join(dirpath, name)).st_mtime
+                     for dirpath, dirnames, filenames in os.walk(path)
+                     for name in dirnames + filenames])
+    return {'path': os.path.basename(path),
+            'size': path_size(path),
+            'mtime': mtime}
+
+
+def simplicity_params(simplicity_obj):
+    '''Parameters of a simplicity object that affect outputs.
+
+    :param simplicity_obj: Simplicity object.
+    :return: Dictionary of label, cutoff, and window.
+    '''
+    return {'simplicity': simplicity_obj.label,
+            'cutoff': simplicity_obj.cutoff,
+            'window': getattr(simplicity_obj, 'window_size', None)}
+
+#
+# Classes begin here.
+#
+class OutputManifest(object):
+    '''Inputs, parameters, and outputs of one command on one set.
+
+    :param path: Path of manifest file.
+    :param inputs: List of input file paths.
+    :param params: Dictionary of parameters that affect the outputs.
+    :param outputs: List of output paths, files or directories.
+    '''
+    def __init__(self, path, inputs, params, outputs):
+        self.path = path
+        self.inputs = [os.path.abspath(input) for input in inputs]
+        self.params = params
+        self.outputs = outputs
+        self.fingerprints = None
+        self._previous = None
+        if os.path.exists(path):
+            with open(path, 'rt') as f:
+                self._previous = yaml.safe_load(f)
+
+
+    def _fingerprint_inputs(self):
+        if self.fingerprints is None:
+            previous = {}
+            if self._previous is not None:
+                previous = dict([(fingerprint['path'], fingerprint)
+                                 for fingerprint in self._previous['inputs']])
+            self.fingerprints = [file_fingerprint(input, previous.get(input))
+                                 for input in self.inputs]
+        return self.fingerprints
+
+
+    def is_up_to_date(self):
+        '''Check whether outputs were made from the current inputs and parameters.
+
+        Always False if the global --rebuild option was given.
+
+        :return: True if the outputs need not be remade.
+        '''
+        user_ctx = get_user_context_obj()
+        if user_ctx is not None and user_ctx.get('rebuild', False):
+            return False
+        if self._previous is None or self._previous.get('version') != MANIFEST_VERSION:
+            return False
+        if self._previous['params'] != self.params:
+            logger.debug('Parameters changed since "%s" was written.', self.path)
+            return False
+        if not all([os.path.exists(output) for output in self.outputs]):
+            logger.debug('Outputs listed in "%s" are missing.', self.path)
+            return False
+        if [output_fingerprint(output) for output in self.outputs] != \
+                self._previous['outputs']:
+            logger.debug('Outputs changed since "%s" was written.', self.path)
+            return False
+        if [fingerprint['path'] for fingerprint in self._previous['inputs']] != self.inputs:
+            return False
+        if [fingerprint['sha256'] for fingerprint in self._fingerprint_inputs()] != \
+                [fingerprint['sha256'] for fingerprint in self._previous['inputs']]:
+            logger.debug('Inputs changed since "%s" was written.', self.path)
+            return False
+        return True
+
+
+    def invalidate(self):
+        '''Remove the manifest before outputs are remade.
+
+        Fingerprints of inputs are taken first, so that changes to inputs
+        while outputs are being made are detected on the next run.
+        '''
+        self._fingerprint_inputs()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+    def write(self):
+        '''Write the manifest after outputs are complete.
+        '''
+        manifest = {'version': MANIFEST_VERSION,
+                    'params': self.params,
+                    'inputs': self._fingerprint_inputs(),
+                    'outputs': [output_fingerprint(output) for output in self.outputs]}
+        logger.debug('Writing manifest "%s".', self.path)
+        with open(self.path, 'wt') as f:
+            yaml.dump(manifest, f)
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+'''Per-stage timers and throughput counters of a run.
+
+Commands time named stages (reading, masking, k-mer extraction, sorting,
+writing, plotting, and so on) and count records, residues, k-mers, hits,
+and bytes read and written.  At the end of a command the totals are
+written as JSON next to the log file in ./logs/, and summarized in the
+log at debug level.
+
+Stages are timed by wall clock, and a stage may be entered many times,
+so that per-record work accumulates into one total.  Stages should not
+be nested, so that their times add up to no more than the elapsed time.
+
+Resident memory is sampled by a background thread, giving a high-water
+mark for the run and for each stage that was active when sampled.  If a
+memory limit is set, the run is interrupted once resident memory goes
+over it, rather than letting the process be killed for lack of memory.
+Sizes of the major arrays and frames are recorded with report_size.
+'''
+
+# standard library imports
+import os
+import json
+import time
+import threading
+import contextlib
+import _thread
+from collections import OrderedDict
+
+# module imports
+from .common import *
+
+#
+# Global constants
+#
+METRICS_VERSION = 1
+METRICS_SUFFIX = '-metrics.json'
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+MEMORY_SAMPLE_INTERVAL = 0.05 # seconds
+MEMORY_UNITS = {'': 1,
+                'K': 1 << 10,
+                'M': 1 << 20,
+                'G': 1 << 30,
+                'T': 1 << 40}
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError):
+    PAGE_SIZE = 4096
+
+#
+# Helper functions begin here.
+#
+def current_rss():
+    '''Resident memory of this process.
+
+    Read from /proc/self/statm where it exists, else the peak
+    resident memory from getrusage is returned.
+
+    :return: Bytes.
+    '''
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1])*PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin': # bytes, not kB
+            return maxrss
+        return maxrss*1024
+
+
+def format_bytes(n_bytes):
+    '''Format a size in bytes for logging.
+
+    :param n_bytes: Size in bytes.
+    :return: String in KiB, MiB, or GiB.
+    '''
+    if n_bytes >= MEMORY_UNITS['G']:
+        return '%.2f GiB' % (n_bytes/MEMORY_UNITS['G'])
+    elif n_bytes >= MEMORY_UNITS['M']:
+        return '%.1f MiB' % (n_bytes/MEMORY_UNITS['M'])
+    return '%.1f KiB' % (n_bytes/MEMORY_UNITS['K'])
+
+
+def object_size(obj):
+    '''Bytes used by an array or frame.
+
+    :param obj: Numpy array, pandas frame or series, or sequence of these.
+    :return: Size in bytes.
+    '''
+    if hasattr(obj, 'memory_usage'): # pandas
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if hasattr(obj, 'nbytes'): # numpy
+        return int(obj.nbytes)
+    if isinstance(obj, (list, tuple)):
+        return sum([object_size(item) for item in obj])
+    return sys.getsizeof(obj)
+
+#
+# Classes begin here.
+#
+class MemorySizeType(click.ParamType):
+    '''Memory size in bytes, with optional K, M, G, or T suffix.
+    '''
+    name = 'size'
+
+    def convert(self, value, param, ctx):
+        if value is None or isinstance(value, int):
+            return value
+        text = value.strip().upper()
+        if text.endswith('B'):
+            text = text[:-1]
+        unit = ''
+        if text and text[-1] in MEMORY_UNITS:
+            unit = text[-1]
+            text = text[:-1]
+        try:
+            return int(float(text)*MEMORY_UNITS[unit])
+        except ValueError:
+            self.fail('"%s" is not a memory size such as 8G or 512M.' % value,
+                      param, ctx)
+
+MEMORY_SIZE = MemorySizeType()
+
+
+class MemorySampler(threading.Thread):
+    '''Sample resident memory, tracking high-water marks.
+
+    :param metrics: RunMetrics object to update.
+    :param max_memory: If not None, interrupt the run when resident
+                       memory exceeds this many bytes.
+    :param interval: Seconds between samples.
+    '''
+    def __init__(self, metrics, max_memory=None, interval=MEMORY_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name='memory-sampler', daemon=True)
+        self.metrics = metrics
+        self.max_memory = max_memory
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = self.metrics.sample_memory()
+            if self.max_memory is not None and rss > self.max_memory:
+                self.metrics.memory_exceeded(rss, self.max_memory)
+                _thread.interrupt_main()
+                return
+
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class RunMetrics(object):
+    '''Stage timers and counters of one command.
+
+    :param command: Name of command, if any.
+    '''
+    def __init__(self, command=None):
+        self.command = command
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.object_sizes = OrderedDict()
+        self.peak_rss = current_rss()
+        self._active_stages = []
+        self._sampler = None
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Context manager adding the time spent in a block to a stage.
+
+        :param name: Stage name.
+        '''
+        stage = self.stages.setdefault(name, {'seconds': 0.,
+                                              'calls': 0,
+                                              'peak_rss': 0})
+        self._active_stages.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            # short stages may be missed by the sampler
+            if stage['peak_rss'] == 0 or seconds >= MEMORY_SAMPLE_INTERVAL:
+                self.sample_memory()
+            self._active_stages.pop()
+
+
+    def count(self, name, n=1):
+        '''Add to a counter.
+
+        :param name: Counter name.
+        :param n: Amount to add.
+        '''
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+
+    def sample_memory(self):
+        '''Sample resident memory, updating high-water marks.
+
+        :return: Resident memory in bytes.
+        '''
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        try: # stages are entered and left by the main thread
+            stage = self.stages[self._active_stages[-1]]
+        except IndexError:
+            return rss
+        stage['peak_rss'] = max(stage['peak_rss'], rss)
+        return rss
+
+
+    def start_sampler(self, max_memory=None):
+        '''Start sampling memory in the background.
+
+        :param max_memory: If not None, memory limit in bytes.
+        '''
+        self._sampler = MemorySampler(self, max_memory=max_memory)
+        self._sampler.start()
+
+
+    def stop_sampler(self):
+        '''Stop sampling memory.
+        '''
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+
+
+    def memory_exceeded(self, rss, max_memory):
+        '''Log that resident memory went over the limit.
+
+        :param rss: Resident memory in bytes.
+        :param max_memory: Limit in bytes.
+        '''
+        try:
+            stage = self._active_stages[-1]
+        except IndexError:
+            stage = None
+        logger.error('Memory use of %s exceeds --max_memory of %s%s; stopping.',
+                     format_bytes(rss), format_bytes(max_memory),
+                     ' in stage "%s"' % stage if stage else '')
+        largest = sorted(self.object_sizes.items(), key=lambda item: -item[1])[:3]
+        if largest:
+            logger.error('Largest arrays were %s.',
+                         ', '.join(['%s (%s)' % (name, format_bytes(size))
+                                    for name, size in largest]))
+        logger.error('Use --first_n, fewer sets, or a larger limit.')
+        self.counters['memory_exceeded'] = 1
+
+
+    def report_size(self, name, obj):
+        '''Record and log the bytes used by an array or frame.
+
+        The largest size seen under each name is kept.
+
+        :param name: Name of array or frame.
+        :param obj: Array, frame, or sequence of these.
+        :return: Size in bytes.
+        '''
+        size = object_size(obj)
+        self.object_sizes[name] = max(self.object_sizes.get(name, 0), size)
+        logger.debug('%s uses %s.', name, format_bytes(size))
+        return size
+
+
+    def elapsed(self):
+        '''Wall time since the metrics were started.
+
+        :return: Seconds.
+        '''
+        return time.perf_counter() - self._start
+
+
+    def as_dict(self):
+        '''Metrics as a JSON-serializable dictionary.
+
+        Rates are counters divided by elapsed time.
+
+        :return: Dictionary.
+        '''
+        elapsed = self.elapsed()
+        return OrderedDict([
+            ('version', METRICS_VERSION),
+            ('program', PROGRAM_NAME),
+            ('program_version', VERSION),
+            ('command', self.command),
+            ('argv', sys.argv),
+            ('started', self.started.isoformat()),
+            ('elapsed_seconds', elapsed),
+            ('peak_rss', self.peak_rss),
+            ('stages', self.stages),
+            ('object_sizes', self.object_sizes),
+            ('counters', self.counters),
+            ('rates_per_second', OrderedDict([(name, value/elapsed if elapsed else None)
+                                              for name, value in self.counters.items()]))])
+
+
+    def write(self, path):
+        '''Write metrics as JSON and summarize them in the log.
+
+        :param path: Output path.
+        '''
+        self.sample_memory()
+        metrics = self.as_dict()
+        for name, stage in self.stages.items():
+            logger.debug('Stage %s took %.3f s in %d calls, peak memory %s.',
+                         name, stage['seconds'], stage['calls'],
+                         format_bytes(stage['peak_rss']))
+        logger.debug('Peak memory use was %s.', format_bytes(self.peak_rss))
+        for name, value in self.counters.items():
+            logger.debug('Counted %d %s.', value, name)
+        logger.debug('Writing metrics to "%s".', path)
+        with open(path, 'wt') as f:
+            json.dump(metrics, f, indent=2)
+
+#
+# Metrics of the current run begin here.
+#
+_run_metrics = RunMetrics()
+
+def start_metrics(command=None, sample_memory=False, max_memory=None):
+    '''Start new metrics, discarding any previous ones.
+
+    :param command: Name of command.
+    :param sample_memory: If True, sample memory in the background.
+    :param max_memory: If not None, memory limit in bytes.
+    :return: RunMetrics object.
+    '''
+    global _run_metrics
+    _run_metrics.stop_sampler()
+    _run_metrics = RunMetrics(command)
+    if sample_memory or max_memory is not None:
+        _run_metrics.start_sampler(max_memory=max_memory)
+    return _run_metrics
+
+
+def get_metrics():
+    '''Return the current metrics.
+
+    :return: RunMetrics object.
+    '''
+    return _run_metrics
+
+
+def metrics_path(logfile_path):
+    '''Return the path of the metrics file written next to a log file.
+
+    :param logfile_path: Path of log file.
+    :return: Path of metrics file.
+    '''
+    return os.path.splitext(str(logfile_path))[0] + METRICS_SUFFIX
+
+
+def stage(name):
+    '''Time a block as a stage of the current metrics.
+
+    :param name: Stage name.
+    :return: Context manager.
+    '''
+    return _run_metrics.stage(name)
+
+
+def count(name, n=1):
+    '''Add to a counter of the current metrics.
+
+    :param name: Counter name.
+    :param n: Amount to add.
+    :return: None
+    '''
+    _run_metrics.count(name, n)
+
+
+def report_size(name, obj):
+    '''Record and log the bytes used by an array or frame.
+
+    :param name: Name of array or frame.
+    :param obj: Array, frame, or sequence of these.
+    :return: Size in bytes.
+    '''
+    return _run_metrics.report_size(name, obj)
+
+
+def path_size(path):
+    '''Size of a file, or total size of the files in a directory.
+
+    :param path: File or directory path.
+    :return: Size in bytes, zero if path does not exist.
+    '''
+    if os.path.isdir(path):
+        return sum([os.path.getsize(os.path.join(dirpath, filename))
+                    for dirpath, dirnames, filenames in os.walk(path)
+                    for filename in filenames])
+    elif os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+def count_read(path):
+    '''Count the size of an input file as bytes read.
+
+    :param path: File or directory path.
+    :return: None
+    '''
+    _run_metrics.count(BYTES_READ, path_size(path))
+
+
+def count_written(path):
+    '''Count the size of an output file as bytes written.
+
+    :param path: File or directory path.
+    :return: None
+    '''
+    _run_metrics.count(BYTES_WRITTEN, path_size(path))
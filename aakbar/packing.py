@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+'''Packed integer keys for peptide k-mers.
+
+Each residue is coded as a digit in base PACKING_RADIX, with the alphabet
+in byte order so that sorting packed keys of a given k sorts the
+corresponding k-mers lexically.  Keys fit in an unsigned 64-bit integer
+for k up to MAX_PACKED_K.
+
+Term tables may be sampled to minimizers: of every w consecutive k-mers
+of a sequence, only the valid one with the smallest hash of its packed
+key is kept.  How a table was sampled is recorded in a small YAML file
+next to it, so that later commands can sample the same way.
+
+Term tables may also be split into shards by a hash of each term, so
+that shard p of every set holds the same terms and can be merged
+independently of other shards.  The number of shards is recorded the
+same way as sampling.
+'''
+
+# standard library imports
+import os
+
+# external packages
+import numpy as np
+
+# module imports
+from .common import *
+
+#
+# Global constants
+#
+PACKED_ALPHABET = b'*ACDEFGHIKLMNPQRSTVWY'
+PACKING_RADIX = len(PACKED_ALPHABET)
+MAX_PACKED_K = 14 # 21**14 < 2**64
+INVALID_CODE = 255
+KEY_DTYPE = np.uint64
+_ALPHABET_ARR = np.frombuffer(PACKED_ALPHABET, dtype=np.uint8)
+_CODE_TABLE = np.full(256, INVALID_CODE, dtype=np.uint8)
+_CODE_TABLE[_ALPHABET_ARR] = np.arange(PACKING_RADIX, dtype=np.uint8)
+_HASH_INCREMENT = 0x9e3779b97f4a7c15
+_HASH_MULTIPLIERS = (KEY_DTYPE(0xbf58476d1ce4e5b9), KEY_DTYPE(0x94d049bb133111eb))
+_HASH_SHIFTS = (KEY_DTYPE(30), KEY_DTYPE(27), KEY_DTYPE(31))
+MINIMIZER_HASH_SEED = 2 # seeds 0 and 1 are used by Bloom filters
+SHARD_HASH_SEED = 3
+SAMPLING_SUFFIX = '_sampling.yaml'
+SHARDS_SUFFIX = '_shards.yaml'
+_FNV_OFFSET = KEY_DTYPE(0xcbf29ce484222325)
+_FNV_PRIME = KEY_DTYPE(0x100000001b3)
+
+#
+# Helper functions begin here.
+#
+def check_packable_k(k):
+    '''Exit with an error message if k is too large to pack.
+
+    :param k: Term length.
+    :return: None
+    '''
+    if k > MAX_PACKED_K:
+        logger.error('k of %d is larger than maximum of %d for packed keys.',
+                     k, MAX_PACKED_K)
+        sys.exit(1)
+
+
+def residue_codes(seq):
+    '''Convert a sequence to an array of residue codes.
+
+    :param seq: Sequence as string, bytes, or other convertible type.
+                Lower-case and ambiguous residues get INVALID_CODE.
+    :return: Array of uint8 codes.
+    '''
+    return _CODE_TABLE[np.frombuffer(to_bytes(seq), dtype=np.uint8)]
+
+
+def pack_codes(codes, k):
+    '''Pack every window of k residue codes.
+
+    :param codes: Array of residue codes.
+    :param k: Term length.
+    :return: Tuple of (array of keys, boolean array of valid windows).
+    '''
+    m = len(codes) - k + 1
+    if m <= 0:
+        return np.zeros(0, dtype=KEY_DTYPE), np.zeros(0, dtype=bool)
+    invalid = codes == INVALID_CODE
+    digits = np.where(invalid, 0, codes).astype(KEY_DTYPE)
+    keys = np.zeros(m, dtype=KEY_DTYPE)
+    for j in range(k):
+        keys *= KEY_DTYPE(PACKING_RADIX)
+        keys += digits[j:j+m]
+    n_invalid = np.concatenate(([0], np.cumsum(invalid)))
+    valid = (n_invalid[k:k+m] - n_invalid[:m]) == 0
+    return keys, valid
+
+
+def pack_windows(seq, k):
+    '''Pack every window of length k in a sequence.
+
+    :param seq: Sequence as string, bytes, or other convertible type.
+    :param k: Term length.
+    :return: Tuple of (array of keys, boolean array of valid windows).
+    '''
+    return pack_codes(residue_codes(seq), k)
+
+
+def pack_terms(terms, k):
+    '''Pack an array of terms.
+
+    :param terms: Array of terms of dtype 'S<k>', or list of strings.
+    :param k: Term length.
+    :return: Tuple of (array of keys, boolean array of packable terms).
+    '''
+    terms = np.asarray(terms, dtype=np.dtype(('S%d' % k)))
+    codes = _CODE_TABLE[np.frombuffer(terms.tobytes(),
+                                      dtype=np.uint8).reshape(-1, k)]
+    valid = (codes != INVALID_CODE).all(axis=1)
+    keys = np.zeros(len(terms), dtype=KEY_DTYPE)
+    for j in range(k):
+        keys *= KEY_DTYPE(PACKING_RADIX)
+        keys += np.where(valid, codes[:, j], 0).astype(KEY_DTYPE)
+    return keys, valid
+
+
+def unpack_keys(keys, k):
+    '''Convert packed keys back to terms.
+
+    :param keys: Array of packed keys.
+    :param k: Term length.
+    :return: Array of terms of dtype 'S<k>'.
+    '''
+    keys = np.array(keys, dtype=KEY_DTYPE)
+    chars = np.zeros((len(keys), k), dtype=np.uint8)
+    for j in range(k-1, -1, -1):
+        chars[:, j] = _ALPHABET_ARR[(keys % KEY_DTYPE(PACKING_RADIX)).astype(np.intp)]
+        keys //= KEY_DTYPE(PACKING_RADIX)
+    return chars.view(np.dtype(('S%d' % k))).ravel()
+
+
+def digit_differences(a, b, n_digits):
+    '''Count differing residues between pairs of packed keys.
+
+    :param a: Array of packed keys.
+    :param b: Array of packed keys, same length as a.
+    :param n_digits: Number of residues packed in each key.
+    :return: Array of counts of differing residues.
+    '''
+    a = np.array(a, dtype=KEY_DTYPE)
+    b = np.array(b, dtype=KEY_DTYPE)
+    radix = KEY_DTYPE(PACKING_RADIX)
+    n_diff = np.zeros(len(a), dtype=np.int32)
+    for j in range(n_digits):
+        n_diff += (a % radix) != (b % radix)
+        a //= radix
+        b //= radix
+    return n_diff
+
+
+def hash_keys(keys, seed=0):
+    '''Mix packed keys into well-distributed 64-bit hashes.
+
+    Uses the splitmix64 finalizer, so that keys differing in any residue
+    give unrelated hashes.
+
+    :param keys: Array of packed keys.
+    :param seed: Integer selecting an independent hash function.
+    :return: Array of hashes.
+    '''
+    h = np.array(keys, dtype=KEY_DTYPE)
+    h += KEY_DTYPE((_HASH_INCREMENT*(seed + 1)) % 2**64)
+    h ^= h >> _HASH_SHIFTS[0]
+    h *= _HASH_MULTIPLIERS[0]
+    h ^= h >> _HASH_SHIFTS[1]
+    h *= _HASH_MULTIPLIERS[1]
+    h ^= h >> _HASH_SHIFTS[2]
+    return h
+
+
+def term_shards(terms, n_shards):
+    '''Assign terms to shards by a hash of their bytes.
+
+    Terms are hashed as bytes rather than as packed keys, so that terms
+    of any length or letters can be sharded.
+
+    :param terms: Array of terms of dtype 'S<k>'.
+    :param n_shards: Number of shards.
+    :return: Array of shard numbers, in range(n_shards).
+    '''
+    terms = np.asarray(terms)
+    k = terms.dtype.itemsize
+    chars = np.frombuffer(terms.tobytes(), dtype=np.uint8).reshape(-1, k)
+    h = np.full(len(terms), _FNV_OFFSET, dtype=KEY_DTYPE)
+    for j in range(k):
+        h ^= chars[:, j].astype(KEY_DTYPE)
+        h *= _FNV_PRIME
+    return (hash_keys(h, seed=SHARD_HASH_SEED) % KEY_DTYPE(n_shards)).astype(np.intp)
+
+
+def shard_stem(filestem, shard, n_shards):
+    '''File stem of one shard of a term table.
+
+    :param filestem: Term file stem, less '_terms.tsv'.
+    :param shard: Shard number, from 0.
+    :param n_shards: Number of shards.
+    :return: File stem.
+    '''
+    return '%s_shard-%d-of-%d' % (filestem, shard, n_shards)
+
+
+def minimizer_mask(keys, valid, window):
+    '''Select the minimizers among the windows of a sequence.
+
+    Of every run of window consecutive k-mers, the valid one with the
+    smallest hash is selected, the leftmost if hashes are equal.  A
+    sequence with fewer k-mers than window has one minimizer.
+
+    :param keys: Array of packed keys of consecutive windows.
+    :param valid: Boolean array of valid windows.
+    :param window: Number of consecutive k-mers from which one is selected.
+    :return: Boolean array of selected windows.
+    '''
+    n = len(keys)
+    selected = np.zeros(n, dtype=bool)
+    if n == 0:
+        return selected
+    hashes = hash_keys(keys, seed=MINIMIZER_HASH_SEED)
+    hashes[~np.asarray(valid)] = np.iinfo(KEY_DTYPE).max
+    if n <= window:
+        selected[np.argmin(hashes)] = True
+    else:
+        runs = np.lib.stride_tricks.as_strided(hashes,
+                                               shape=(n - window + 1, window),
+                                               strides=(hashes.strides[0],)*2)
+        selected[runs.argmin(axis=1) + np.arange(n - window + 1)] = True
+    return selected & valid
+
+
+def minimizer_sampling(k, window):
+    '''Describe minimizer sampling of a term table.
+
+    :param k: Term length.
+    :param window: Minimizer window, in k-mers.
+    :return: Sampling dictionary, or None if window is None or 1.
+    '''
+    if window is None or window <= 1:
+        return None
+    return {'scheme': 'minimizer',
+            'k': int(k),
+            'window': int(window),
+            'hash_seed': MINIMIZER_HASH_SEED}
+
+
+def write_sidecar(path, description):
+    '''Write a description of a term table, replacing any old one at once.
+
+    Commands working on different shards of a table may write the same
+    description concurrently, so readers must never see a partial file.
+
+    :param path: Path of description.
+    :param description: Dictionary to write as YAML.
+    :return: None
+    '''
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmppath, 'wt') as f:
+        yaml.dump(description, f)
+    os.replace(tmppath, path)
+
+
+def sampling_path(dir, filestem):
+    '''Return the path of the sampling description of a term table.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem, less '_terms.tsv'.
+    :return: Path.
+    '''
+    return os.path.join(dir, filestem + SAMPLING_SUFFIX)
+
+
+def read_sampling(dir, filestem):
+    '''Read how a term table was sampled.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem.
+    :return: Sampling dictionary, or None if the table is not sampled.
+    '''
+    path = sampling_path(dir, filestem)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rt') as f:
+        return yaml.safe_load(f)
+
+
+def write_sampling(dir, filestem, sampling):
+    '''Record how a term table was sampled.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem.
+    :param sampling: Sampling dictionary, or None to remove any record
+                     left from an earlier sampled table.
+    :return: None
+    '''
+    path = sampling_path(dir, filestem)
+    if sampling is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    write_sidecar(path, sampling)
+
+
+def shards_path(dir, filestem):
+    '''Return the path of the shard description of a term table.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem, less '_terms.tsv'.
+    :return: Path.
+    '''
+    return os.path.join(dir, filestem + SHARDS_SUFFIX)
+
+
+def read_shards(dir, filestem):
+    '''Read the number of shards into which a term table was split.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem.
+    :return: Number of shards, or 1 if the table is not sharded.
+    '''
+    path = shards_path(dir, filestem)
+    if not os.path.exists(path):
+        return 1
+    with open(path, 'rt') as f:
+        return yaml.safe_load(f)['n_shards']
+
+
+def write_shards(dir, filestem, n_shards):
+    '''Record the number of shards into which a term table was split.
+
+    :param dir: Directory of term table.
+    :param filestem: Term file stem.
+    :param n_shards: Number of shards, or 1 to remove any record left
+                     from an earlier sharded table.
+    :return: None
+    '''
+    path = shards_path(dir, filestem)
+    if n_shards <= 1:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    write_sidecar(path, {'n_shards': int(n_shards),
+                         'hash_seed': SHARD_HASH_SEED})
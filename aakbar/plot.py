@@ -4,27 +4,126 @@
 
 # standard library imports
 import os
-import math
 import csv
+from concurrent.futures import ProcessPoolExecutor
 
 # external packages
+import numpy as np
 import pandas as pd
 
 # module imports
 from .common import *
 from . import cli, get_user_context_obj, logger
+from .compression import table_compression
 
+#
+# Global constants
+#
+CONSERVED_BINS = [1,2,3,4,5,6,7,8,
+                  10,12,14,16,
+                  20,24,28,32,
+                  40,48,56,64,
+                  80,96,112,128,
+                  160,192,224,256]
+DEFAULT_WORKERS = os.cpu_count() or 1
+# highly-conserved term arrays, set by _init_conserved_worker in each pool
+# worker process, or in this process when stats are computed serially
+_HC_TERMS = None
+_HC_AVG_COUNT = None
+_HC_MAX_COUNT = None
+
+#
+# Helper functions begin here.
+#
+def _init_conserved_worker(hc_terms, hc_avg_count, hc_max_count):
+    '''Share highly-conserved term arrays with a worker process.
+    '''
+    global _HC_TERMS, _HC_AVG_COUNT, _HC_MAX_COUNT
+    _HC_TERMS = hc_terms
+    _HC_AVG_COUNT = hc_avg_count
+    _HC_MAX_COUNT = hc_max_count
+
+
+def conserved_set_stats(calc_set, dir, filestem, first_n):
+    '''Find which highly-conserved terms were found in one set.
+
+    Writes the fraction found per max_count bin and the list of missing
+    signatures to the set directory.
+
+    :param calc_set: Data set name.
+    :param dir: Data set directory.
+    :param filestem: Search output file stem.
+    :param first_n: Number of signature counts to read, or None for all.
+    :return: Tuple of (calc_set, number of HCterms found, list of
+             (bin, n_terms, n_found) tuples for nonempty bins).
+    '''
+    infilepath = os.path.join(dir, filestem + '_sigcounts.tsv')
+    sigs = pd.read_csv(infilepath,
+                       usecols=[0],
+                       sep='\t',
+                       compression=table_compression(infilepath),
+                       nrows=first_n,
+                       keep_default_na=False).iloc[:, 0].values
+    found = np.isin(_HC_TERMS, np.sort(sigs.astype(_HC_TERMS.dtype)))
+    # bin i holds max_count in (CONSERVED_BINS[i-1], CONSERVED_BINS[i]]
+    bin_numbers = np.digitize(_HC_MAX_COUNT, CONSERVED_BINS, right=True)
+    in_bins = bin_numbers < len(CONSERVED_BINS)
+    n_terms = np.bincount(bin_numbers[in_bins], minlength=len(CONSERVED_BINS))
+    n_found = np.bincount(bin_numbers[in_bins & found], minlength=len(CONSERVED_BINS))
+    bin_rows = [(CONSERVED_BINS[i], int(n_terms[i]), int(n_found[i]))
+                for i in np.flatnonzero(n_terms)]
+    #
+    # write fraction found histogram
+    #
+    fractionfoundpath = os.path.join(dir, filestem + '_fractionfound.tsv')
+    with open(fractionfoundpath, 'wt') as fractionfoundfh:
+        fractionfoundwriter = csv.DictWriter(fractionfoundfh,
+                                             fieldnames=['bin',
+                                                         'n_found',
+                                                         'found_percent',
+                                                         'sigma_percent'],
+                                             delimiter='\t')
+        fractionfoundwriter.writeheader()
+        for bin, n_terms_in_bin, n_sigs_in_bin in bin_rows:
+            fractionfoundwriter.writerow({
+                'bin': bin,
+                'n_found': n_sigs_in_bin,
+                'found_percent': 100.*n_sigs_in_bin/n_terms_in_bin,
+                'sigma_percent': 100.*np.sqrt(n_sigs_in_bin)/n_terms_in_bin
+            })
+    #
+    # write missing signatures, in bin order
+    #
+    missing = np.flatnonzero(in_bins & ~found)
+    missing = missing[np.argsort(bin_numbers[missing], kind='mergesort')]
+    missinglistpath = os.path.join(dir, filestem + '_missingsigs.tsv')
+    pd.DataFrame({'signature': [to_str(term) for term in _HC_TERMS[missing]],
+                  'avg_count': _HC_AVG_COUNT[missing],
+                  'max_count': _HC_MAX_COUNT[missing]},
+                 columns=['signature', 'avg_count', 'max_count']
+                 ).to_csv(missinglistpath, sep='\t', index=False)
+    return calc_set, int(found.sum()), bin_rows
+
+#
+# Cli commands begin here.
+#
 @cli.command()
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Number of sets to process in parallel.')
 @click.argument('infilestem', type=str)
 @click.argument('sigset', type=str)
 @click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
-def conserved_signature_stats(infilestem, sigset, setlist):
+def conserved_signature_stats(workers, infilestem, sigset, setlist):
     """Stats on signatures found in all input genomes.
 
+    :param workers: Number of sets to process in parallel.
     :param: infilestem: Input filestem.
     :param sigset: Name of signature set used.
     :param setlist: List of data sets.
     :return:
+
+    Highly-conserved terms are binned by max_count, with each bin
+    holding counts above the previous bin edge up to its own.
     """
     global config_obj
     user_ctx = get_user_context_obj()
@@ -32,7 +131,7 @@ def conserved_signature_stats(infilestem, sigset, setlist):
         logger.info('Only first %d records will be used.', user_ctx['first_n'])
         first_n = user_ctx['first_n']
     else:
-        first_n = 1E12
+        first_n = None
     # parameter inputs
     filestem = infilestem + '-' + sigset
     infilename = filestem + '_sigcounts.tsv'
@@ -47,8 +146,11 @@ def conserved_signature_stats(infilestem, sigset, setlist):
     if not os.path.exists(termfilepath):
         logger.error('input file "%s" does not exist.', termfilepath)
         sys.exit(1)
-    term_frame = pd.DataFrame().from_csv(termfilepath, sep='\t')
-    del term_frame['score']
+    term_frame = pd.read_csv(termfilepath,
+                             index_col=0,
+                             sep='\t',
+                             compression=table_compression(termfilepath),
+                             keep_default_na=False)
     n_terms = len(term_frame)
     k = len(term_frame.index[0])
     n_intersections = max(term_frame['intersections'])
@@ -57,109 +159,53 @@ def conserved_signature_stats(infilestem, sigset, setlist):
                 k)
     logger.info('Calculating HCterms for %d data sets:', len(setlist))
     #
-    # operate on highly-conserved terms only
+    # operate on highly-conserved terms only, as sorted arrays
     #
-    hc_terms = term_frame[term_frame['intersections'] == n_intersections]
+    hc_frame = term_frame[term_frame['intersections'] == n_intersections]
     del term_frame
-    del hc_terms['intersections']
+    hc_terms = np.array(hc_frame.index, dtype=np.dtype(('S%d' % k)))
+    order = np.argsort(hc_terms, kind='mergesort')
+    hc_terms = hc_terms[order]
+    hc_avg_count = hc_frame['count'].values[order]/float(n_intersections)
+    hc_max_count = hc_frame['max_count'].values[order]
+    del hc_frame
     n_hc_terms = len(hc_terms)
     logger.info('%d HCterms in signature set.', n_hc_terms)
     #
-    # loop on sets
+    # check input files exist before starting
     #
+    set_args = []
     for calc_set in setlist:
-        logger.info('set %s:', calc_set)
         dir = config_obj.config_dict[calc_set]['dir']
         infilepath = os.path.join(dir, infilename)
         if not os.path.exists(infilepath):
             logger.error('Input file "%s" does not exist.', infilepath)
             sys.exit(1)
-        sig_frame = pd.read_csv(infilepath,
-                                usecols=[0, 3],
-                                index_col=0,
-                                sep='\t')
-        n_sigs = 0
-        n_hc_sigs = 0
-        sigs_in_hc = set()
-        for sig in sig_frame.index:
-            if sig in hc_terms.index:
-                sigs_in_hc.add(sig)
-                n_hc_sigs += 1
-                #my_lca_counts.loc[sig] = sig_frame.loc[sig]['counts']
-                #term_stats = lca_terms.loc[sig]
-                #logger.info(sig_frame.loc[sig]['counts'])
-            if n_sigs > first_n:
-                break
-            n_sigs += 1
-        bins = [1,2,3,4,5,6,7,8,
-                10,12,14,16,
-                20,24,28,32,
-                40,48,56,64,
-                80,96,112,128,
-                160,192,224,256]
-        lastbin = 0
-        #
-        # Fraction found historam initialization
-        #
-        fractionfoundpath = os.path.join(dir, filestem + '_fractionfound.tsv')
-        fractionfoundfh = open(fractionfoundpath, 'wt')
-        fractionfoundwriter = csv.DictWriter(fractionfoundfh,
-                                            fieldnames=['bin',
-                                                        'n_found',
-                                                        'found_percent',
-                                                        'sigma_percent'],
-                                            delimiter='\t')
-        fractionfoundwriter.writeheader()
-        #
-        # Missing list initialization
-        #
-        missinglistpath = os.path.join(dir, filestem + '_missingsigs.tsv')
-        missinglistfh = open(missinglistpath, 'wt')
-        missinglistwriter = csv.DictWriter(missinglistfh,
-                                            fieldnames=['signature',
-                                                        'avg_count',
-                                                        'max_count'],
-                                            delimiter='\t')
-        missinglistwriter.writeheader()
-        #
+        set_args.append((calc_set, dir, filestem, first_n))
+    #
+    # process sets, in parallel if more than one worker
+    #
+    workers = max(1, min(workers, len(set_args)))
+    hc_arrays = (hc_terms, hc_avg_count, hc_max_count)
+    if workers == 1:
+        _init_conserved_worker(*hc_arrays)
+        results = [conserved_set_stats(*args) for args in set_args]
+    else:
+        logger.debug('Processing %d sets with %d workers.', len(set_args), workers)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_conserved_worker,
+                                 initargs=hc_arrays) as executor:
+            results = list(executor.map(conserved_set_stats, *zip(*set_args)))
+    for calc_set, n_hc_sigs, bin_rows in results:
+        logger.info('set %s:', calc_set)
         logger.info('   bin\tHCsigs\tfraction\t+/-')
-        for i in range(len(bins)):
-            nextbin = bins[i]
-            inrange = hc_terms[hc_terms['max_count'].isin([lastbin,nextbin])].index
-            rangeset = set([term for term in inrange])
-            n_terms_in_bin = len(rangeset)
-            if n_terms_in_bin == 0:
-                continue
-            sigs_in_range = rangeset.intersection(sigs_in_hc)
-            for missing in rangeset.difference(sigs_in_hc):
-                missinglistwriter.writerow({
-                    'signature': missing,
-                    'avg_count': hc_terms.loc[missing]['count']/float(n_intersections),
-                    'max_count': hc_terms.loc[missing]['max_count']
-                })
-            n_sigs_in_bin = len(sigs_in_range)
-            fraction_found = 100.*n_sigs_in_bin/n_terms_in_bin
-            sigma = math.sqrt(n_sigs_in_bin)
-            sigma_percent = 100.*sigma/n_terms_in_bin
+        for bin, n_terms_in_bin, n_sigs_in_bin in bin_rows:
             logger.info('   %d: %d\t%.1f\t%.1f',
-                        nextbin,
+                        bin,
                         n_sigs_in_bin,
-                        fraction_found,
-                        sigma_percent)
-            fractionfoundwriter.writerow({
-                'bin': nextbin,
-                'n_found': n_sigs_in_bin,
-                'found_percent': fraction_found,
-                'sigma_percent': sigma_percent
-            })
-            lastbin = nextbin
+                        100.*n_sigs_in_bin/n_terms_in_bin,
+                        100.*np.sqrt(n_sigs_in_bin)/n_terms_in_bin)
         logger.info('   %d (%.1f%% of overall) highly-conserved sigs in %s.',
                     n_hc_sigs,
                     n_hc_sigs * 100. / n_hc_terms,
                     calc_set)
-        fractionfoundfh.close()
-        missinglistfh.close()
-
-
-
-
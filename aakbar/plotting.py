@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''Deferred rendering of plots from plot specifications.
+
+Commands describe each plot as a small YAML specification written next
+to the plot file, holding the series to draw and the labels.  Unless
+plotting is turned off with --no-plots, specifications are rendered by
+a background process while the command goes on computing, and the
+command waits for rendering to finish before it exits.  Specifications
+left unrendered can be rendered later with render_plots.
+
+Matplotlib is imported only in the processes that render.
+'''
+
+# standard library imports
+import os
+import glob
+from concurrent.futures import ProcessPoolExecutor
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .metrics import stage
+
+#
+# Global constants
+#
+PLOT_SPEC_SUFFIX = '_plotspec.yaml'
+DEFAULT_PLOT_WORKERS = 1
+DEFAULT_RENDER_WORKERS = os.cpu_count() or 1
+_plot_executor = None
+_plot_futures = []
+
+#
+# Helper functions begin here.
+#
+def plot_spec_path(plotpath):
+    '''Return the path of the specification for a plot file.
+
+    :param plotpath: Path of plot file.
+    :return: Path of plot specification.
+    '''
+    return os.path.splitext(plotpath)[0] + PLOT_SPEC_SUFFIX
+
+
+def write_plot_spec(plotpath, series, title, xlabel, ylabel,
+                    xlim=None, legend_loc=None):
+    '''Write a plot specification of line series.
+
+    :param plotpath: Path of plot file to be rendered.
+    :param series: List of dictionaries with x and y sequences, and an
+                   optional label.
+    :param title: Plot title.
+    :param xlabel: X-axis label.
+    :param ylabel: Y-axis label.
+    :param xlim: Optional [min, max] of x axis.
+    :param legend_loc: If not None, draw a legend at this location.
+    :return: Path of plot specification.
+    '''
+    spec = {'plot': os.path.basename(plotpath),
+            'title': title,
+            'xlabel': xlabel,
+            'ylabel': ylabel,
+            'series': []}
+    for line in series:
+        spec_line = {'x': [float(x) for x in line['x']],
+                     'y': [float(y) for y in line['y']]}
+        if 'label' in line:
+            spec_line['label'] = str(line['label'])
+        spec['series'].append(spec_line)
+    if xlim is not None:
+        spec['xlim'] = [float(x) for x in xlim]
+    if legend_loc is not None:
+        spec['legend_loc'] = legend_loc
+    specpath = plot_spec_path(plotpath)
+    logger.debug('Writing plot specification "%s".', specpath)
+    with open(specpath, 'wt') as f:
+        yaml.dump(spec, f)
+    return specpath
+
+
+def render_plot_spec(specpath):
+    '''Render a plot from its specification.
+
+    :param specpath: Path of plot specification.
+    :return: Path of plot file.
+    '''
+    # Matplotlib -use non-interactive backend
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    with open(specpath, 'rt') as f:
+        spec = yaml.safe_load(f)
+    plotpath = os.path.join(os.path.dirname(specpath), spec['plot'])
+    fig = plt.figure()
+    try:
+        ax = fig.add_subplot(111)
+        for series in spec['series']:
+            ax.plot(series['x'], series['y'], '-', label=series.get('label'))
+        if 'legend_loc' in spec:
+            ax.legend(loc=spec['legend_loc'])
+        if 'xlim' in spec:
+            ax.set_xlim(spec['xlim'])
+        ax.set_title(spec['title'])
+        ax.set_xlabel(spec['xlabel'])
+        ax.set_ylabel(spec['ylabel'])
+        fig.savefig(plotpath)
+    finally:
+        plt.close(fig)
+    return plotpath
+
+
+def wait_for_plots():
+    '''Wait for background rendering to finish.
+
+    :return: None
+    '''
+    global _plot_executor, _plot_futures
+    for future in _plot_futures:
+        try:
+            with stage('plot'):
+                plotpath = future.result()
+            logger.debug('Rendered plot "%s".', plotpath)
+        except Exception as e:
+            logger.error('Plot rendering failed: %s', e)
+    _plot_futures = []
+    if _plot_executor is not None:
+        _plot_executor.shutdown()
+        _plot_executor = None
+
+
+def plot_lines(plotpath, series, title, xlabel, ylabel,
+               xlim=None, legend_loc=None):
+    '''Write a plot specification and queue it for background rendering.
+
+    Parameters are as for write_plot_spec.  With --no-plots, only the
+    specification is written.
+
+    :return: Path of plot specification.
+    '''
+    global _plot_executor
+    with stage('plot'):
+        specpath = write_plot_spec(plotpath, series, title, xlabel, ylabel,
+                                   xlim=xlim, legend_loc=legend_loc)
+        ctx = click.get_current_context(silent=True)
+        if ctx is None or not isinstance(ctx.obj, dict):
+            render_plot_spec(specpath)
+            return specpath
+        if not ctx.obj.get('plots', True):
+            return specpath
+        if _plot_executor is None:
+            _plot_executor = ProcessPoolExecutor(max_workers=DEFAULT_PLOT_WORKERS)
+            ctx.find_root().call_on_close(wait_for_plots)
+        _plot_futures.append(_plot_executor.submit(render_plot_spec, specpath))
+    return specpath
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.option('--force', is_flag=True, default=False,
+              help='Render plots that are already up to date.')
+@click.option('--workers', default=DEFAULT_RENDER_WORKERS, show_default=True,
+              help='Number of plots to render in parallel.')
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def render_plots(force, workers, setlist):
+    '''Render plots from plot specifications.
+
+    :param force: If True, render plots newer than their specifications.
+    :param workers: Number of plots to render in parallel.
+    :param setlist: Sets in which to render plots, in addition to the
+                    summary directory.
+    :return:
+
+    Plot specifications are written by commands that make plots, and are
+    left unrendered by --no-plots.
+
+    Example:
+        aakbar render_plots all
+    '''
+    global config_obj
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    dirs = [config_obj.config_dict[calc_set]['dir'] for calc_set in setlist]
+    summarydir = config_obj.config_dict['summary']['dir']
+    if summarydir is not None:
+        dirs.insert(0, summarydir)
+    specpaths = []
+    for dir in dirs:
+        for specpath in sorted(glob.glob(os.path.join(dir, '*' + PLOT_SPEC_SUFFIX))):
+            with open(specpath, 'rt') as f:
+                plotpath = os.path.join(dir, yaml.safe_load(f)['plot'])
+            if (force or not os.path.exists(plotpath) or
+                    os.path.getmtime(plotpath) < os.path.getmtime(specpath)):
+                specpaths.append(specpath)
+    logger.info('Rendering %d plots.', len(specpaths))
+    if len(specpaths) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(specpaths)))) as executor:
+        for plotpath in executor.map(render_plot_spec, specpaths):
+            logger.debug('Rendered plot "%s".', plotpath)
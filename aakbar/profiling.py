@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+'''Profiling of a command, selected by the global --profile option.
+
+With --profile cprofile, the command is run under cProfile, and the
+stats are written to logs/aakbar-COMMAND.prof for use with pstats or
+snakeviz.  This is exact but slows down Python-heavy code considerably.
+
+With --profile sample, a background thread records the stack of the
+main thread at intervals.  Overhead is small and does not depend on how
+many calls are made, so it is safe to leave on for production runs.
+Stacks are written to logs/aakbar-COMMAND-samples.txt in the collapsed
+format read by flame graph tools.
+
+Either way, the functions with the most time are summarized in
+logs/aakbar-COMMAND-profile.txt.
+'''
+
+# standard library imports
+import os
+import io
+import time
+import threading
+from collections import Counter
+
+# module imports
+from .common import *
+
+#
+# Global constants
+#
+PROFILE_MODES = ['cprofile', 'sample']
+PROFILE_TOP_N = 30
+SAMPLE_INTERVAL = 0.01 # seconds
+LOG_DIR = './logs/'
+
+#
+# Helper functions begin here.
+#
+def profile_path(command, suffix):
+    '''Return the path of a profile output next to the command log.
+
+    :param command: Command name.
+    :param suffix: Suffix, including extension.
+    :return: Path.
+    '''
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    return os.path.join(LOG_DIR, PROGRAM_NAME + '-' + command + suffix)
+
+
+def frame_label(code):
+    '''Label of a code object, as for pstats.
+
+    :param code: Code object.
+    :return: String of file:line(function).
+    '''
+    return '%s:%d(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def start_profiler(mode, command):
+    '''Start profiling a command.
+
+    :param mode: One of PROFILE_MODES.
+    :param command: Command name.
+    :return: Profiler object with a stop() method.
+    '''
+    logger.debug('Profiling %s with %s.', command, mode)
+    if mode == 'cprofile':
+        return CProfiler(command)
+    return SamplingProfiler(command)
+
+#
+# Classes begin here.
+#
+class CProfiler(object):
+    '''Profile the main thread with cProfile.
+
+    :param command: Command name.
+    '''
+    def __init__(self, command):
+        import cProfile
+        self.command = command
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+
+    def stop(self):
+        '''Stop profiling and write stats and summary.
+        '''
+        import pstats
+        self.profile.disable()
+        statspath = profile_path(self.command, '.prof')
+        self.profile.dump_stats(statspath)
+        summary = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=summary)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        stats.sort_stats('tottime').print_stats(PROFILE_TOP_N)
+        summarypath = profile_path(self.command, '-profile.txt')
+        with open(summarypath, 'wt') as f:
+            f.write(summary.getvalue())
+        logger.debug('Wrote profile stats to "%s" and summary to "%s".',
+                     statspath, summarypath)
+
+
+class SamplingProfiler(threading.Thread):
+    '''Profile the main thread by sampling its stack.
+
+    :param command: Command name.
+    :param interval: Seconds between samples.
+    '''
+    def __init__(self, command, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name='sampling-profiler', daemon=True)
+        self.command = command
+        self.interval = interval
+        self.main_id = threading.main_thread().ident
+        self.stacks = Counter()
+        self.n_samples = 0
+        self._stop_event = threading.Event()
+        self._start = time.perf_counter()
+        self.start()
+
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.main_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.n_samples += 1
+
+
+    def summary(self):
+        '''Summarize samples by function.
+
+        :return: Summary text.
+        '''
+        own = Counter()
+        total = Counter()
+        for stack, n in self.stacks.items():
+            if stack:
+                own[stack[-1]] += n
+            for code in set(stack):
+                total[code] += n
+        # callers common to all samples, as from click, tell nothing
+        stacks = list(self.stacks.keys())
+        n_common = 0
+        while (stacks and n_common < min([len(stack) for stack in stacks]) - 1 and
+               len(set([stack[n_common] for stack in stacks])) == 1):
+            n_common += 1
+        for code in stacks[0][:n_common - 1] if n_common else []:
+            del total[code]
+        n_samples = max(self.n_samples, 1)
+        lines = ['%d samples of %s every %.0f ms in %.1f s.' %
+                 (self.n_samples, self.command, self.interval*1000.,
+                  time.perf_counter() - self._start)]
+        for title, counts in [('Ordered by samples in function and callees:', total),
+                              ('Ordered by samples in function itself:', own)]:
+            lines += ['', title, '%8s %7s  %s' % ('samples', 'percent', 'function')]
+            lines += ['%8d %6.1f%%  %s' % (n, 100.*n/n_samples, frame_label(code))
+                      for code, n in counts.most_common(PROFILE_TOP_N)]
+        return '\n'.join(lines) + '\n'
+
+
+    def stop(self):
+        '''Stop sampling and write stacks and summary.
+        '''
+        self._stop_event.set()
+        self.join()
+        samplepath = profile_path(self.command, '-samples.txt')
+        with open(samplepath, 'wt') as f:
+            for stack, n in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write('%s %d\n' % (';'.join([frame_label(code) for code in stack]), n))
+        summarypath = profile_path(self.command, '-profile.txt')
+        with open(summarypath, 'wt') as f:
+            f.write(self.summary())
+        logger.debug('Wrote %d stack samples to "%s" and summary to "%s".',
+                     self.n_samples, samplepath, summarypath)
+
@@ -4,98 +4,323 @@
 
 # standard library imports
 import os
-import shutil
-from collections import Counter
 import csv
 
 # external packages
 import numpy as np
 import pandas as pd
-import pyfaidx
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 
 # module imports
 from .common import *
 from . import cli, get_user_context_obj, logger, log_elapsed_time
-
-# Matplotlib -use non-interactive backend
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from .hits import HitTableWriter, hit_table_dir, SIGLIST_FIELDS
+from .packing import pack_codes, residue_codes, minimizer_mask
+from .sigindex import open_signature_index
+from .compression import (open_fasta, fasta_keys, n_fasta_keys, split_fasta_ext,
+                          open_output)
+from .classify import SignatureClassifier
+from .plotting import plot_lines
+from .manifest import OutputManifest, manifest_path
+from .metrics import stage, count, count_read, count_written
 
 #
 # Global constants
 #
 RESIDUES_TO_BASES = 3
 HISTOGRAM_BINS = 14
+HIT_FORMATS = ['tsv', 'binary']
+FASTA_LINE_LENGTH = 80
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+#
+# Helper functions begin here.
+#
+def weight_string(weightarr):
+    '''Encode per-residue weights as one hex digit per residue.
+
+    :param weightarr: Integer array of weights.
+    :return: String of hex digits, saturating at 'f'.
+    '''
+    return HEX_DIGITS[np.clip(weightarr, 0, 15)].tobytes().decode('ascii')
+
+
+def translate_frames(seq, nucleotides=False):
+    '''Return residue codes for each frame to be searched.
+
+    :param seq: Input sequence string.
+    :param nucleotides: If True, do 6-frame translation.
+    :return: List of residue code arrays, in frame order.
+    '''
+    if not nucleotides:
+        return [residue_codes(seq)]
+    frame_codes = []
+    seq = to_bytes(seq)
+    length = len(seq)
+    for offset in range(3): # three bases in a codon
+        DNA = Seq(to_str(seq[offset:offset+int((length-offset)/3)*3]), generic_dna)
+        frame_codes.append(residue_codes(str(DNA.translate())))
+        frame_codes.append(residue_codes(str(DNA.reverse_complement().translate())))
+    return frame_codes
+
+
+def frame_windows(seq, ks, nucleotides=False):
+    '''Pack the windows of every frame of a sequence for each k.
+
+    :param seq: Sequence string.
+    :param ks: Iterable of term lengths.
+    :param nucleotides: If True, do 6-frame translation.
+    :return: Dictionary of lists of (keys, valid) tuples in frame order,
+             keyed by k.
+    '''
+    frame_codes = translate_frames(seq, nucleotides)
+    return dict([(k, [pack_codes(codes, k) for codes in frame_codes])
+                 for k in set(ks)])
+
+
+def sample_frame_windows(seq, windows, k, minimizer_window, nucleotides=False):
+    '''Keep only the windows that are minimizers, as in sampled term tables.
+
+    Minimizers are chosen on upper-cased residues, as they are by
+    calculate_peptide_terms on masked sequences.
+
+    :param seq: Sequence string.
+    :param windows: List of (keys, valid) tuples of length k, in frame order.
+    :param k: Term length.
+    :param minimizer_window: Minimizer window, or None for all windows.
+    :param nucleotides: If True, frames are translations.
+    :return: List of (keys, valid) tuples, with non-minimizers not valid.
+    '''
+    if minimizer_window is None:
+        return windows
+    upper = to_str(seq).upper()
+    if upper == to_str(seq):
+        upper_windows = windows
+    else:
+        upper_windows = frame_windows(upper, [k], nucleotides=nucleotides)[k]
+    return [(keys, valid & minimizer_mask(upper_keys, upper_valid, minimizer_window))
+            for (keys, valid), (upper_keys, upper_valid) in zip(windows, upper_windows)]
+
+
+def hit_coordinates(positions, frame, k, length, nucleotides=False):
+    '''Map window positions in a frame to sequence coordinates.
+
+    :param positions: Array of window positions in the frame.
+    :param frame: Frame number, forward frames are even.
+    :param k: Term length in residues.
+    :param length: Length of input sequence.
+    :param nucleotides: If True, frame is a translation.
+    :return: Tuple of (hit positions, first covered positions, span).
+    '''
+    if not nucleotides:
+        return positions, positions, k
+    offset = int(frame/2)
+    if frame%2 == 0:
+        positions = positions*3 + offset
+        starts = positions
+    else:
+        # reverse frames are translated from seq[offset:offset+coding_length]
+        coding_length = ((length - offset)//3)*3
+        positions = offset + coding_length - 1 - positions*3
+        starts = positions - k*3 + 1
+    return positions, starts, k*3
+
+
+def add_hit_weights(weightarr, starts, span, weights):
+    '''Raise per-residue weights to at least the weight of covering hits.
+
+    :param weightarr: Per-residue weight array, modified in place.
+    :param starts: Array of first covered positions.
+    :param span: Number of positions covered by each hit.
+    :param weights: Array of hit weights.
+    :return: None
+    '''
+    covered = (starts[:, np.newaxis] + np.arange(span)).ravel()
+    in_seq = (covered >= 0) & (covered < len(weightarr))
+    np.maximum.at(weightarr, covered[in_seq],
+                  np.repeat(weights, span)[in_seq])
+
+
+def coverage_and_divergence(weightarr, n_sets):
+    '''Calculate per-gene coverage and divergence.
+
+    :param weightarr: Per-residue weight array.
+    :param n_sets: Number of sets in signature set.
+    :return: Tuple of (coverage, divergence).
+    '''
+    nonzero = weightarr > 0
+    coverage = nonzero.astype(int).mean()
+    if coverage > 0.0:
+        divergence = (1. - weightarr[nonzero]/n_sets).mean()
+    else:
+        divergence = np.nan # avoid warning on mean if no signatures found
+    return coverage, divergence
+
+
+def search_sequence(searchers, key, seq, nucleotides=False):
+    '''Search one sequence with one or more searchers.
+
+    Frames are translated once, and windows are packed once per distinct k.
+    Searchers of sampled signatures see only minimizer windows.
+
+    :param searchers: List of PeptideSignatureSearcher objects.
+    :param key: Sequence key.
+    :param seq: Sequence string.
+    :param nucleotides: If True, do 6-frame translation.
+    :return: None
+    '''
+    if len(seq) == 0:
+        logger.warning('  Empty sequence with key "%s".', key)
+        return
+    windows = frame_windows(seq, [searcher.k for searcher in searchers],
+                            nucleotides=nucleotides)
+    for searcher in searchers:
+        searcher.search_windows(key, seq,
+                                sample_frame_windows(seq, windows[searcher.k],
+                                                     searcher.k,
+                                                     searcher.index.minimizer_window,
+                                                     nucleotides=nucleotides))
+
+
+def search_set_sequence(searchers, fasta, key, nucleotides):
+    '''Read and search one record, timing and counting each.
+
+    :param searchers: List of PeptideSignatureSearcher objects.
+    :param fasta: Fasta object.
+    :param key: Record key.
+    :param nucleotides: If True, do 6-frame translation.
+    :return: None
+    '''
+    with stage('read'):
+        seq = str(fasta[key])
+    count('records')
+    count('residues', len(seq))
+    with stage('search'):
+        search_sequence(searchers, key, seq, nucleotides=nucleotides)
 
 #
 # Classes begin here.
 #
+class FootprintWriter(object):
+    '''Write signature footprints as FASTA records of hex weight strings.
+    '''
+    def __init__(self, path, line_length=FASTA_LINE_LENGTH):
+        self.path = path
+        self.line_length = line_length
+        self.fh = open_output(path)
+
+
+    def write(self, header, weight_str):
+        '''Write a single footprint record.
+
+        :param header: FASTA header line, without '>'.
+        :param weight_str: Weight string.
+        :return: None
+        '''
+        n = self.line_length
+        self.fh.write('>' + header + '\n')
+        self.fh.write(''.join([weight_str[i:i+n] + '\n'
+                               for i in range(0, len(weight_str), n)]))
+
+
+    def close(self):
+        self.fh.close()
+
+
 class PeptideSignatureSearcher(object):
     '''Find peptide signatures in sequences.
     '''
-    def __init__(self, filestem, sig_frame, k, n_sets, genome_size,
-                 nucleotides=False):
+    def __init__(self, filestem, index, genome_size,
+                 nucleotides=False, hit_format='tsv', mismatches=False):
         self.filestem = filestem
-        self.k = k
-        self.sig_frame = sig_frame
-        self.n_sets = n_sets
+        self.index = index
+        self.k = index.k
+        self.n_sets = index.n_sets
         self.genome_size = genome_size
         self.nucleotide_input = nucleotides
-        #
-        self.signatures = np.array(sig_frame.index, dtype=np.dtype(('S%d' % (self.k))))
-        self.signatures.sort()
+        self.hit_format = hit_format
+        self.mismatches = mismatches
         logger.info('%d %d-mer terms defined in signature file.',
-                     len(self.signatures), k)
+                     len(self.index), self.k)
+        if self.mismatches:
+            self.index.neighborhood()
+            logger.info('One-substitution hits will be reported separately.')
         # attributes to be initialized per set
         self.input_dict = None
-        self.counter = None
+        self.counts = None
         self.code = None
         self.residues_read = None
         self.dir = None
         self.coverage = None
         self.divergence = None
         self.n_seqs = None
+        self.n_mismatch_hits = None
+        self.hitwriter = None
+        self.footprintwriter = None
         # per-gene attributes
         self.weightarr = None
+        self.gene_index = None
+        self.gene_mismatch_hits = None
+
+    def output_paths(self, dir):
+        '''Paths of the outputs written for a set, less footprints and plots.
+
+        :param dir: Set directory.
+        :return: List of paths.
+        '''
+        paths = [os.path.join(dir, self.filestem + suffix)
+                 for suffix in ['_genestats.tsv',
+                                '_sigcounts.tsv',
+                                '_coveragehist.tsv',
+                                '_divergencehist.tsv']]
+        if self.hit_format == 'binary':
+            paths.append(hit_table_dir(dir, self.filestem))
+        else:
+            paths.append(os.path.join(dir, self.filestem + '_siglist.tsv'))
+        return paths
 
-    def init_set(self, input_dict, code, dir):
+
+    def init_set(self, input_dict, code, dir, footprintpath=None, n_recs=0):
         global config_obj
         self.input_dict = input_dict
         self.code = code
-        self.counter = Counter()
+        self.counts = np.zeros(len(self.index), dtype=np.int64)
         self.residues_read = 0
         self.n_seqs = 0
-        self.coverage = []
-        self.divergence = []
+        self.n_mismatch_hits = 0
+        self.coverage = np.zeros(n_recs, dtype=np.float64)
+        self.divergence = np.zeros(n_recs, dtype=np.float64)
         self.sigcountpath = os.path.join(dir, self.filestem + '_sigcounts.tsv')
+        if footprintpath is not None:
+            logger.debug('Writing footprints to "%s".', footprintpath)
+            self.footprintwriter = FootprintWriter(footprintpath)
         #
         # Signature list initialization
         #
-        siglistpath = os.path.join(dir, self.filestem + '_siglist.tsv')
-        self.siglistfh = open(siglistpath, 'wt')
-        self.siglistwriter = csv.DictWriter(self.siglistfh,
-                                            fieldnames=['signature',
-                                                        'key',
-                                                        'length',
-                                                        'position',
-                                                        'intersections',
-                                                        'max_count',
-                                                        'frame'],
-                                            delimiter='\t')
-        self.siglistwriter.writeheader()
+        if self.hit_format == 'binary':
+            self.hitwriter = HitTableWriter(hit_table_dir(dir, self.filestem),
+                                            mismatches=self.mismatches)
+        else:
+            siglistpath = os.path.join(dir, self.filestem + '_siglist.tsv')
+            self.siglistfh = open_output(siglistpath)
+            siglist_fields = SIGLIST_FIELDS[:]
+            if self.mismatches:
+                siglist_fields.append('mismatches')
+            self.siglistwriter = csv.DictWriter(self.siglistfh,
+                                                fieldnames=siglist_fields,
+                                                delimiter='\t')
+            self.siglistwriter.writeheader()
         #
         # Gene list initialization
         #
         genestatspath = os.path.join(dir, self.filestem + '_genestats.tsv')
-        self.genestatsfh = open(genestatspath, 'wt')
+        self.genestatsfh = open_output(genestatspath)
+        genestats_fields = ['key', 'length', 'coverage', 'divergence']
+        if self.mismatches:
+            genestats_fields.append('mismatch_hits')
         self.genestatswriter = csv.DictWriter(self.genestatsfh,
-                                              fieldnames=['key',
-                                                          'length',
-                                                          'coverage',
-                                                          'divergence'],
+                                              fieldnames=genestats_fields,
                                               delimiter='\t')
         self.genestatswriter.writeheader()
         #
@@ -109,108 +334,144 @@ class PeptideSignatureSearcher(object):
                                                config_obj.config_dict['plot_type'])
 
 
-    def _count_matches(self, match, terms, key, frame):
-        match_positions = np.where(terms == match)[0]
-        forwards = bool(frame%2)
-        offset = int(frame/2)
-        if self.nucleotide_input:
-            if forwards:
-                match_positions = match_positions*3 + offset
-                k = self.k * 3
-            else:
-                match_positions = len(self.seq) - 1 - match_positions*3 - offset
-                k = self.k * -3
-        else:
-            k = self.k
-        match_str = to_str(match)
-        match_count = len(match_positions)
-        self.counter[match_str] += match_count
-        sig_stats = self.sig_frame.loc[match_str]
-        intersections = sig_stats['intersections']
-        max_count = sig_stats['max_count']
-        for pos in match_positions:
-            self.siglistwriter.writerow({
-                    'signature': to_str(match),
-                    'key': key,
-                    'length': len(self.seq),
-                    'position': pos,
-                    'intersections': intersections,
-                    'max_count': max_count,
-                    'frame': frame})
-            for i in range(pos, pos+k):
-                self.weightarr[i] = max(self.weightarr[i], intersections)
+    def _write_hits(self, ordinals, positions, key, frame, mismatches=0):
+        if self.hitwriter is not None:
+            self.hitwriter.add_hits(ordinals, self.gene_index, positions, frame,
+                                    mismatches=mismatches)
+            return
+        signatures = self.index.signatures[ordinals]
+        intersections = self.index.intersections[ordinals]
+        max_counts = self.index.max_count[ordinals]
+        length = len(self.seq)
+        rows = [{'signature': to_str(signatures[i]),
+                 'key': key,
+                 'length': length,
+                 'position': positions[i],
+                 'intersections': intersections[i],
+                 'max_count': max_counts[i],
+                 'frame': frame} for i in range(len(ordinals))]
+        if self.mismatches:
+            for row in rows:
+                row['mismatches'] = mismatches
+        self.siglistwriter.writerows(rows)
+
+
+    def _count_matches(self, ordinals, positions, key, frame):
+        positions, starts, span = hit_coordinates(positions, frame, self.k,
+                                                  len(self.seq),
+                                                  nucleotides=self.nucleotide_input)
+        np.add.at(self.counts, ordinals, 1)
+        self._write_hits(ordinals, positions, key, frame)
+        add_hit_weights(self.weightarr, starts, span,
+                        self.index.intersections[ordinals])
+
+
+    def _count_mismatches(self, ordinals, positions, key, frame):
+        # one-substitution hits are reported but not counted or weighted
+        positions, starts, span = hit_coordinates(positions, frame, self.k,
+                                                  len(self.seq),
+                                                  nucleotides=self.nucleotide_input)
+        self.n_mismatch_hits += len(ordinals)
+        self.gene_mismatch_hits += len(ordinals)
+        self._write_hits(ordinals, positions, key, frame, mismatches=1)
 
 
     def _init_weightarr(self, seq):
         self.seq = seq
         self.weightarr = np.zeros(len(self.seq), dtype=np.int32)
+        self.gene_mismatch_hits = 0
 
 
     def _write_weightstats(self, key):
         # calculate per-gene stats
-        nonzero = self.weightarr > 0
-        coverage = nonzero.astype(int).mean()
-        self.coverage.append(coverage)
-        if coverage > 0.0:
-            divergence = (1. - self.weightarr[nonzero]/self.n_sets).mean()
-        else:
-            divergence = np.nan # avoid warning on mean if no signatures found
-        self.divergence.append(divergence)
-        self.genestatswriter.writerow({
-            'key': key,
-            'length':len(self.seq),
-            'coverage': coverage,
-            'divergence':divergence})
+        coverage, divergence = coverage_and_divergence(self.weightarr, self.n_sets)
+        if self.n_seqs > len(self.coverage):
+            new_size = max(2*len(self.coverage), self.n_seqs)
+            self.coverage = np.resize(self.coverage, new_size)
+            self.divergence = np.resize(self.divergence, new_size)
+        self.coverage[self.n_seqs-1] = coverage
+        self.divergence[self.n_seqs-1] = divergence
+        genestats = {'key': key,
+                     'length':len(self.seq),
+                     'coverage': coverage,
+                     'divergence':divergence}
+        if self.mismatches:
+            genestats['mismatch_hits'] = self.gene_mismatch_hits
+        self.genestatswriter.writerow(genestats)
         #
-        weight_str = ''.join(['%x' %i for i in self.weightarr])
-        if isinstance(self.seq, str):  # strings need to have whole length set
-            self.seq = weight_str
-        else:  # may be MutableSeq that needs lengths
-            end = len(self.seq)
-            self.seq[:end] = weight_str[:end]
+        if self.footprintwriter is not None:
+            try:
+                header = self.input_dict[key].long_name
+            except AttributeError:
+                header = key
+            self.footprintwriter.write(header, weight_string(self.weightarr))
 
 
     def search_as_peptide(self, key):
-        s = self.input_dict[key]
-        if len(s) == 0:
-            logger.warn('  Empty sequence with key "%s".', key)
-            return
+        search_sequence([self], key, str(self.input_dict[key]),
+                        nucleotides=self.nucleotide_input)
+
+
+    def search_windows(self, key, s, frame_windows):
+        '''Match packed windows of all frames of one sequence.
+
+        :param key: Sequence key.
+        :param s: Sequence string.
+        :param frame_windows: List of (keys, valid) tuples, in frame order.
+        :return: None
+        '''
         self.n_seqs +=1
         self.residues_read += len(s)
         self._init_weightarr(s)
-        if self.nucleotide_input: # do 6-frame translation
-            seq_bytes_list = []
-            seq = to_bytes(str(s))
-            length = len(seq)
-            for offset in range(3): # three bases in a codon
-                DNA = Seq(to_str(seq[offset:offset+int((length-offset)/3)*3]), generic_dna)
-                seq_bytes_list.append(DNA.translate())
-                seq_bytes_list.append(DNA.reverse_complement().translate())
-        else:
-            seq_bytes_list = [to_bytes(str(s))]
-        for frame, seq_bytes in enumerate(seq_bytes_list):
-            terms = np.array([to_str(seq_bytes[i:i + self.k]) for i in range(len(seq_bytes) - self.k)],
-                             dtype=np.dtype(('S%d' % (self.k))))
-            unique_terms = np.unique(terms)
-            for match in np.intersect1d(self.signatures, unique_terms, assume_unique=True):
-                self._count_matches(match, terms, key, frame)
-            self._write_weightstats(key)
+        if self.hitwriter is not None:
+            self.gene_index = self.hitwriter.add_gene(key, len(s))
+        for frame, (keys, valid) in enumerate(frame_windows):
+            ordinals, found = self.index.lookup(keys)
+            positions = np.flatnonzero(found & valid)
+            count('hits', len(positions))
+            if len(positions):
+                self._count_matches(ordinals[positions], positions, key, frame)
+            if self.mismatches:
+                inexact = np.flatnonzero(valid & ~found)
+                query_indexes, mismatch_ordinals = self.index.lookup_one_mismatch(keys[inexact])
+                count('mismatch_hits', len(query_indexes))
+                if len(query_indexes):
+                    self._count_mismatches(mismatch_ordinals, inexact[query_indexes],
+                                           key, frame)
+        self._write_weightstats(key)
 
 
     def close_set(self):
-        self.siglistfh.close()
-        self.genestatsfh.close()
+        with stage('write'):
+            if self.hitwriter is not None:
+                self.hitwriter.close(self.index.signatures,
+                                     self.index.intersections,
+                                     self.index.max_count,
+                                     self.k)
+                self.hitwriter = None
+            else:
+                self.siglistfh.close()
+            if self.footprintwriter is not None:
+                self.footprintwriter.close()
+                self.footprintwriter = None
+            self.genestatsfh.close()
         logger.info('   %d sequences, %d residues read in %s.',
                     self.n_seqs, self.residues_read, self.code)
+        if self.mismatches:
+            logger.info('   %d one-substitution hits, not included in stats.',
+                        self.n_mismatch_hits)
         if self.genome_size is None:
             self.genome_size = self.residues_read*RESIDUES_TO_BASES
+        self.coverage = self.coverage[:self.n_seqs]
+        self.divergence = self.divergence[:self.n_seqs]
         logger.info('   Mean per-gene coverage is %.2f%%.',
-                    np.array(self.coverage).mean()*100.)
+                    self.coverage.mean()*100.)
         logger.info('   Genome size for frequency calculations is %d bp.',
                     self.genome_size)
-        most_common = self.counter.most_common()
-        if len(most_common) >0:
-            top_sig, top_freq = most_common[0]
+        if self.counts.any():
+            top_ordinal = np.argmax(self.counts)
+            top_freq = self.counts[top_ordinal]
+            top_sig = to_str(self.index.signatures[top_ordinal])
         else: # no signatures found
             top_sig = '""'
             top_freq = 0
@@ -218,51 +479,42 @@ class PeptideSignatureSearcher(object):
                     top_sig,
                     top_freq,
                     top_freq/self.genome_size)
-        signatures = []
-        counts = []
-        count_freqs = []
-        sig_freqs = []
-        max_counts = []
-        for signature, count in most_common:
-            signatures.append(signature)
-            counts.append(count)
-            count_freqs.append(count/self.genome_size)
-            sig_stats = self.sig_frame.loc[signature]
-            sig_freqs.append(float(sig_stats['intersections'])/self.n_sets)
-            max_counts.append(sig_stats['max_count'])
+        # found signatures in order of decreasing count
+        found = np.flatnonzero(self.counts)
+        found = found[np.argsort(-self.counts[found], kind='mergesort')]
+        counts = self.counts[found]
         #
         # write signature counts
         #
         logger.debug('Writing signature counts file "%s".', self.sigcountpath)
-        pd.DataFrame({'counts': counts,
-                      'count_freq':count_freqs,
-                      'sig_weight': sig_freqs,
-                      'max_count':max_counts},
-                    columns=['counts',
-                             'count_freq',
-                             'max_count',
-                             'sig_weight'],
-                     index=signatures
-        ).to_csv(self.sigcountpath, sep='\t')
+        with stage('write'), open_output(self.sigcountpath) as fh:
+            pd.DataFrame({'counts': counts,
+                          'count_freq': counts/self.genome_size,
+                          'sig_weight': self.index.intersections[found]/float(self.n_sets),
+                          'max_count': self.index.max_count[found]},
+                        columns=['counts',
+                                 'count_freq',
+                                 'max_count',
+                                 'sig_weight'],
+                         index=[to_str(sig) for sig in self.index.signatures[found]]
+            ).to_csv(fh, sep='\t')
         #
         # write and plot coverage histogram
         #
-        coverage_hist, bins = np.histogram(np.array(self.coverage)*100.,
+        coverage_hist, bins = np.histogram(self.coverage*100.,
                                                     bins=HISTOGRAM_BINS,
                                                     range=[0.,100.])
         bin_centers = bins[:-1]  # zero should really be zero
         coverage_hist = coverage_hist*100./len(self.coverage)
         logger.debug('Writing coverage histogram to "%s".', self.coveragehistpath)
-        pd.Series(coverage_hist, index=bin_centers).to_csv(self.coveragehistpath,
-                                                  sep='\t',
-                                                  float_format='%.3f')
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        ax.plot(bin_centers, coverage_hist)
-        plt.title('Coverage Distribution for %s' % (self.code.capitalize()))
-        plt.xlabel('Percent Covered')
-        plt.ylabel('Percent of Genes')
-        plt.savefig(self.coverageplotpath)
+        with stage('write'), open_output(self.coveragehistpath) as fh:
+            pd.Series(coverage_hist, index=bin_centers).to_csv(fh,
+                                                      sep='\t',
+                                                      float_format='%.3f')
+        plot_lines(self.coverageplotpath, [{'x': bin_centers, 'y': coverage_hist}],
+                   'Coverage Distribution for %s' % (self.code.capitalize()),
+                   'Percent Covered',
+                   'Percent of Genes')
         #
         # write divergence histogram
         #
@@ -273,16 +525,14 @@ class PeptideSignatureSearcher(object):
         bin_centers = (bins[:-1] + bins[1:]) / 2.
         divergence_hist = divergence_hist * 100. / len(self.divergence)
         logger.debug('Writing divergence histogram to "%s".', self.divergencehistpath)
-        pd.Series(coverage_hist, index=bin_centers).to_csv(self.divergencehistpath,
-                                                           sep='\t',
-                                                           float_format='%.3f')
-        fig = plt.figure()
-        ax = fig.add_subplot(111)
-        ax.plot(bin_centers, divergence_hist)
-        plt.title('Divergence Distribution for %s' % (self.code.capitalize()))
-        plt.xlabel('Signature Divergence Score')
-        plt.ylabel('Percent of Genes')
-        plt.savefig(self.divergenceplotpath)
+        with stage('write'), open_output(self.divergencehistpath) as fh:
+            pd.Series(divergence_hist, index=bin_centers).to_csv(fh,
+                                                               sep='\t',
+                                                               float_format='%.3f')
+        plot_lines(self.divergenceplotpath, [{'x': bin_centers, 'y': divergence_hist}],
+                   'Divergence Distribution for %s' % (self.code.capitalize()),
+                   'Signature Divergence Score',
+                   'Percent of Genes')
 
 #
 # Cli commands begin here.
@@ -292,13 +542,56 @@ class PeptideSignatureSearcher(object):
               help='Genome size in bp for frequency calculations')
 @click.option('--nucleotides/--no-nucleotides', default=False,
               help='Input file is nucleotides.')
+@click.option('--hit_format', type=click.Choice(HIT_FORMATS), default='tsv',
+              show_default=True,
+              help='Write hits as siglist TSV or as a binary hit table.')
+@click.option('--footprints/--no-footprints', default=True, show_default=True,
+              help='Write per-residue signature weights as FASTA.')
+@click.option('--classify', is_flag=True, default=False,
+              help='Write only a per-sequence set assignment table.')
+@click.option('--mismatches/--no-mismatches', default=False, show_default=True,
+              help='Also report hits with one substitution.')
+@click.option('--bloom/--no-bloom', default=False, show_default=True,
+              help='Reject windows with a Bloom filter before exact lookup.')
 @click.argument('infilename', type=str)
-@click.argument('filestem', type=str)
+@click.argument('filestems', type=str)
 @click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
 @log_elapsed_time()
-def search_peptide_occurrances(genome_size, nucleotides, infilename, filestem, setlist):
+def search_peptide_occurrances(genome_size, nucleotides, hit_format, footprints,
+                               classify, mismatches, bloom, infilename, filestems,
+                               setlist):
     '''Find signatures in peptide space.
 
+    FILESTEMS is one signature file stem, or several separated by commas.
+    Input is read and translated once, and windows are generated once per
+    distinct k, for all signature sets.  Outputs are written separately
+    for each stem.
+
+    Binary hit tables are written to the directory INFILESTEM-FILESTEM_hits
+    and may be converted to siglist TSV with convert_hit_table.
+
+    With --classify, each sequence is assigned to the set whose signatures
+    it hits most specifically, and only INFILESTEM-FILESTEM_classes.tsv is
+    written.  This requires presence information recorded by
+    compile_signatures --presence_stem.
+
+    With --mismatches, windows within one substitution of a signature are
+    also reported, with a mismatches column of 1 in the hit outputs and a
+    per-gene mismatch_hits count.  They do not contribute to coverage,
+    divergence, footprints, or signature counts.
+
+    Searches of a set are skipped if the input file, signature file, and
+    options are unchanged since the outputs were written, unless the
+    global --rebuild option is given.
+
+    If the signatures are minimizers, as from calculate_peptide_terms
+    --minimizer_window, only windows that are minimizers are looked up,
+    so that hits, coverage, and footprints are sampled alike.
+
+    With --bloom, windows are first probed against a Bloom filter of the
+    signatures, and only those that pass are looked up exactly.  Results
+    are unchanged.  The filter stored by compile_signatures --bloom_fpr
+    is used if present, otherwise one is built at startup.
     '''
     global config_obj
     # context inputs
@@ -307,31 +600,42 @@ def search_peptide_occurrances(genome_size, nucleotides, infilename, filestem, s
         logger.info('Only first %d records will be used', user_ctx['first_n'])
     # parameter inputs
     logger.debug('Input file name is "%s".', infilename)
-    logger.info('Signature file stem is "%s".', filestem)
+    filestem_list = [stem for stem in filestems.split(',') if stem != '']
+    if len(set(filestem_list)) != len(filestem_list):
+        logger.error('Signature file stems must not be repeated.')
+        sys.exit(1)
+    logger.info('Signature file stems are %s.',
+                ', '.join(['"%s"' % stem for stem in filestem_list]))
     setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
     logger.info('Searching in %d data sets:', len(setlist))
     #
-    # read signature file
+    # open signature indexes
     #
     summarydir = config_obj.config_dict['summary']['dir']
-    sigfilepath = os.path.join(summarydir, filestem + '_terms.tsv')
-    if not os.path.exists(sigfilepath):
-        logger.error('Signature file "%s" does not exist.', sigfilepath)
-        sys.exit(1)
-    logger.debug('Reading signature file "%s".', sigfilepath)
-    sig_frame = pd.read_csv(sigfilepath,
-                            usecols=[0, 1, 3],
-                            index_col=0,
-                            sep='\t')
-    k = len(sig_frame.index[0])
-    n_sets = max(sig_frame['intersections'])
-    outfilestem = os.path.splitext(infilename)[0]+'-'+filestem
-    searcher = PeptideSignatureSearcher(outfilestem,
-                                        sig_frame,
-                                        k,
-                                        n_sets,
-                                        genome_size,
-                                        nucleotides=nucleotides)
+    instem = split_fasta_ext(infilename)[0]
+    searchers = []
+    for filestem in filestem_list:
+        index = open_signature_index(summarydir, filestem)
+        if bloom:
+            bloom_filter = index.enable_bloom_filter()
+            logger.debug('Bloom filter for "%s" has %d bits and %d hashes.',
+                         filestem, len(bloom_filter), bloom_filter.n_hashes)
+        if classify:
+            searchers.append(SignatureClassifier(instem+'-'+filestem, index))
+        else:
+            searchers.append(PeptideSignatureSearcher(instem+'-'+filestem,
+                                                      index,
+                                                      genome_size,
+                                                      nucleotides=nucleotides,
+                                                      hit_format=hit_format,
+                                                      mismatches=mismatches))
+    params = {'genome_size': genome_size,
+              'nucleotides': nucleotides,
+              'hit_format': hit_format,
+              'footprints': footprints,
+              'classify': classify,
+              'mismatches': mismatches,
+              'first_n': user_ctx['first_n']}
     #
     # loop on sets
     #
@@ -341,18 +645,40 @@ def search_peptide_occurrances(genome_size, nucleotides, infilename, filestem, s
         if not os.path.exists(fastapath):
             logger.error('Input file "%s" does not exist.', fastapath)
             sys.exit(1)
-        footprintpath = os.path.join(dir, filestem+'_footprints.faa')
-        shutil.copy(fastapath, footprintpath)
-        fasta = pyfaidx.Fasta(footprintpath, mutable=True)
-        searcher.init_set(fasta, calc_set, dir)
+        #
+        # skip searches whose outputs are up to date
+        #
+        set_searches = []
+        for filestem, searcher in zip(filestem_list, searchers):
+            if footprints and not classify:
+                footprintpath = os.path.join(dir, filestem+'_footprints.faa')
+                outputs = searcher.output_paths(dir) + [footprintpath]
+            else:
+                footprintpath = None
+                outputs = searcher.output_paths(dir)
+            manifest = OutputManifest(manifest_path(dir, searcher.filestem),
+                                      [fastapath,
+                                       os.path.join(summarydir, filestem + '_terms.tsv')],
+                                      params,
+                                      outputs)
+            if manifest.is_up_to_date():
+                logger.info('   %s with %s is up to date, skipping.', calc_set, filestem)
+                continue
+            manifest.invalidate()
+            set_searches.append((filestem, searcher, footprintpath, manifest))
+        if len(set_searches) == 0:
+            continue
+        set_searchers = [searcher for filestem, searcher, footprintpath, manifest
+                         in set_searches]
+        fasta = open_fasta(fastapath)
         #
         # iterate on genes in FASTA file
         #
-        if user_ctx['first_n']:
-            keys = list(fasta.keys())[:user_ctx['first_n']]
-        else:
-            keys = fasta.keys()
-        n_recs = len(keys)
+        keys = fasta_keys(fasta, user_ctx['first_n'])
+        n_recs = n_fasta_keys(keys)
+        for filestem, searcher, footprintpath, manifest in set_searches:
+            searcher.init_set(fasta, calc_set, dir, footprintpath=footprintpath,
+                              n_recs=n_recs or 0)
         #
         # loop on genes, with or without progress bars
         #
@@ -360,11 +686,17 @@ def search_peptide_occurrances(genome_size, nucleotides, infilename, filestem, s
             with click.progressbar(keys, label='   %s genes processed' % calc_set,
                                    length=n_recs) as bar:
                 for key in bar:
-                    searcher.search_as_peptide(key)
+                    search_set_sequence(set_searchers, fasta, key, nucleotides)
         else:
             logger.info('  %s: ', calc_set)
             for key in keys:
-                searcher.search_as_peptide(key)
-        searcher.close_set()
+                search_set_sequence(set_searchers, fasta, key, nucleotides)
+        for filestem, searcher, footprintpath, manifest in set_searches:
+            if len(searchers) > 1:
+                logger.info('  %s with %s:', calc_set, filestem)
+            searcher.close_set()
+            for path in manifest.outputs:
+                count_written(path)
+            manifest.write()
         fasta.close()
-
+        count_read(fastapath)
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+'''Long-running signature search server.
+
+The serve command loads one or more signature indexes once and answers
+search requests over HTTP on localhost or on a Unix socket.  Requests
+are gathered into batches that are searched by a pool of worker
+processes.
+
+Endpoints:
+    POST /search   JSON body {"sequences": [{"key": ..., "sequence": ...}],
+                   "nucleotides": false}, returns hits, coverage, and
+                   divergence per sequence for each signature set.
+    GET /metrics   Request counts, latency percentiles, and throughput.
+    GET /health    Signature sets loaded.
+'''
+
+# standard library imports
+import os
+import json
+import time
+import queue
+import threading
+import socketserver
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# external packages
+import numpy as np
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger
+from .packing import unpack_keys
+from .search import (frame_windows, sample_frame_windows, hit_coordinates,
+                     add_hit_weights, coverage_and_divergence)
+from .sigindex import open_signature_index
+
+#
+# Global constants
+#
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8047
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_BATCH_SIZE = 256 # sequences
+DEFAULT_BATCH_WAIT = 5 # milliseconds
+DEFAULT_LATENCY_WINDOW = 10000 # requests kept for percentiles
+RECENT_SECONDS = 60
+MAX_REQUEST_BYTES = 1 << 30
+_WORKER_INDEXES = None # signature indexes in worker processes
+
+#
+# Helper functions begin here.
+#
+def sequence_report(index, seq, windows, nucleotides=False):
+    '''Find signature hits and stats for one sequence.
+
+    :param index: SignatureIndex object.
+    :param seq: Sequence string.
+    :param windows: List of (keys, valid) tuples in frame order.
+    :param nucleotides: If True, frames are translations.
+    :return: Dictionary of hits, coverage, and divergence.
+    '''
+    if len(seq) == 0:
+        return {'hits': [], 'coverage': 0., 'divergence': None}
+    weightarr = np.zeros(len(seq), dtype=np.int32)
+    hits = []
+    for frame, (keys, valid) in enumerate(windows):
+        ordinals, found = index.lookup(keys)
+        positions = np.flatnonzero(found & valid)
+        if len(positions) == 0:
+            continue
+        ordinals = ordinals[positions]
+        positions, starts, span = hit_coordinates(positions, frame, index.k,
+                                                  len(seq),
+                                                  nucleotides=nucleotides)
+        intersections = index.intersections[ordinals]
+        max_counts = index.max_count[ordinals]
+        add_hit_weights(weightarr, starts, span, intersections)
+        terms = unpack_keys(index.keys[ordinals], index.k)
+        hits += [{'signature': to_str(terms[i]),
+                  'position': int(positions[i]),
+                  'frame': frame,
+                  'intersections': int(intersections[i]),
+                  'max_count': int(max_counts[i])}
+                 for i in range(len(ordinals))]
+    coverage, divergence = coverage_and_divergence(weightarr, index.n_sets)
+    if np.isnan(divergence):
+        divergence = None
+    else:
+        divergence = float(divergence)
+    return {'hits': hits,
+            'coverage': float(coverage),
+            'divergence': divergence}
+
+
+def check_records(records):
+    '''Check the sequence records of a search request.
+
+    :param records: List of dictionaries with 'sequence' and optional 'key'.
+    :return: None, raising ValueError if a record is malformed.
+    '''
+    if not isinstance(records, list):
+        raise ValueError('"sequences" must be a list of records')
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError('sequence record %d is not an object' % i)
+        if not isinstance(record.get('sequence'), str):
+            raise ValueError('sequence record %d has no "sequence" string' % i)
+        if not isinstance(record.get('key', ''), str):
+            raise ValueError('"key" of sequence record %d is not a string' % i)
+
+
+def search_records(indexes, records, nucleotides=False):
+    '''Search a list of sequence records against signature indexes.
+
+    :param indexes: List of (filestem, SignatureIndex) tuples.
+    :param records: List of dictionaries with 'key' and 'sequence'.
+    :param nucleotides: If True, do 6-frame translation.
+    :return: List of result dictionaries, one per record.
+    '''
+    ks = [index.k for filestem, index in indexes]
+    results = []
+    for record in records:
+        seq = str(record['sequence'])
+        if len(seq) > 0:
+            windows = frame_windows(seq, ks, nucleotides=nucleotides)
+        else:
+            windows = dict([(k, []) for k in ks])
+        results.append({'key': record.get('key', ''),
+                        'length': len(seq),
+                        'signatures': dict([(filestem,
+                                             sequence_report(index, seq,
+                                                             sample_frame_windows(
+                                                                 seq, windows[index.k],
+                                                                 index.k,
+                                                                 index.minimizer_window,
+                                                                 nucleotides=nucleotides),
+                                                             nucleotides=nucleotides))
+                                            for filestem, index in indexes])})
+    return results
+
+
+def _init_worker(summarydir, filestems):
+    '''Open signature indexes in a worker process.
+    '''
+    global _WORKER_INDEXES
+    _WORKER_INDEXES = [(filestem, open_signature_index(summarydir, filestem))
+                       for filestem in filestems]
+
+
+def _search_batch(batch):
+    '''Search a batch of requests in a worker process.
+
+    Requests are searched separately, so that one that fails does not
+    fail the others batched with it.
+
+    :param batch: List of (nucleotides, records) tuples.
+    :return: List of (results, error) tuples, one per request, where
+             error is a message if the request failed, else None.
+    '''
+    searched = []
+    for nucleotides, records in batch:
+        try:
+            searched.append((search_records(_WORKER_INDEXES, records,
+                                            nucleotides=nucleotides), None))
+        except Exception as exc:
+            searched.append((None, '%s: %s' % (exc.__class__.__name__, exc)))
+    return searched
+
+#
+# Classes begin here.
+#
+class ServerMetrics(object):
+    '''Thread-safe request counters, latencies, and throughput.
+    '''
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.latencies = deque(maxlen=window)
+        self.recent = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_sequences = 0
+        self.n_residues = 0
+        self.n_batches = 0
+        self.n_batched_sequences = 0
+
+
+    def record_request(self, latency, n_sequences, n_residues):
+        with self.lock:
+            now = time.time()
+            self.n_requests += 1
+            self.n_sequences += n_sequences
+            self.n_residues += n_residues
+            self.latencies.append(latency)
+            self.recent.append((now, n_sequences, n_residues))
+
+
+    def record_error(self):
+        with self.lock:
+            self.n_errors += 1
+
+
+    def record_batch(self, n_sequences):
+        with self.lock:
+            self.n_batches += 1
+            self.n_batched_sequences += n_sequences
+
+
+    def snapshot(self):
+        '''Return current metrics as a dictionary.
+        '''
+        with self.lock:
+            now = time.time()
+            uptime = now - self.start_time
+            latencies = np.array(self.latencies, dtype=np.float64)*1000.
+            recent = [entry for entry in self.recent
+                      if entry[0] >= now - RECENT_SECONDS]
+            recent_span = min(uptime, RECENT_SECONDS)
+            metrics = {'uptime_s': uptime,
+                       'requests': self.n_requests,
+                       'errors': self.n_errors,
+                       'sequences': self.n_sequences,
+                       'residues': self.n_residues,
+                       'batches': self.n_batches,
+                       'mean_batch_sequences': (self.n_batched_sequences/self.n_batches
+                                                if self.n_batches else 0.),
+                       'throughput': {
+                           'requests_per_s': self.n_requests/uptime,
+                           'sequences_per_s': self.n_sequences/uptime,
+                           'residues_per_s': self.n_residues/uptime,
+                           'recent_requests_per_s': len(recent)/recent_span,
+                           'recent_sequences_per_s': sum([entry[1] for entry in recent])/recent_span,
+                           'recent_residues_per_s': sum([entry[2] for entry in recent])/recent_span},
+                       'latency_ms': {}}
+            if len(latencies):
+                p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+                metrics['latency_ms'] = {'p50': p50,
+                                         'p90': p90,
+                                         'p99': p99,
+                                         'mean': latencies.mean(),
+                                         'max': latencies.max()}
+        return metrics
+
+
+class RequestBatcher(object):
+    '''Gather search requests into batches for the worker pool.
+    '''
+    def __init__(self, executor, metrics,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 batch_wait=DEFAULT_BATCH_WAIT):
+        self.executor = executor
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait/1000.
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, records, nucleotides=False):
+        '''Queue a request.
+
+        :param records: List of sequence records.
+        :param nucleotides: If True, do 6-frame translation.
+        :return: Future for the list of results.
+        '''
+        future = Future()
+        self.queue.put((future, nucleotides, records))
+        return future
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            n_sequences = len(item[2])
+            deadline = time.time() + self.batch_wait
+            while n_sequences < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0.:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                n_sequences += len(item[2])
+            self.metrics.record_batch(n_sequences)
+            self._dispatch(batch)
+
+
+    def _dispatch(self, batch):
+        futures = [future for future, nucleotides, records in batch]
+        work = [(nucleotides, records) for future, nucleotides, records in batch]
+        if self.executor is None:
+            result_future = Future()
+            try:
+                result_future.set_result(_search_batch(work))
+            except Exception as exc:
+                result_future.set_exception(exc)
+        else:
+            result_future = self.executor.submit(_search_batch, work)
+
+        def distribute(done):
+            try:
+                results = done.result()
+            except Exception as exc:
+                for future in futures:
+                    future.set_exception(exc)
+                return
+            for future, (result, error) in zip(futures, results):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(RuntimeError(error))
+        result_future.add_done_callback(distribute)
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    '''Handle search, metrics, and health requests.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s', format % args)
+
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            self._send_json(200, self.server.metrics.snapshot())
+        elif path == '/health':
+            self._send_json(200, {'status': 'ok',
+                                  'signatures': self.server.signature_info})
+        else:
+            self._send_json(404, {'error': 'unknown path "%s"' % path})
+
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        if path != '/search':
+            self._send_json(404, {'error': 'unknown path "%s"' % path})
+            return
+        start_time = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_REQUEST_BYTES:
+                raise ValueError('request is larger than %d bytes' % MAX_REQUEST_BYTES)
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            records = request['sequences']
+            if isinstance(records, dict):
+                records = [records]
+            check_records(records)
+            nucleotides = bool(request.get('nucleotides', False))
+        except (ValueError, KeyError, TypeError) as exc:
+            self.server.metrics.record_error()
+            self._send_json(400, {'error': 'bad request: %s' % exc})
+            return
+        try:
+            results = self.server.batcher.submit(records,
+                                                 nucleotides=nucleotides).result()
+        except Exception as exc:
+            logger.error('Search failed: %s', exc)
+            self.server.metrics.record_error()
+            self._send_json(500, {'error': str(exc)})
+            return
+        self.server.metrics.record_request(time.time() - start_time,
+                                           len(records),
+                                           sum([result['length'] for result in results]))
+        self._send_json(200, {'results': results})
+
+
+class ThreadingSearchHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingSearchUnixServer(socketserver.ThreadingMixIn,
+                                socketserver.UnixStreamServer):
+    daemon_threads = True
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.option('--host', default=DEFAULT_HOST, show_default=True,
+              help='Address on which to listen.')
+@click.option('--port', default=DEFAULT_PORT, show_default=True,
+              help='Port on which to listen.')
+@click.option('--socket', 'socket_path', default=None, type=click.Path(),
+              help='Listen on a Unix socket at this path instead.')
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Worker processes, 0 to search in the server process.')
+@click.option('--batch_size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Maximum sequences per batch.')
+@click.option('--batch_wait', default=DEFAULT_BATCH_WAIT, show_default=True,
+              help='Milliseconds to wait while filling a batch.')
+@click.argument('filestems', type=str)
+def serve(host, port, socket_path, workers, batch_size, batch_wait, filestems):
+    '''Serve signature searches over a local socket.
+
+    FILESTEMS is one signature file stem, or several separated by commas.
+    Signature indexes are loaded once, and POST requests to /search are
+    batched and searched by a pool of worker processes.  GET /metrics
+    reports latency percentiles and throughput.
+
+    Example:
+        aakbar serve --socket /tmp/aakbar.sock strep10
+    '''
+    global config_obj
+    summarydir = config_obj.config_dict['summary']['dir']
+    filestem_list = [stem for stem in filestems.split(',') if stem != '']
+    indexes = [(filestem, open_signature_index(summarydir, filestem))
+               for filestem in filestem_list]
+    signature_info = dict([(filestem, {'k': index.k,
+                                       'n_sets': index.n_sets,
+                                       'n_signatures': len(index)})
+                           for filestem, index in indexes])
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=_init_worker,
+                                       initargs=(summarydir, filestem_list))
+    else:
+        executor = None
+        _init_worker(summarydir, filestem_list)
+    metrics = ServerMetrics()
+    batcher = RequestBatcher(executor, metrics,
+                             batch_size=batch_size,
+                             batch_wait=batch_wait)
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = ThreadingSearchUnixServer(socket_path, SearchRequestHandler)
+        logger.info('Serving %d signature sets on Unix socket "%s".',
+                    len(indexes), socket_path)
+    else:
+        server = ThreadingSearchHTTPServer((host, port), SearchRequestHandler)
+        logger.info('Serving %d signature sets on http://%s:%d/.',
+                    len(indexes), host, port)
+    server.metrics = metrics
+    server.batcher = batcher
+    server.signature_info = signature_info
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Shutting down server.')
+    finally:
+        server.server_close()
+        batcher.close()
+        if executor is not None:
+            executor.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+'''Compiled, memory-mapped signature indexes.
+
+A signature index is a directory next to the signature terms file that
+holds the packed keys of the signatures in sorted order, with the
+intersections and max_count columns as parallel arrays, each in its own
+.npy file so that it can be memory-mapped at search startup.  An optional
+blocked Bloom filter rejects most non-signature windows before the exact
+lookup.
+
+If the signatures were sampled to minimizers, the sampling is recorded
+in the index metadata, so that searches sample their windows alike.
+
+Signatures are indexed as packed keys, so they must be of length at
+most MAX_PACKED_K and of residues in PACKED_ALPHABET.  Compiling stops
+with an error otherwise, rather than leaving signatures out.
+'''
+
+# standard library imports
+import os
+import time
+import shutil
+
+# external packages
+import numpy as np
+import pandas as pd
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .packing import (KEY_DTYPE, PACKING_RADIX, PACKED_ALPHABET, MAX_PACKED_K,
+                      pack_terms, unpack_keys, digit_differences, hash_keys, read_sampling)
+from .metrics import stage, count, count_read, count_written
+from .compression import table_compression
+
+#
+# Global constants
+#
+SIGNATURE_INDEX_VERSION = 1
+NEIGHBORHOOD_ARRAYS = ['left_keys', 'left_order', 'right_keys', 'right_order']
+DEFAULT_BLOOM_FPR = 0.01
+BLOOM_BLOCK_BITS = 64
+BLOOM_BIT_SHIFT = KEY_DTYPE(6) # log2 of BLOOM_BLOCK_BITS
+MAX_BLOOM_HASHES = 10 # bits per key drawn from one 64-bit hash
+OPEN_RETRIES = 5 # tries to open an index being replaced
+OPEN_RETRY_WAIT = 0.1 # seconds
+
+#
+# Helper functions begin here.
+#
+def signature_index_dir(dir, filestem):
+    '''Return the path of the signature index for a file stem.
+
+    :param dir: Summary directory.
+    :param filestem: Signature file stem.
+    :return: Path of index directory.
+    '''
+    return os.path.join(dir, filestem + '_sigindex')
+
+
+def term_file_sampling(termfilepath):
+    '''Read how the terms file at a path was sampled.
+
+    :param termfilepath: Path to terms file.
+    :return: Sampling dictionary, or None if not sampled.
+    '''
+    return read_sampling(os.path.dirname(termfilepath),
+                         os.path.basename(termfilepath)[:-len('_terms.tsv')])
+
+
+def read_term_keys(termfilepath, k):
+    '''Read the terms of a terms file as sorted packed keys.
+
+    :param termfilepath: Path to terms file.
+    :param k: Expected term length.
+    :return: Sorted array of packed keys.
+    '''
+    logger.debug('Reading terms from "%s".', termfilepath)
+    terms = pd.read_csv(termfilepath,
+                        usecols=[0],
+                        sep='\t',
+                        compression=table_compression(termfilepath),
+                        keep_default_na=False).iloc[:, 0].values.astype(str)
+    if len(terms) and len(terms[0]) != k:
+        logger.error('Terms in "%s" are of length %d, expected %d.',
+                     termfilepath, len(terms[0]), k)
+        sys.exit(1)
+    keys, packable = pack_terms(terms, k)
+    return np.sort(keys[packable])
+
+
+def set_presence(keys, k, termfilepaths):
+    '''Find which sets contain each signature.
+
+    :param keys: Array of signature keys.
+    :param k: Term length.
+    :param termfilepaths: List of per-set terms files.
+    :return: Bit matrix of presence, packed along sets.
+    '''
+    presence = np.zeros((len(keys), len(termfilepaths)), dtype=bool)
+    for i, termfilepath in enumerate(termfilepaths):
+        presence[:, i] = np.isin(keys, read_term_keys(termfilepath, k),
+                                 assume_unique=True)
+    return np.packbits(presence, axis=1)
+
+
+def half_key_divisor(k):
+    '''Return the divisor that splits packed keys into left and right halves.
+
+    :param k: Term length.
+    :return: Divisor as a KEY_DTYPE scalar.
+    '''
+    return KEY_DTYPE(PACKING_RADIX**(k - k//2))
+
+
+def neighborhood_arrays(keys, k):
+    '''Sort the left and right halves of signature keys.
+
+    Any term within one substitution of a signature matches it exactly
+    on one of the two halves, so these arrays locate all one-substitution
+    candidates by binary search.
+
+    :param keys: Sorted array of signature keys.
+    :param k: Term length.
+    :return: Dictionary of sorted half keys and their orderings.
+    '''
+    divisor = half_key_divisor(k)
+    arrays = {}
+    for side, halves in [('left', keys // divisor), ('right', keys % divisor)]:
+        order = np.argsort(halves, kind='mergesort')
+        arrays[side + '_keys'] = halves[order]
+        arrays[side + '_order'] = order.astype(np.int64)
+    return arrays
+
+
+def _expand_matches(sorted_halves, order, query_halves):
+    '''Pair each query with every signature whose half key equals it.
+
+    :return: Tuple of (query indexes, signature ordinals).
+    '''
+    starts = np.searchsorted(sorted_halves, query_halves, side='left')
+    counts = np.searchsorted(sorted_halves, query_halves, side='right') - starts
+    query_indexes = np.repeat(np.arange(len(query_halves)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return query_indexes, order[np.repeat(starts, counts) + offsets]
+
+
+def blocked_bloom_fpr(n_keys, n_words, n_hashes):
+    '''Estimate the false-positive rate of a blocked Bloom filter.
+
+    Each key sets n_hashes bits in one 64-bit word, so the rate is
+    averaged over the Poisson-distributed number of keys per word.
+
+    :param n_keys: Number of keys in filter.
+    :param n_words: Number of 64-bit words.
+    :param n_hashes: Number of bits set per key.
+    :return: Estimated false-positive rate.
+    '''
+    if n_keys == 0:
+        return 0.
+    load = float(n_keys)/n_words
+    n_keys_in_word = np.arange(int(load + 10.*np.sqrt(load) + 20.))
+    log_factorial = np.concatenate(([0.], np.cumsum(np.log(n_keys_in_word[1:]))))
+    word_prob = np.exp(n_keys_in_word*np.log(load) - load - log_factorial)
+    bit_set_prob = 1. - (1. - 1./BLOOM_BLOCK_BITS)**(n_keys_in_word*n_hashes)
+    return float((word_prob*bit_set_prob**n_hashes).sum())
+
+
+def bloom_filter_shape(n_keys, fpr):
+    '''Choose the size and number of hashes of a blocked Bloom filter.
+
+    :param n_keys: Number of keys in filter.
+    :param fpr: Target false-positive rate.
+    :return: Tuple of (number of 64-bit words, number of hashes).
+    '''
+    if not 0. < fpr < 1.:
+        logger.error('Bloom filter false-positive rate %g is not between 0 and 1.', fpr)
+        sys.exit(1)
+    n_words = max(1, int(np.ceil(-n_keys*np.log(fpr)/np.log(2.)**2/BLOOM_BLOCK_BITS)))
+    while True:
+        rates = [blocked_bloom_fpr(n_keys, n_words, n_hashes)
+                 for n_hashes in range(1, MAX_BLOOM_HASHES+1)]
+        best = int(np.argmin(rates))
+        if rates[best] <= fpr:
+            return n_words, best + 1
+        n_words = int(np.ceil(n_words*1.1))
+
+
+def bloom_probes(keys, n_words, n_hashes):
+    '''Compute the word and bit mask that a blocked Bloom filter uses for keys.
+
+    :param keys: Array of packed keys.
+    :param n_words: Number of 64-bit words in filter.
+    :param n_hashes: Number of bits set per key.
+    :return: Tuple of (array of word indexes, array of bit masks).
+    '''
+    words = (hash_keys(keys, seed=0) % KEY_DTYPE(n_words)).astype(np.intp)
+    bit_hash = hash_keys(keys, seed=1)
+    bit_mask = KEY_DTYPE(BLOOM_BLOCK_BITS - 1)
+    masks = np.zeros(len(bit_hash), dtype=KEY_DTYPE)
+    for i in range(n_hashes):
+        masks |= KEY_DTYPE(1) << (bit_hash & bit_mask)
+        bit_hash >>= BLOOM_BIT_SHIFT
+    return words, masks
+
+
+def build_bloom_filter(keys, fpr=DEFAULT_BLOOM_FPR):
+    '''Build a blocked Bloom filter of packed keys.
+
+    :param keys: Array of packed keys.
+    :param fpr: Target false-positive rate.
+    :return: Tuple of (array of 64-bit words, number of hashes).
+    '''
+    n_words, n_hashes = bloom_filter_shape(len(keys), fpr)
+    bloom = np.zeros(n_words, dtype=KEY_DTYPE)
+    words, masks = bloom_probes(np.asarray(keys), n_words, n_hashes)
+    np.bitwise_or.at(bloom, words, masks)
+    return bloom, n_hashes
+
+
+def replace_index_dir(tmpdir, indexdir):
+    '''Put a newly-written index directory in place of any old one.
+
+    The new index is written completely before it is moved into place,
+    so that searches opening the index at the same time never see
+    partly-written arrays.  Arrays of the old index stay readable by
+    searches that mapped them before it was removed.  If another process
+    put an index in place first, it is kept and the new one discarded,
+    since both were compiled from the same signatures.
+
+    :param tmpdir: Path of new index directory, next to indexdir.
+    :param indexdir: Path of index directory.
+    :return: None
+    '''
+    olddir = '%s.old-%d' % (indexdir, os.getpid())
+    try:
+        os.rename(indexdir, olddir)
+    except FileNotFoundError:
+        olddir = None
+    try:
+        os.rename(tmpdir, indexdir)
+    except OSError:
+        logger.debug('Index "%s" was replaced by another process.', indexdir)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if olddir is not None:
+        shutil.rmtree(olddir, ignore_errors=True)
+
+
+def compile_signature_index(sigfilepath, indexdir,
+                            presence_paths=None, presence_sets=None,
+                            neighborhood=False, bloom_fpr=None):
+    '''Write a signature index from a signature terms file.
+
+    :param sigfilepath: Path to signature terms file.
+    :param indexdir: Path to output index directory.
+    :param presence_paths: Optional list of per-set terms files from which
+                           the presence of each signature in each set is
+                           recorded.
+    :param presence_sets: Set identifiers corresponding to presence_paths.
+    :param neighborhood: If True, store arrays for one-substitution search.
+    :param bloom_fpr: If not None, store a Bloom filter with this
+                      false-positive rate.
+    :return: Metadata dictionary.
+
+    The index is written to a temporary directory next to indexdir,
+    then moved into place by replace_index_dir.
+    '''
+    logger.debug('Reading signature file "%s".', sigfilepath)
+    with stage('read'):
+        sig_frame = pd.read_csv(sigfilepath,
+                                usecols=[0, 1, 3],
+                                index_col=0,
+                                sep='\t',
+                                compression=table_compression(sigfilepath),
+                                keep_default_na=False)
+    count_read(sigfilepath)
+    k = len(sig_frame.index[0])
+    if k > MAX_PACKED_K:
+        logger.error('All %d signatures in "%s" are %d-mers, longer than the maximum of %d for a signature index.',
+                     len(sig_frame), sigfilepath, k, MAX_PACKED_K)
+        sys.exit(1)
+    n_sets = int(max(sig_frame['intersections']))
+    with stage('pack'):
+        keys, packable = pack_terms(np.array(sig_frame.index,
+                                             dtype=np.dtype(('S%d' % k))), k)
+    count('kmers', len(keys))
+    if not packable.all():
+        # searches would silently miss these signatures
+        unpackable = sig_frame.index[~packable]
+        logger.error('%d of %d signatures in "%s" have residues other than "%s" and cannot be indexed, e.g. %s.',
+                     len(unpackable), len(sig_frame), sigfilepath,
+                     to_str(PACKED_ALPHABET), ', '.join(unpackable[:5]))
+        sys.exit(1)
+    with stage('sort'):
+        order = np.argsort(keys, kind='mergesort')
+    arrays = {'keys': keys[order],
+              'intersections': sig_frame['intersections'].values[order].astype(np.int32),
+              'max_count': sig_frame['max_count'].values[order].astype(np.int32)}
+    if presence_paths:
+        logger.debug('Recording presence of signatures in %d sets.', len(presence_paths))
+        arrays['presence'] = set_presence(arrays['keys'], k, presence_paths)
+    if neighborhood:
+        with stage('neighborhood'):
+            arrays.update(neighborhood_arrays(arrays['keys'], k))
+    if bloom_fpr is not None:
+        with stage('bloom'):
+            arrays['bloom'], bloom_hashes = build_bloom_filter(arrays['keys'], bloom_fpr)
+    tmpdir = '%s.tmp-%d' % (indexdir, os.getpid())
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    with stage('write'):
+        for name in arrays.keys():
+            np.save(os.path.join(tmpdir, name + '.npy'), arrays[name])
+    sig_stat = os.stat(sigfilepath)
+    meta = {'version': SIGNATURE_INDEX_VERSION,
+            'k': k,
+            'n_sets': n_sets,
+            'n_signatures': int(len(arrays['keys'])),
+            'source': os.path.basename(sigfilepath),
+            'source_size': sig_stat.st_size,
+            'source_mtime': sig_stat.st_mtime}
+    if presence_paths:
+        meta['presence_paths'] = [os.path.abspath(path) for path in presence_paths]
+        meta['presence_sets'] = list(presence_sets)
+    meta['neighborhood'] = bool(neighborhood)
+    meta['sampling'] = term_file_sampling(sigfilepath)
+    if bloom_fpr is not None:
+        meta['bloom_fpr'] = float(bloom_fpr)
+        meta['bloom_hashes'] = bloom_hashes
+    with open(os.path.join(tmpdir, 'meta.yaml'), 'wt') as f:
+        yaml.dump(meta, f)
+    replace_index_dir(tmpdir, indexdir)
+    count_written(indexdir)
+    logger.debug('Wrote %d signatures to index "%s".', meta['n_signatures'], indexdir)
+    return meta
+
+
+def open_signature_index(dir, filestem):
+    '''Open a signature index, compiling it first if missing or stale.
+
+    :param dir: Summary directory.
+    :param filestem: Signature file stem.
+    :return: SignatureIndex object.
+    '''
+    sigfilepath = os.path.join(dir, filestem + '_terms.tsv')
+    indexdir = signature_index_dir(dir, filestem)
+    metapath = os.path.join(indexdir, 'meta.yaml')
+    presence_paths = None
+    presence_sets = None
+    neighborhood = False
+    bloom_fpr = None
+    if os.path.exists(metapath):
+        for attempt in range(OPEN_RETRIES):
+            try:
+                index = SignatureIndex(indexdir)
+                break
+            except FileNotFoundError:
+                # moved aside by replace_index_dir while being opened
+                if attempt == OPEN_RETRIES - 1:
+                    raise
+                time.sleep(OPEN_RETRY_WAIT)
+        if not os.path.exists(sigfilepath) or not index.is_stale(sigfilepath):
+            return index
+        logger.info('Signature index "%s" is out of date, recompiling.', indexdir)
+        presence_paths = index.meta.get('presence_paths')
+        presence_sets = index.meta.get('presence_sets')
+        neighborhood = index.meta.get('neighborhood', False)
+        bloom_fpr = index.meta.get('bloom_fpr')
+    elif not os.path.exists(sigfilepath):
+        logger.error('Signature file "%s" does not exist.', sigfilepath)
+        sys.exit(1)
+    else:
+        logger.info('Compiling signature index "%s".', indexdir)
+    compile_signature_index(sigfilepath, indexdir,
+                            presence_paths=presence_paths,
+                            presence_sets=presence_sets,
+                            neighborhood=neighborhood,
+                            bloom_fpr=bloom_fpr)
+    return SignatureIndex(indexdir)
+
+#
+# Classes begin here.
+#
+class BloomFilter(object):
+    '''Blocked Bloom filter with all bits of a key in one 64-bit word.
+
+    A probe costs one memory access per key, and never rejects a key
+    that was added.
+    '''
+    def __init__(self, words, n_hashes):
+        self.words = words
+        self.n_hashes = n_hashes
+
+
+    def __len__(self):
+        return len(self.words)*BLOOM_BLOCK_BITS
+
+
+    def contains(self, keys):
+        '''Test keys for possible membership.
+
+        :param keys: Array of packed keys.
+        :return: Boolean array, False where a key is surely absent.
+        '''
+        words, masks = bloom_probes(keys, len(self.words), self.n_hashes)
+        return (self.words[words] & masks) == masks
+
+
+class SignatureIndex(object):
+    '''Memory-mapped arrays of sorted signature keys and their stats.
+    '''
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+        with open(os.path.join(indexdir, 'meta.yaml'), 'rt') as f:
+            self.meta = yaml.safe_load(f)
+        if self.meta['version'] != SIGNATURE_INDEX_VERSION:
+            logger.error('Signature index "%s" is version %d, expected %d; rerun compile_signatures.',
+                         indexdir, self.meta['version'], SIGNATURE_INDEX_VERSION)
+            sys.exit(1)
+        self.k = self.meta['k']
+        self.n_sets = self.meta['n_sets']
+        self.keys = self._load('keys')
+        self.intersections = self._load('intersections')
+        self.max_count = self._load('max_count')
+        if 'presence_sets' in self.meta:
+            self.presence = self._load('presence')
+            self.presence_sets = self.meta['presence_sets']
+        else:
+            self.presence = None
+            self.presence_sets = None
+        self._signatures = None
+        self._neighborhood = None
+        self._bloom = None
+
+
+    def _load(self, name):
+        return np.load(os.path.join(self.indexdir, name + '.npy'), mmap_mode='r')
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def is_stale(self, sigfilepath):
+        '''Check whether the signature file changed since compilation.
+
+        :param sigfilepath: Path to signature terms file.
+        :return: True if size, modification time, or sampling differs.
+        '''
+        sig_stat = os.stat(sigfilepath)
+        return (sig_stat.st_size != self.meta['source_size'] or
+                sig_stat.st_mtime != self.meta['source_mtime'] or
+                term_file_sampling(sigfilepath) != self.meta.get('sampling'))
+
+
+    @property
+    def minimizer_window(self):
+        '''Minimizer window of sampled signatures, or None.
+        '''
+        sampling = self.meta.get('sampling')
+        if sampling is None:
+            return None
+        return sampling['window']
+
+
+    @property
+    def signatures(self):
+        '''Array of signature terms in index order.
+        '''
+        if self._signatures is None:
+            self._signatures = unpack_keys(self.keys, self.k)
+        return self._signatures
+
+
+    def neighborhood(self):
+        '''Return arrays for one-substitution search, computing if not stored.
+        '''
+        if self._neighborhood is None:
+            if self.meta.get('neighborhood', False):
+                self._neighborhood = dict([(name, self._load(name))
+                                           for name in NEIGHBORHOOD_ARRAYS])
+            else:
+                logger.debug('Computing neighborhood arrays for "%s".', self.indexdir)
+                self._neighborhood = neighborhood_arrays(np.asarray(self.keys), self.k)
+        return self._neighborhood
+
+
+    def enable_bloom_filter(self, fpr=DEFAULT_BLOOM_FPR):
+        '''Prefilter lookups with a Bloom filter, building it if not stored.
+
+        :param fpr: False-positive rate of filter if it is built.
+        :return: BloomFilter object.
+        '''
+        if self._bloom is None:
+            if 'bloom_fpr' in self.meta:
+                self._bloom = BloomFilter(self._load('bloom'),
+                                          self.meta['bloom_hashes'])
+            else:
+                logger.debug('Building Bloom filter for "%s".', self.indexdir)
+                self._bloom = BloomFilter(*build_bloom_filter(np.asarray(self.keys),
+                                                              fpr))
+        return self._bloom
+
+
+    def lookup_one_mismatch(self, keys):
+        '''Find signatures that differ from keys at exactly one residue.
+
+        :param keys: Array of packed keys.
+        :return: Tuple of (indexes into keys, signature ordinals), one entry
+                 per matching pair.
+        '''
+        if len(self.keys) == 0 or len(keys) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.int64)
+        arrays = self.neighborhood()
+        divisor = half_key_divisor(self.k)
+        n_left = self.k//2
+        # same left half, one substitution in right half
+        left_query, left_ordinals = _expand_matches(arrays['left_keys'],
+                                                    arrays['left_order'],
+                                                    keys // divisor)
+        keep_left = digit_differences(keys[left_query] % divisor,
+                                      self.keys[left_ordinals] % divisor,
+                                      self.k - n_left) == 1
+        # same right half, one substitution in left half
+        right_query, right_ordinals = _expand_matches(arrays['right_keys'],
+                                                      arrays['right_order'],
+                                                      keys % divisor)
+        keep_right = digit_differences(keys[right_query] // divisor,
+                                       self.keys[right_ordinals] // divisor,
+                                       n_left) == 1
+        return (np.concatenate((left_query[keep_left], right_query[keep_right])),
+                np.concatenate((left_ordinals[keep_left], right_ordinals[keep_right])))
+
+
+    def lookup(self, keys):
+        '''Find packed keys in the index.
+
+        :param keys: Array of packed keys.
+        :return: Tuple of (array of signature ordinals, boolean array of found).
+        '''
+        if len(self.keys) == 0:
+            return (np.zeros(len(keys), dtype=np.intp),
+                    np.zeros(len(keys), dtype=bool))
+        if self._bloom is not None:
+            candidates = np.flatnonzero(self._bloom.contains(keys))
+            ordinals = np.zeros(len(keys), dtype=np.intp)
+            found = np.zeros(len(keys), dtype=bool)
+            ordinals[candidates], found[candidates] = self._search(keys[candidates])
+            return ordinals, found
+        return self._search(keys)
+
+
+    def _search(self, keys):
+        ordinals = np.searchsorted(self.keys, keys)
+        np.minimum(ordinals, len(self.keys) - 1, out=ordinals)
+        return ordinals, self.keys[ordinals] == keys
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.option('--presence_stem', default=None, type=str,
+              help='Record presence in SETLIST from these per-set terms.')
+@click.option('--neighborhood/--no-neighborhood', default=False, show_default=True,
+              help='Store arrays for one-substitution search.')
+@click.option('--bloom_fpr', default=None, type=float,
+              help='Store a Bloom filter with this false-positive rate.')
+@click.argument('filestem', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def compile_signatures(presence_stem, neighborhood, bloom_fpr, filestem, setlist):
+    '''Compile signatures to a memory-mapped index.
+
+    :param presence_stem: Stem of per-set terms files, less '_terms.tsv',
+                          used to record which sets contain each signature.
+    :param filestem: Signature file stem, less '_terms.tsv'.
+    :param setlist: Sets in which to record presence.
+    :return:
+
+    Presence in sets is needed by search_peptide_occurrances --classify.
+    Neighborhood arrays are otherwise computed at startup of
+    search_peptide_occurrances --mismatches, and a Bloom filter with
+    the default false-positive rate of 0.01 at startup of
+    search_peptide_occurrances --bloom.
+
+    Example:
+        aakbar compile_signatures --presence_stem protein_k-10 strep10 all
+    '''
+    global config_obj
+    summarydir = config_obj.config_dict['summary']['dir']
+    sigfilepath = os.path.join(summarydir, filestem + '_terms.tsv')
+    if not os.path.exists(sigfilepath):
+        logger.error('Signature file "%s" does not exist.', sigfilepath)
+        sys.exit(1)
+    presence_paths = None
+    if presence_stem is not None:
+        setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+        presence_paths = []
+        for calc_set in setlist:
+            termfilepath = os.path.join(config_obj.config_dict[calc_set]['dir'],
+                                        presence_stem + '_terms.tsv')
+            if not os.path.exists(termfilepath):
+                logger.error('Terms file "%s" does not exist.', termfilepath)
+                sys.exit(1)
+            presence_paths.append(termfilepath)
+    elif len(setlist) > 0:
+        logger.error('A set list requires --presence_stem.')
+        sys.exit(1)
+    indexdir = signature_index_dir(summarydir, filestem)
+    meta = compile_signature_index(sigfilepath, indexdir,
+                                   presence_paths=presence_paths,
+                                   presence_sets=setlist,
+                                   neighborhood=neighborhood,
+                                   bloom_fpr=bloom_fpr)
+    logger.info('%d %d-mer signatures from %d sets compiled to "%s".',
+                meta['n_signatures'], meta['k'], meta['n_sets'], indexdir)
+    if presence_paths:
+        logger.info('Presence recorded in %d sets.', len(presence_paths))
+    if bloom_fpr is not None:
+        logger.info('Bloom filter of %d hashes stored for false-positive rate %g.',
+                    meta['bloom_hashes'], bloom_fpr)
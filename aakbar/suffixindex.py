@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+'''Memory-mapped suffix-array indexes of set proteomes.
+
+A suffix index is a directory next to a FASTA file of a set that holds
+the residues of all records, upper-cased and each followed by a zero
+separator byte, with the masked (lower-case) positions as a bit array.
+The suffix array lists the start of every residue's suffix in lexical
+order, and the LCP array the length of the prefix each suffix has in
+common with the one before it.  Each is in its own .npy file so that it
+can be memory-mapped.
+
+Occurrences of a peptide of any length are a contiguous range of the
+suffix array, found by binary search.  Unique terms of length k are the
+runs of suffixes with common prefixes of at least k, so term counts for
+any k come from the index without reading the FASTA again.
+'''
+
+# standard library imports
+import os
+import locale
+
+# external packages
+import numpy as np
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .core import (AMBIGUOUS_RESIDUES, fasta_sequences, log_term_counts,
+                   run_beginnings, term_lengths, term_stem, write_set_terms)
+from .compression import (open_fasta, fasta_keys, n_fasta_keys, split_fasta_ext,
+                          open_text)
+from .manifest import OutputManifest, manifest_path
+from .metrics import stage, count, count_read, count_written, report_size
+
+#
+# Global constants
+#
+SUFFIX_INDEX_VERSION = 1
+SUFFIX_INDEX_ARRAYS = ['text', 'masked', 'record_starts', 'suffixes', 'lcp']
+SEPARATOR = 0
+
+#
+# Helper functions begin here.
+#
+def suffix_index_dir(dir, infilename):
+    '''Return the path of the suffix index of a FASTA file.
+
+    :param dir: Set directory.
+    :param infilename: Name of FASTA file.
+    :return: Path of index directory.
+    '''
+    return os.path.join(dir, split_fasta_ext(infilename)[0] + '_sufindex')
+
+
+def proteome_text(fasta, keys):
+    '''Concatenate FASTA records, each followed by a separator.
+
+    :param fasta: Fasta object, with masked positions in lower case.
+    :param keys: Iterable of record keys.
+    :return: Tuple of (array of upper-case residues and separators,
+             boolean array of masked positions, array of record starts,
+             list of record names).
+    '''
+    text_arrays = []
+    masked_arrays = []
+    record_starts = [0]
+    names = []
+    for key in keys:
+        names.append(key)
+        seq = next(fasta_sequences(fasta, [key]))
+        seq_bytes = np.frombuffer(to_bytes(to_str(seq)), dtype=np.uint8)
+        upper = np.frombuffer(to_bytes(to_str(seq).upper()), dtype=np.uint8)
+        text_arrays += [upper, np.array([SEPARATOR], dtype=np.uint8)]
+        masked_arrays += [seq_bytes != upper, np.zeros(1, dtype=bool)]
+        record_starts.append(record_starts[-1] + len(upper) + 1)
+    return (np.concatenate(text_arrays + [np.zeros(0, dtype=np.uint8)]),
+            np.concatenate(masked_arrays + [np.zeros(0, dtype=bool)]),
+            np.array(record_starts[:-1], dtype=np.int64),
+            names)
+
+
+def suffix_array(text, n_records):
+    '''Sort the suffixes of a text by prefix doubling.
+
+    Separators are given distinct ranks below all residues, so that no
+    comparison runs past the end of a record.
+
+    :param text: Array of residues and separators.
+    :param n_records: Number of separators.
+    :return: Tuple of (suffix array, list of rank arrays, the i-th of
+             which ranks suffixes by their first 2**i characters).
+    '''
+    n = len(text)
+    rank = np.unique(text, return_inverse=True)[1].ravel().astype(np.int64) + n_records
+    rank[text == SEPARATOR] = np.arange(n_records)
+    rank = np.unique(rank, return_inverse=True)[1].ravel()
+    ranks = [rank.astype(np.int32)]
+    order = np.argsort(rank, kind='stable')
+    h = 1
+    while n and rank[order[-1]] < n - 1:
+        following = np.full(n, -1, dtype=np.int64)
+        following[:n-h] = rank[h:]
+        combined = rank*(n + 1) + following + 1
+        order = np.argsort(combined)
+        sorted_combined = combined[order]
+        del combined, following
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.concatenate(([0], np.cumsum(sorted_combined[1:] !=
+                                                     sorted_combined[:-1])))
+        del sorted_combined
+        ranks.append(rank.astype(np.int32))
+        h *= 2
+    return order, ranks
+
+
+def lcp_array(suffixes, ranks):
+    '''Find the common prefix lengths of adjacent suffixes.
+
+    Suffixes that have equal ranks at level i share their first 2**i
+    characters, so prefix lengths are built up from the highest level.
+
+    :param suffixes: Suffix array.
+    :param ranks: Rank arrays from suffix_array.
+    :return: Array of common prefix lengths, zero for the first suffix.
+    '''
+    n = len(suffixes)
+    previous = suffixes[:-1]
+    current = suffixes[1:]
+    lcp = np.zeros(max(n - 1, 0), dtype=np.int64)
+    for level in range(len(ranks) - 1, -1, -1):
+        rank = ranks[level]
+        in_text = np.maximum(previous, current) + lcp < n
+        same = np.zeros(len(lcp), dtype=bool)
+        same[in_text] = (rank[previous[in_text] + lcp[in_text]] ==
+                         rank[current[in_text] + lcp[in_text]])
+        lcp[same] += 2**level
+    return np.concatenate(([0], lcp)).astype(np.int32)
+
+
+def build_suffix_index(fasta, keys, indexdir, infilepath, first_n=None):
+    '''Write a suffix index of FASTA records.
+
+    :param fasta: Fasta object.
+    :param keys: Iterable of record keys.
+    :param indexdir: Path to output index directory.
+    :param infilepath: Path of FASTA file, recorded in metadata.
+    :param first_n: Number of records used, if limited.
+    :return: Metadata dictionary.
+    '''
+    text, masked, record_starts, names = proteome_text(fasta, keys)
+    report_size('text', text)
+    n_records = len(record_starts)
+    with stage('sort'):
+        suffixes, ranks = suffix_array(text, n_records)
+        report_size('ranks', ranks)
+        lcp = lcp_array(suffixes, ranks)
+        del ranks
+        # separators sort first, and no suffix shares a prefix with them
+        suffixes = suffixes[n_records:]
+        lcp = lcp[n_records:]
+        if len(lcp):
+            lcp[0] = 0
+    index_dtype = np.int32 if len(text) < 2**31 else np.int64
+    arrays = {'text': text,
+              'masked': np.packbits(masked),
+              'record_starts': record_starts,
+              'suffixes': suffixes.astype(index_dtype),
+              'lcp': lcp}
+    report_size('suffixes', arrays['suffixes'])
+    count('kmers', len(suffixes))
+    if not os.path.isdir(indexdir):
+        os.makedirs(indexdir)
+    with stage('write'):
+        for name in SUFFIX_INDEX_ARRAYS:
+            np.save(os.path.join(indexdir, name + '.npy'), arrays[name])
+        with open(os.path.join(indexdir, 'names.txt'), 'wt') as f:
+            for name in names:
+                f.write(name + '\n')
+    source_stat = os.stat(infilepath)
+    meta = {'version': SUFFIX_INDEX_VERSION,
+            'n_records': n_records,
+            'n_residues': int(len(suffixes)),
+            'max_lcp': int(lcp.max()) if len(lcp) else 0,
+            'first_n': first_n,
+            'source': os.path.basename(infilepath),
+            'source_size': source_stat.st_size,
+            'source_mtime': source_stat.st_mtime}
+    with open(os.path.join(indexdir, 'meta.yaml'), 'wt') as f:
+        yaml.dump(meta, f)
+    count_written(indexdir)
+    logger.debug('Wrote suffix index of %d residues to "%s".', meta['n_residues'], indexdir)
+    return meta
+
+
+def open_suffix_index(dir, infilename):
+    '''Open the suffix index of a FASTA file, building it first if missing or stale.
+
+    :param dir: Set directory.
+    :param infilename: Name of FASTA file.
+    :return: SuffixIndex object.
+    '''
+    user_ctx = get_user_context_obj()
+    infilepath = os.path.join(dir, infilename)
+    indexdir = suffix_index_dir(dir, infilename)
+    if os.path.exists(os.path.join(indexdir, 'meta.yaml')):
+        index = SuffixIndex(indexdir)
+        if not os.path.exists(infilepath) or not index.is_stale(infilepath,
+                                                                user_ctx['first_n']):
+            return index
+        logger.info('Suffix index "%s" is out of date, rebuilding.', indexdir)
+    elif not os.path.exists(infilepath):
+        logger.error('Input file "%s" does not exist.', infilepath)
+        sys.exit(1)
+    else:
+        logger.info('Building suffix index "%s".', indexdir)
+    fasta = open_fasta(infilepath)
+    keys = fasta_keys(fasta, user_ctx['first_n'])
+    build_suffix_index(fasta, keys, indexdir, infilepath,
+                       first_n=user_ctx['first_n'])
+    fasta.close()
+    count_read(infilepath)
+    return SuffixIndex(indexdir)
+
+
+def read_peptides(peptides):
+    '''Read a comma-separated list of peptides, or a file of one per line.
+
+    :param peptides: List or path.
+    :return: List of upper-case peptides.
+    '''
+    if os.path.exists(peptides):
+        with open_text(peptides) as f:
+            peptides = [line.strip() for line in f]
+    else:
+        peptides = peptides.split(',')
+    return [peptide.upper() for peptide in peptides if peptide]
+
+#
+# Classes begin here.
+#
+class SuffixIndex(object):
+    '''Memory-mapped suffix and LCP arrays of a set proteome.
+    '''
+    def __init__(self, indexdir):
+        self.indexdir = indexdir
+        with open(os.path.join(indexdir, 'meta.yaml'), 'rt') as f:
+            self.meta = yaml.safe_load(f)
+        if self.meta['version'] != SUFFIX_INDEX_VERSION:
+            logger.error('Suffix index "%s" is version %d, expected %d; rerun index_proteome.',
+                         indexdir, self.meta['version'], SUFFIX_INDEX_VERSION)
+            sys.exit(1)
+        self.text = self._load('text')
+        self.record_starts = self._load('record_starts')
+        self.suffixes = self._load('suffixes')
+        self.lcp = self._load('lcp')
+        self._names = None
+
+
+    def _load(self, name):
+        return np.load(os.path.join(self.indexdir, name + '.npy'), mmap_mode='r')
+
+
+    def __len__(self):
+        return len(self.suffixes)
+
+
+    def is_stale(self, infilepath, first_n=None):
+        '''Check whether the FASTA file or record limit changed since building.
+
+        :param infilepath: Path of FASTA file.
+        :param first_n: Number of records to be used, if limited.
+        :return: True if size, modification time, or first_n differs.
+        '''
+        source_stat = os.stat(infilepath)
+        return (source_stat.st_size != self.meta['source_size'] or
+                source_stat.st_mtime != self.meta['source_mtime'] or
+                first_n != self.meta.get('first_n'))
+
+
+    @property
+    def names(self):
+        '''List of record names in index order.
+        '''
+        if self._names is None:
+            with open(os.path.join(self.indexdir, 'names.txt'), 'rt') as f:
+                self._names = [line.rstrip('\n') for line in f]
+        return self._names
+
+
+    def masked(self):
+        '''Boolean array of masked positions in the text.
+        '''
+        return np.unpackbits(self._load('masked'))[:len(self.text)].astype(bool)
+
+
+    def _bound(self, peptide, upper):
+        # first suffix whose prefix is not below (or, if upper, not above) peptide
+        low = 0
+        high = len(self.suffixes)
+        m = len(peptide)
+        while low < high:
+            middle = (low + high)//2
+            start = int(self.suffixes[middle])
+            prefix = self.text[start:start+m].tobytes()
+            if prefix < peptide or (upper and prefix == peptide):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def find(self, peptide):
+        '''Find the range of suffixes that begin with a peptide.
+
+        :param peptide: Peptide string.
+        :return: Tuple of (first, last+1) suffix array positions.
+        '''
+        peptide = to_bytes(peptide.upper())
+        return self._bound(peptide, False), self._bound(peptide, True)
+
+
+    def count(self, peptide):
+        '''Count occurrences of a peptide.
+
+        :param peptide: Peptide string.
+        :return: Number of occurrences.
+        '''
+        first, last = self.find(peptide)
+        return last - first
+
+
+    def locate(self, peptide):
+        '''Locate occurrences of a peptide.
+
+        :param peptide: Peptide string.
+        :return: Tuple of (array of record ordinals, array of 0-based
+                 positions in records), in order of position.
+        '''
+        first, last = self.find(peptide)
+        starts = np.sort(np.asarray(self.suffixes[first:last]))
+        records = np.searchsorted(self.record_starts, starts, side='right') - 1
+        return records, starts - self.record_starts[records]
+
+
+    def set_terms(self, ks):
+        '''Count the unique terms of each length, as count_set_terms does.
+
+        Windows containing ambiguous residues and the last window of
+        each record are not counted.  Scores are the mean numbers of
+        masked residues in windows.
+
+        :param ks: Sorted list of term lengths.
+        :return: List, one per term length, of tuples of (sorted array
+                 of unique terms, array of counts, array of mean scores).
+        '''
+        text = np.asarray(self.text)
+        n = len(text)
+        suffixes = np.asarray(self.suffixes).astype(np.int64)
+        lcp = np.asarray(self.lcp)
+        record_lengths = np.diff(np.append(self.record_starts, n)) - 1
+        with stage('extract'):
+            # terms end before the next ambiguous residue and the last residue
+            stops = np.flatnonzero(np.isin(text,
+                                           np.frombuffer(to_bytes(''.join(AMBIGUOUS_RESIDUES)),
+                                                         dtype=np.uint8)))
+            ends = np.asarray(self.record_starts) + record_lengths - 1
+            stops = np.union1d(stops, ends)
+            usable = np.append(stops, n)[np.searchsorted(stops, suffixes)] - suffixes
+            n_masked = np.concatenate(([0], np.cumsum(self.masked())))
+        results = []
+        for k in ks:
+            with stage('sort'):
+                terms, beginnings = run_beginnings(lcp, usable >= k, k)
+                n_terms = len(terms)
+                freqs = np.diff(np.append(beginnings, n_terms))
+                starts = suffixes[terms[beginnings]]
+                windows = text[starts[:, np.newaxis] + np.arange(k)[np.newaxis, :]]
+                unique_terms = np.ascontiguousarray(windows).view(np.dtype(('S%d'%(k)))).ravel()
+                if n_terms:
+                    term_starts = suffixes[terms]
+                    scores = n_masked[term_starts + k] - n_masked[term_starts]
+                    mean_scores = (np.add.reduceat(scores.astype(np.float64), beginnings)/freqs
+                                   ).astype(np.float32)
+                else:
+                    mean_scores = np.zeros(0, dtype=np.float32)
+            count('kmers', n_terms)
+            n_raw_terms = int(np.maximum(record_lengths - k + 1, 0).sum())
+            log_term_counts(k, len(record_lengths), self.meta['n_residues'],
+                            n_raw_terms, n_terms, len(unique_terms))
+            results.append((unique_terms, freqs, mean_scores))
+        return results
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.argument('infilename', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def index_proteome(infilename, setlist):
+    '''Build suffix-array indexes of set proteomes.
+
+    :param infilename: Name of input FASTA files for every directory in setlist.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+
+    The index of INFILENAME is written to the directory INSTEM_sufindex
+    next to it.  Index the masked FASTA for terms and scores to agree
+    with calculate_peptide_terms.  Indexes are also built as needed by
+    query_peptides and index_peptide_terms.
+
+    Example:
+        aakbar index_proteome protein_letterfreq10-5.faa all
+    '''
+    global config_obj
+    user_ctx = get_user_context_obj()
+    if user_ctx['first_n']:
+        logger.info('Only first %d records will be used', user_ctx['first_n'])
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    logger.info('Indexing "%s" in %d data sets:', infilename, len(setlist))
+    for calc_set in setlist:
+        dir = config_obj.config_dict[calc_set]['dir']
+        infilepath = os.path.join(dir, infilename)
+        if not os.path.exists(infilepath):
+            logger.error('Input file "%s" does not exist.', infilepath)
+            sys.exit(1)
+        indexdir = suffix_index_dir(dir, infilename)
+        manifest = OutputManifest(manifest_path(dir, os.path.basename(indexdir)),
+                                  [infilepath],
+                                  {'first_n': user_ctx['first_n']},
+                                  [indexdir])
+        if manifest.is_up_to_date():
+            logger.info('   %s is up to date, skipping.', calc_set)
+            continue
+        manifest.invalidate()
+        fasta = open_fasta(infilepath)
+        keys = fasta_keys(fasta, user_ctx['first_n'])
+        n_recs = n_fasta_keys(keys)
+        if user_ctx['progress']:
+            with click.progressbar(keys, label='   %s genes indexed' %calc_set,
+                                   length=n_recs) as bar:
+                meta = build_suffix_index(fasta, bar, indexdir, infilepath,
+                                          first_n=user_ctx['first_n'])
+        else:
+            meta = build_suffix_index(fasta, keys, indexdir, infilepath,
+                                      first_n=user_ctx['first_n'])
+        fasta.close()
+        count_read(infilepath)
+        manifest.write()
+        logger.info('   %s: %s residues in %s genes, longest repeat %d.',
+                    calc_set,
+                    locale.format('%d', meta['n_residues'], grouping=True),
+                    locale.format('%d', meta['n_records'], grouping=True),
+                    meta['max_lcp'])
+
+
+@cli.command()
+@click.option('--locate/--no-locate', default=False, show_default=True,
+              help='Write the record and position of each occurrence.')
+@click.argument('infilename', type=str)
+@click.argument('peptides', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def query_peptides(locate, infilename, peptides, setlist):
+    '''Count or locate peptides of any length in sets.
+
+    :param locate: If True, write occurrences instead of counts.
+    :param infilename: Name of indexed FASTA files for every directory in setlist.
+    :param peptides: Comma-separated peptides, or file of one per line.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+
+    Counts are written to stdout as TSV of set, peptide, and count, or
+    with --locate as set, peptide, record, and 0-based position.
+
+    Example:
+        aakbar query_peptides protein.faa MKVLAAGIVG,GDSLTEA all
+    '''
+    global config_obj
+    peptides = read_peptides(peptides)
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    logger.info('Querying %d peptides in %d data sets.', len(peptides), len(setlist))
+    if locate:
+        click.echo('set\tpeptide\trecord\tposition')
+    else:
+        click.echo('set\tpeptide\tcount')
+    for calc_set in setlist:
+        index = open_suffix_index(config_obj.config_dict[calc_set]['dir'], infilename)
+        for peptide in peptides:
+            with stage('search'):
+                if locate:
+                    records, positions = index.locate(peptide)
+                else:
+                    n_hits = index.count(peptide)
+            if locate:
+                count('hits', len(records))
+                for record, position in zip(records, positions):
+                    click.echo('%s\t%s\t%s\t%d' % (calc_set, peptide,
+                                                   index.names[record], position))
+            else:
+                count('hits', n_hits)
+                click.echo('%s\t%s\t%d' % (calc_set, peptide, n_hits))
+
+
+@cli.command()
+@click.option('-k', default=str(DEFAULT_K), show_default=True,
+              help='Term length, or range of lengths such as 8-14.')
+@click.argument('infilename', type=str)
+@click.argument('outfilestem', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def index_peptide_terms(k, infilename, outfilestem, setlist):
+    '''Write terms and histograms from suffix indexes.
+
+    :param k: Term length or range.
+    :param infilename: Name of indexed FASTA files for every directory in setlist.
+    :param outfilestem: Output file stem, as for calculate_peptide_terms.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+
+    Outputs are the same as those of calculate_peptide_terms on the
+    indexed FASTA, with scores counting masked residues, but come from
+    the index without reading the FASTA again.
+
+    Example:
+        aakbar index_peptide_terms -k 8-14 protein_letterfreq10-5.faa protein_letterfreq10-5_k-{k} all
+    '''
+    global config_obj
+    try:
+        ks = term_lengths(k)
+    except ValueError:
+        logger.error('Term length "%s" is not a length or range such as 8-14.', k)
+        sys.exit(1)
+    logger.info('Term sizes are %s characters.', ', '.join([str(i) for i in ks]))
+    logger.info('Output file stem is "%s".', outfilestem)
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    logger.info('Calculating terms for %d data sets:', len(setlist))
+    for calc_set in setlist:
+        dir = config_obj.config_dict[calc_set]['dir']
+        index = open_suffix_index(dir, infilename)
+        metapath = os.path.join(index.indexdir, 'meta.yaml')
+        manifests = {}
+        for term_k in ks:
+            stem = term_stem(outfilestem, term_k, ks)
+            manifest = OutputManifest(manifest_path(dir, stem),
+                                      [metapath],
+                                      {'k': term_k},
+                                      [os.path.join(dir, stem + suffix)
+                                       for suffix in ['_terms.tsv',
+                                                      '_freqhist.csv',
+                                                      '_scorehist.tsv']])
+            if not manifest.is_up_to_date():
+                manifests[term_k] = manifest
+        if not manifests:
+            logger.info('   %s is up to date, skipping.', calc_set)
+            continue
+        calc_ks = sorted(manifests.keys())
+        logger.info('  %s: ', calc_set)
+        for manifest in manifests.values():
+            manifest.invalidate()
+        k_terms = index.set_terms(calc_ks)
+        for term_k, (unique_terms, freqs, mean_scores) in zip(calc_ks, k_terms):
+            write_set_terms(unique_terms, freqs, mean_scores, dir,
+                            term_stem(outfilestem, term_k, ks))
+            manifests[term_k].write()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+'''Signature builds split into tasks that workers claim from a directory.
+
+plan_signatures writes one small YAML manifest per task in a task
+directory.  Map tasks mask and count the terms of one set, writing them
+in shards.  Reduce tasks intersect and filter one shard of all sets,
+once every map task is done.  A final task gathers the shards of
+signatures into one table.
+
+Any number of run_task workers, on one node or on several nodes sharing
+the task directory and the data directories, claim tasks by creating a
+lock file next to the manifest, which succeeds for only one worker.
+Each step of a task is an aakbar command, run in a fresh interpreter
+from the working directory of the worker, with its output logged to
+TASK.log in the task directory.  A finished task leaves TASK.done, and
+a failed one TASK.failed.
+'''
+
+# standard library imports
+import os
+import time
+import socket
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+# module imports
+from .common import *
+from . import cli, get_user_context_obj, logger, log_elapsed_time
+from .core import DEFAULT_MAX_SCORE
+from .compression import split_fasta_ext
+
+#
+# Global constants
+#
+TASK_SUFFIX = '.task.yaml'
+STATE_SUFFIXES = {'locked': '.lock',
+                  'done': '.done',
+                  'failed': '.failed'}
+TAKEOVER_SUFFIX = '.takeover'
+DEFAULT_SHARDS = 8
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_POLL = 5. # seconds between looks for runnable tasks
+
+#
+# Helper functions begin here.
+#
+def task_path(taskdir, name, suffix=TASK_SUFFIX):
+    '''Return the path of a task manifest or state file.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :param suffix: Suffix of file.
+    :return: Path.
+    '''
+    return os.path.join(taskdir, name + suffix)
+
+
+def write_task(taskdir, name, steps, depends=()):
+    '''Write a task manifest.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :param steps: List of aakbar argument lists, run in order.
+    :param depends: Names of tasks that must be done first.
+    :return: None
+    '''
+    with open(task_path(taskdir, name), 'wt') as f:
+        yaml.dump({'name': name,
+                   'depends': list(depends),
+                   'steps': [list(step) for step in steps]}, f)
+
+
+def read_tasks(taskdir):
+    '''Read the task manifests of a task directory.
+
+    :param taskdir: Task directory.
+    :return: List of task dictionaries, in order of name.
+    '''
+    tasks = []
+    for filename in sorted(os.listdir(taskdir)):
+        if filename.endswith(TASK_SUFFIX):
+            with open(os.path.join(taskdir, filename), 'rt') as f:
+                tasks.append(yaml.safe_load(f))
+    return tasks
+
+
+def lock_holder(taskdir, name):
+    '''Read who holds the lock of a task.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :return: Dictionary with host and pid, or None if not locked.
+    '''
+    try:
+        with open(task_path(taskdir, name, STATE_SUFFIXES['locked']), 'rt') as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return None
+
+
+def is_stale_lock(holder):
+    '''Check if a lock is held by a process of this host that has died.
+
+    Locks held on other hosts can't be checked, and must be removed by
+    hand if their worker died.
+
+    :param holder: Lock holder, as from lock_holder.
+    :return: True if the lock may be taken over.
+    '''
+    if holder.get('host') != socket.gethostname() or 'pid' not in holder:
+        return False
+    try:
+        os.kill(holder['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def task_state(taskdir, name):
+    '''Find the state of a task.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :return: One of 'done', 'failed', 'locked', or 'ready'.
+    '''
+    for state in ['done', 'failed', 'locked']:
+        if os.path.exists(task_path(taskdir, name, STATE_SUFFIXES[state])):
+            return state
+    return 'ready'
+
+
+def lock_contents():
+    '''Describe this worker as the holder of a lock.
+
+    :return: Dictionary with host, pid, and start time.
+    '''
+    return {'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def take_over_task(taskdir, name, holder):
+    '''Take over the lock of a task from a dead holder.
+
+    A worker taking over first creates a takeover file with O_EXCL, so
+    only one worker at a time can.  It then checks that the lock is
+    still held by the dead holder, and atomically replaces the lock
+    with its own, so the lock file is never missing for another worker
+    to create.  A takeover file left by a worker that died while taking
+    over must be removed by hand.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :param holder: Dead lock holder, as from lock_holder.
+    :return: True if this worker took over the task.
+    '''
+    lockpath = task_path(taskdir, name, STATE_SUFFIXES['locked'])
+    takeoverpath = lockpath + TAKEOVER_SUFFIX
+    try:
+        fd = os.open(takeoverpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    try:
+        with os.fdopen(fd, 'wt') as f:
+            yaml.dump(lock_contents(), f)
+        if lock_holder(taskdir, name) != holder:
+            # taken over by another worker, or cleared
+            return False
+        logger.warning('Taking over task %s from dead process %d.',
+                       name, holder['pid'])
+        tmppath = '%s.%d.tmp' % (lockpath, os.getpid())
+        with open(tmppath, 'wt') as f:
+            yaml.dump(lock_contents(), f)
+        os.replace(tmppath, lockpath)
+    finally:
+        os.remove(takeoverpath)
+    return True
+
+
+def claim_task(taskdir, name):
+    '''Claim a task by creating its lock file.
+
+    Creating the file with O_EXCL is atomic, on NFS as well as local
+    file systems, so only one worker succeeds.  Locks of dead workers
+    are taken over by take_over_task.
+
+    :param taskdir: Task directory.
+    :param name: Task name.
+    :return: True if this worker claimed the task.
+    '''
+    lockpath = task_path(taskdir, name, STATE_SUFFIXES['locked'])
+    try:
+        fd = os.open(lockpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        holder = lock_holder(taskdir, name)
+        if holder is None or not is_stale_lock(holder):
+            return False
+        return take_over_task(taskdir, name, holder)
+    with os.fdopen(fd, 'wt') as f:
+        yaml.dump(lock_contents(), f)
+    return True
+
+
+def run_steps(taskdir, task):
+    '''Run the steps of a claimed task and record its state.
+
+    :param taskdir: Task directory.
+    :param task: Task dictionary.
+    :return: True if all steps succeeded.
+    '''
+    name = task['name']
+    start = time.time()
+    with open(task_path(taskdir, name, '.log'), 'wt') as logfh:
+        for step in task['steps']:
+            logfh.write('$ aakbar %s\n' % ' '.join(step))
+            logfh.flush()
+            returncode = subprocess.call([sys.executable, '-m', PROGRAM_NAME, '--no_log'] + step,
+                                         stdout=logfh,
+                                         stderr=subprocess.STDOUT)
+            if returncode != 0:
+                break
+    state = 'done' if returncode == 0 else 'failed'
+    with open(task_path(taskdir, name, STATE_SUFFIXES[state]), 'wt') as f:
+        yaml.dump({'host': socket.gethostname(),
+                   'returncode': returncode,
+                   'elapsed': round(time.time() - start, 1)}, f)
+    if returncode == 0:
+        logger.info('Task %s done in %.1f s.', name, time.time() - start)
+    else:
+        logger.error('Task %s failed; see "%s".', name, task_path(taskdir, name, '.log'))
+    return returncode == 0
+
+
+def task_worker(taskdir, poll):
+    '''Claim and run tasks until none are left that can run.
+
+    :param taskdir: Task directory.
+    :param poll: Seconds to wait when all runnable tasks are claimed.
+    :return: Tuple of (number of tasks done, number failed).
+    '''
+    n_done = 0
+    n_failed = 0
+    while True:
+        tasks = read_tasks(taskdir)
+        states = dict([(task['name'], task_state(taskdir, task['name'])) for task in tasks])
+        for name, state in states.items():
+            if state == 'locked' and is_stale_lock(lock_holder(taskdir, name) or {}):
+                states[name] = 'ready'
+        ready = [task for task in tasks if states[task['name']] == 'ready']
+        runnable = [task for task in ready
+                    if all([states.get(dep) == 'done' for dep in task['depends']])]
+        for task in runnable:
+            if claim_task(taskdir, task['name']):
+                if run_steps(taskdir, task):
+                    n_done += 1
+                else:
+                    n_failed += 1
+                break
+        else:
+            running = [name for name, state in states.items() if state == 'locked']
+            if not ready or not (runnable or running):
+                # finished, or blocked by failed tasks
+                return n_done, n_failed
+            time.sleep(poll)
+
+#
+# Cli commands begin here.
+#
+@cli.command()
+@click.option('-k', default=DEFAULT_K, show_default=True, help='Term length')
+@click.option('--cutoff', default=DEFAULT_SIMPLICITY_CUTOFF, show_default=True,
+              help='Minimum simplicity level to unmask.')
+@click.option('--score', default=DEFAULT_MAX_SCORE, show_default=True,
+              help='Maximum simplicity score to keep.')
+@click.option('--shards', default=DEFAULT_SHARDS, show_default=True,
+              help='Number of reduce tasks, each of one shard of terms.')
+@click.option('--minimizer_window', type=int, default=None,
+              help='Keep only minimizers of every W consecutive terms.')
+@click.option('--force/--no-force', default=False,
+              help='Replace tasks in a non-empty task directory.')
+@click.argument('taskdir', type=click.Path(file_okay=False))
+@click.argument('infilename', type=str)
+@click.argument('outfilestem', type=str)
+@click.argument('setlist', nargs=-1, type=DATA_SET_VALIDATOR)
+@log_elapsed_time()
+def plan_signatures(k, cutoff, score, shards, minimizer_window, force,
+                    taskdir, infilename, outfilestem, setlist):
+    '''Write tasks of a signature build for run_task workers.
+
+    :param k: Term length.
+    :param cutoff: Minimum simplicity level to unmask.
+    :param score: Maximum simplicity score to keep.
+    :param shards: Number of shards of terms.
+    :param minimizer_window: If given, keep only minimizer terms.
+    :param force: If True, replace existing tasks.
+    :param taskdir: Directory of task manifests, shared by workers.
+    :param infilename: Name of input FASTA files for every directory in setlist.
+    :param outfilestem: Signature file stem, less '_terms.tsv'.
+    :param setlist: List of defined sets to iterate over.
+    :return:
+
+    Gives the same signatures as build_signatures, with intermediate
+    outputs under the same stems.  A map task per set runs
+    peptide_simplicity_mask and calculate_peptide_terms --shards, a
+    reduce task per shard runs intersect_peptide_terms --shard and
+    filter_peptide_terms --shard, and a final task runs
+    gather_peptide_terms.  The global --first_n, --rebuild, --no-plots,
+    and --compress options given here are passed to every step.
+
+    Example:
+        aakbar plan_signatures -k 10 --cutoff 5 --score 0.1 tasks/strep10 protein.faa strep10 all
+        aakbar run_task --workers 8 tasks/strep10
+    '''
+    user_ctx = get_user_context_obj()
+    setlist = DATA_SET_VALIDATOR.multiple_or_empty_set(setlist)
+    if shards < 2:
+        logger.error('Number of shards must be >=2.')
+        sys.exit(1)
+    if os.path.isdir(taskdir) and os.listdir(taskdir):
+        if not force:
+            logger.error('Task directory "%s" is not empty.  Use --force to replace tasks.',
+                         taskdir)
+            sys.exit(1)
+        for filename in os.listdir(taskdir):
+            if filename.endswith(TASK_SUFFIX) or filename.endswith('.log') or \
+               filename.endswith(TAKEOVER_SUFFIX) or \
+               any([filename.endswith(suffix) for suffix in STATE_SUFFIXES.values()]):
+                os.remove(os.path.join(taskdir, filename))
+    elif not os.path.isdir(taskdir):
+        os.makedirs(taskdir)
+    global_args = []
+    if user_ctx['first_n']:
+        global_args += ['--first_n', str(user_ctx['first_n'])]
+    if user_ctx['rebuild']:
+        global_args.append('--rebuild')
+    if not user_ctx['plots']:
+        global_args.append('--no-plots')
+    if user_ctx['compress']:
+        global_args += ['--compress', user_ctx['compress'],
+                        '--compress_level', str(user_ctx['compress_level'])]
+    simplicity_label = user_ctx['simplicity_object'].label
+    instem, ext = split_fasta_ext(infilename)
+    maskedstem = '%s_%s-%d' % (instem, simplicity_label, cutoff)
+    termstem = '%s_k-%d' % (maskedstem, k)
+    calculate_args = ['-k', str(k), '--shards', str(shards)]
+    if minimizer_window is not None:
+        calculate_args += ['--minimizer_window', str(minimizer_window)]
+    #
+    # map tasks, one per set
+    #
+    map_names = []
+    for calc_set in setlist:
+        name = 'map-%s' % calc_set
+        write_task(taskdir, name,
+                   [global_args + ['peptide_simplicity_mask', '--cutoff', str(cutoff),
+                                   infilename, maskedstem, calc_set],
+                    global_args + ['calculate_peptide_terms'] + calculate_args +
+                    [maskedstem + ext, termstem, calc_set]])
+        map_names.append(name)
+    #
+    # reduce tasks, one per shard
+    #
+    reduce_names = []
+    for p in range(shards):
+        name = 'reduce-%0*d' % (len(str(shards - 1)), p)
+        write_task(taskdir, name,
+                   [global_args + ['intersect_peptide_terms', '--shard', str(p),
+                                   termstem] + list(setlist),
+                    global_args + ['filter_peptide_terms', '--shard', str(p),
+                                   '--cutoff', str(score), termstem, outfilestem]],
+                   depends=map_names)
+        reduce_names.append(name)
+    write_task(taskdir, 'gather',
+               [global_args + ['gather_peptide_terms', outfilestem]],
+               depends=reduce_names)
+    logger.info('Wrote %d map, %d reduce, and 1 gather tasks to "%s".',
+                len(map_names), len(reduce_names), taskdir)
+
+
+@cli.command()
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True,
+              help='Number of worker processes on this node.')
+@click.option('--poll', default=DEFAULT_POLL, show_default=True,
+              help='Seconds between looks for tasks claimed by other workers.')
+@click.option('--retry/--no-retry', default=False, show_default=True,
+              help='Run failed tasks again.')
+@click.argument('taskdir', type=click.Path(file_okay=False, exists=True))
+@log_elapsed_time()
+def run_task(workers, poll, retry, taskdir):
+    '''Claim and run tasks until all are done.
+
+    :param workers: Number of worker processes on this node.
+    :param poll: Seconds between looks for runnable tasks.
+    :param retry: If True, clear failed tasks first.
+    :param taskdir: Directory of task manifests.
+    :return:
+
+    Run from the working directory in which tasks were planned, on any
+    number of nodes that share it.  Workers stop once every task is
+    done, or when the remaining tasks depend on failed ones.
+    '''
+    tasks = read_tasks(taskdir)
+    if not tasks:
+        logger.error('No tasks in "%s".', taskdir)
+        sys.exit(1)
+    if retry:
+        for task in tasks:
+            if task_state(taskdir, task['name']) == 'failed':
+                logger.info('Retrying task %s.', task['name'])
+                for state in ['failed', 'locked']:
+                    os.remove(task_path(taskdir, task['name'], STATE_SUFFIXES[state]))
+    workers = max(1, min(workers, len(tasks)))
+    logger.info('Running %d tasks from "%s" with %d workers.',
+                len(tasks), taskdir, workers)
+    if workers == 1:
+        results = [task_worker(taskdir, poll)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(task_worker, [taskdir]*workers, [poll]*workers))
+    n_done = sum([done for done, failed in results])
+    logger.info('%d tasks run by this node.', n_done)
+    states = [task_state(taskdir, task['name']) for task in tasks]
+    if 'failed' in states or 'ready' in states:
+        logger.error('%d tasks failed and %d could not run.',
+                     states.count('failed'), states.count('ready'))
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('taskdir', type=click.Path(file_okay=False, exists=True))
+def show_tasks(taskdir):
+    '''Print the state of each task.
+
+    :param taskdir: Directory of task manifests.
+    :return:
+    '''
+    for task in read_tasks(taskdir):
+        name = task['name']
+        state = task_state(taskdir, name)
+        holder = lock_holder(taskdir, name) if state != 'ready' else None
+        if holder:
+            click.echo('%s\t%s\t%s:%s' % (name, state, holder.get('host'), holder.get('pid')))
+        else:
+            click.echo('%s\t%s' % (name, state))
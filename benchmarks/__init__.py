@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks of aakbar commands.
+
+Scripts here are run from the top of the source tree, e.g.
+    python -m benchmarks.pipeline small
+'''
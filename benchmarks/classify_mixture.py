@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+'''Benchmark per-sequence classification on a synthetic mixture.
+
+Synthetic genomes are made by mutating a random ancestral proteome
+independently for each set.  Signatures are the k-mers shared by two or
+more sets, with presence recorded per set.  Fragments drawn from known
+sets are then classified, and sequences per second and accuracy are
+reported.
+
+Usage:
+    python -m benchmarks.classify_mixture [OPTIONS]
+'''
+
+# standard library imports
+import os
+import time
+import tempfile
+
+# external packages
+import click
+import numpy as np
+import pandas as pd
+
+# package imports
+from aakbar.packing import pack_windows, unpack_keys
+from aakbar.sigindex import compile_signature_index, SignatureIndex
+from aakbar.search import frame_windows
+from aakbar.classify import SignatureClassifier
+from .synthetic import random_gene, mutate
+
+
+def random_proteome(rng, n_genes, gene_length):
+    '''Random genes of equal length.
+
+    :param rng: numpy RandomState.
+    :param n_genes: Number of genes.
+    :param gene_length: Residues per gene.
+    :return: List of arrays of residue codes (uint8).
+    '''
+    return [random_gene(rng, gene_length) for i in range(n_genes)]
+
+
+def write_terms(path, keys, k, columns):
+    '''Write a term table as aakbar reads it.
+
+    :param path: Output path.
+    :param keys: Array of packed terms.
+    :param k: Term length.
+    :param columns: Dictionary of column name to array of values.
+    :return: None
+    '''
+    frame = pd.DataFrame(columns,
+                         index=[term.decode('utf-8') for term in unpack_keys(keys, k)])
+    frame.to_csv(path, sep='\t', float_format='%.2f')
+
+
+@click.command()
+@click.option('-k', default=10, show_default=True, help='Term length.')
+@click.option('--n_sets', default=8, show_default=True, help='Number of genomes.')
+@click.option('--n_genes', default=2000, show_default=True, help='Genes per genome.')
+@click.option('--gene_length', default=300, show_default=True, help='Residues per gene.')
+@click.option('--divergence', default=0.08, show_default=True,
+              help='Substitution rate of each genome from the ancestor.')
+@click.option('--n_queries', default=20000, show_default=True,
+              help='Fragments in the mixture.')
+@click.option('--query_length', default=100, show_default=True,
+              help='Residues per fragment.')
+@click.option('--query_error', default=0.01, show_default=True,
+              help='Substitution rate applied to fragments.')
+@click.option('--seed', default=1, show_default=True, help='Random seed.')
+def classify_mixture(k, n_sets, n_genes, gene_length, divergence,
+                     n_queries, query_length, query_error, seed):
+    '''Time classification of a synthetic mixture.'''
+    rng = np.random.RandomState(seed)
+    ancestor = random_proteome(rng, n_genes, gene_length)
+    genomes = [[mutate(rng, gene, divergence) for gene in ancestor]
+               for i in range(n_sets)]
+    set_names = ['set%d' % i for i in range(n_sets)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        #
+        # signatures are terms shared by two or more sets
+        #
+        set_keys = []
+        set_paths = []
+        for name, genome in zip(set_names, genomes):
+            keys = np.unique(np.concatenate([pack_windows(gene.tobytes(), k)[0]
+                                             for gene in genome]))
+            set_keys.append(keys)
+            path = os.path.join(tmpdir, name + '_terms.tsv')
+            write_terms(path, keys, k, {'count': np.ones(len(keys), dtype=int),
+                                        'score': np.zeros(len(keys))})
+            set_paths.append(path)
+        sig_keys, intersections = np.unique(np.concatenate(set_keys),
+                                            return_counts=True)
+        shared = intersections > 1
+        sigpath = os.path.join(tmpdir, 'mixture_terms.tsv')
+        write_terms(sigpath, sig_keys[shared], k,
+                    {'intersections': intersections[shared],
+                     'count': intersections[shared],
+                     'max_count': np.ones(shared.sum(), dtype=int),
+                     'score': np.zeros(shared.sum())})
+        indexdir = os.path.join(tmpdir, 'mixture_sigindex')
+        compile_signature_index(sigpath, indexdir,
+                                presence_paths=set_paths,
+                                presence_sets=set_names)
+        index = SignatureIndex(indexdir)
+        click.echo('%d signatures from %d sets of %d genes.' % (len(index), n_sets, n_genes))
+        #
+        # mixture of fragments from known sets
+        #
+        truth = rng.randint(n_sets, size=n_queries)
+        queries = []
+        for i in range(n_queries):
+            gene = genomes[truth[i]][rng.randint(n_genes)]
+            start = rng.randint(gene_length - query_length + 1)
+            queries.append(mutate(rng, gene[start:start+query_length],
+                                  query_error).tobytes().decode('ascii'))
+        classifier = SignatureClassifier('mixture', index)
+        classifier.init_set(None, 'mixture', tmpdir)
+        start_time = time.time()
+        for i, seq in enumerate(queries):
+            classifier.search_windows('q%d' % i, seq, frame_windows(seq, [k])[k])
+        elapsed = time.time() - start_time
+        classifier.close_set()
+        classes = pd.read_csv(os.path.join(tmpdir, 'mixture_classes.tsv'),
+                              sep='\t', keep_default_na=False)
+        assigned = classes['assignment'] != ''
+        correct = classes['assignment'].values == np.array(set_names)[truth]
+    click.echo('%d sequences classified in %.2f s: %.0f sequences/s, %.0f residues/s.'
+               % (n_queries, elapsed, n_queries/elapsed,
+                  n_queries*query_length/elapsed))
+    click.echo('%.1f%% assigned, %.1f%% of assigned correct.'
+               % (100.*assigned.mean(),
+                  100.*correct[assigned].sum()/max(assigned.sum(), 1)))
+
+
+if __name__ == '__main__':
+    classify_mixture()
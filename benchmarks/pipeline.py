@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+'''Time the signature pipeline on synthetic proteomes.
+
+Synthetic sets are written to a work directory, aakbar is configured
+there, and each pipeline command is run in a fresh interpreter in
+order: peptide_simplicity_mask, calculate_peptide_terms,
+intersect_peptide_terms, filter_peptide_terms, and
+search_peptide_occurrances.  Wall time is measured around each run,
+and peak memory and residues per second are read from the metrics file
+the command writes in logs/.
+
+Outputs of each command are checked against the SHA-256 digests in
+benchmarks/golden/PRESET.yaml, if the synthetic parameters match those
+the digests were made from.  Use --update_golden after a change that
+is meant to alter outputs.
+
+Results are printed as a table, and appended as TSV to --results so
+that runs of different versions can be compared.
+
+Usage:
+    python -m benchmarks.pipeline [OPTIONS] [PRESET]
+'''
+
+# standard library imports
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from datetime import datetime
+
+# external packages
+import click
+import yaml
+import numpy as np
+
+# package imports
+import aakbar
+from aakbar.version import __version__
+from .synthetic import DEFAULT_PARAMS, DEFAULT_FILENAME, write_synthetic_sets
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+PRESETS = {'small': {},
+           'medium': {'n_sets': 8, 'n_genes': 4000},
+           'large': {'n_sets': 16, 'n_genes': 10000}}
+SIGNATURE_STEM = 'synsigs'
+# run the aakbar that was imported here, installed or not
+AAKBAR_ENV = dict(os.environ,
+                  PYTHONPATH=os.pathsep.join(
+                      [os.path.dirname(os.path.dirname(os.path.abspath(aakbar.__file__)))] +
+                      [path for path in [os.environ.get('PYTHONPATH')] if path]))
+RESULT_FIELDS = ['date', 'label', 'version', 'preset', 'command', 'runs',
+                 'wall_median_s', 'wall_min_s', 'peak_rss_mib', 'residues_per_s',
+                 'golden']
+
+
+def aakbar_command(args, cwd, log=True):
+    '''Run aakbar in a fresh interpreter.
+
+    :param args: Arguments to aakbar.
+    :param cwd: Working directory.
+    :param log: If False, pass --no_log.
+    :return: Wall time in s.
+    '''
+    command = [sys.executable, '-m', 'aakbar', '-q']
+    if not log:
+        command.append('--no_log')
+    start = time.time()
+    result = subprocess.run(command + args,
+                            cwd=cwd,
+                            env=AAKBAR_ENV,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall = time.time() - start
+    if result.returncode != 0:
+        raise click.ClickException('"aakbar %s" failed:\n%s' % (' '.join(args),
+                                                                  result.stderr[-2000:]))
+    return wall
+
+
+def pipeline_commands(k, simplicity, cutoff, score, filename=DEFAULT_FILENAME):
+    '''Commands of the pipeline and the outputs each is checked on.
+
+    :param k: Term length.
+    :param simplicity: Simplicity object label.
+    :param cutoff: Simplicity masking cutoff.
+    :param score: Maximum simplicity score of signatures.
+    :param filename: Input FASTA file name.
+    :return: List of (command name, arguments, output names) tuples.
+             Output names starting with '/' are in the summary
+             directory, others are in every set directory.
+    '''
+    instem, ext = os.path.splitext(filename)
+    maskedstem = '%s_%s-%d' % (instem, simplicity, cutoff)
+    termstem = '%s_k-%d' % (maskedstem, k)
+    searchstem = '%s-%s' % (instem, SIGNATURE_STEM)
+    return [('peptide_simplicity_mask',
+             ['--cutoff', str(cutoff), filename, maskedstem, 'all'],
+             [maskedstem + ext]),
+            ('calculate_peptide_terms',
+             ['-k', str(k), maskedstem + ext, termstem, 'all'],
+             [termstem + '_terms.tsv']),
+            ('intersect_peptide_terms',
+             [termstem, 'all'],
+             ['/' + termstem + '_terms.tsv']),
+            ('filter_peptide_terms',
+             ['--cutoff', str(score), termstem, SIGNATURE_STEM],
+             ['/' + SIGNATURE_STEM + '_terms.tsv']),
+            ('search_peptide_occurrances',
+             [filename, SIGNATURE_STEM, 'all'],
+             [searchstem + '_sigcounts.tsv', searchstem + '_genestats.tsv'])]
+
+
+def output_digests(workdir, set_names, outputs):
+    '''SHA-256 of each output of a command.
+
+    :param workdir: Work directory.
+    :param set_names: Names of set directories.
+    :param outputs: Output names, as from pipeline_commands.
+    :return: Dictionary of digests by path relative to workdir.
+    '''
+    paths = []
+    for output in outputs:
+        if output.startswith('/'):
+            paths.append('summary' + output)
+        else:
+            paths += [name + '/' + output for name in set_names]
+    digests = {}
+    for path in paths:
+        with open(os.path.join(workdir, path), 'rb') as f:
+            digests[path] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def read_metrics(workdir, command):
+    '''Read the metrics file written by a command.
+
+    :param workdir: Work directory.
+    :param command: Command name.
+    :return: Metrics dictionary.
+    '''
+    with open(os.path.join(workdir, 'logs', 'aakbar-%s-metrics.json' % command), 'rt') as f:
+        return json.load(f)
+
+
+def configure(workdir, sets, simplicity):
+    '''Write an aakbar configuration in the work directory.
+
+    :param workdir: Work directory.
+    :param sets: List of (set name, set directory) tuples.
+    :param simplicity: Simplicity object label.
+    :return: None
+    '''
+    aakbar_command(['init_config_file', '.'], workdir, log=False)
+    for name, setdir in sets:
+        aakbar_command(['define_set', name, os.path.relpath(setdir, workdir)],
+                       workdir, log=False)
+    aakbar_command(['define_summary', 'summary', 'synthetic'], workdir, log=False)
+    aakbar_command(['set_simplicity_object', simplicity], workdir, log=False)
+    aakbar_command(['set_plot_type', 'png'], workdir, log=False)
+
+
+@click.command()
+@click.option('--n_sets', type=int, help='Number of sets, overriding preset.')
+@click.option('--n_genes', type=int, help='Genes per set, overriding preset.')
+@click.option('--gene_length', type=int, help='Mean residues per gene, overriding preset.')
+@click.option('--shared_fraction', type=float,
+              help='Fraction of genes from a shared core, overriding preset.')
+@click.option('--divergence', type=float,
+              help='Substitution rate of core genes, overriding preset.')
+@click.option('--low_complexity', type=float,
+              help='Fraction of residues in low-complexity runs, overriding preset.')
+@click.option('--seed', type=int, help='Random seed, overriding preset.')
+@click.option('-k', default=10, show_default=True, help='Term length.')
+@click.option('--simplicity', default='letterfreq10', show_default=True,
+              help='Simplicity object.')
+@click.option('--cutoff', default=5, show_default=True,
+              help='Simplicity masking cutoff.')
+@click.option('--score', default=0.1, show_default=True,
+              help='Maximum simplicity score of signatures.')
+@click.option('--repeat', default=3, show_default=True,
+              help='Runs per command; the median is reported.')
+@click.option('--workdir', type=click.Path(file_okay=False),
+              help='Keep data and outputs here, instead of in a temporary directory.')
+@click.option('--results', type=click.Path(dir_okay=False),
+              help='Append results as TSV to this file.')
+@click.option('--label', default='', help='Label of this run in results.')
+@click.option('--update_golden', is_flag=True, default=False,
+              help='Write golden digests from this run.')
+@click.argument('preset', type=click.Choice(sorted(PRESETS.keys())), default='small')
+def pipeline(preset, k, simplicity, cutoff, score, repeat, workdir, results,
+             label, update_golden, **overrides):
+    '''Time pipeline commands on synthetic sets of size PRESET.'''
+    params = dict(DEFAULT_PARAMS)
+    params.update(PRESETS[preset])
+    params.update(dict([(key, value) for key, value in overrides.items()
+                        if value is not None]))
+    run_params = dict(params, k=k, simplicity=simplicity, cutoff=cutoff, score=score)
+    golden_path = os.path.join(GOLDEN_DIR, preset + '.yaml')
+    golden = None
+    if os.path.exists(golden_path):
+        with open(golden_path, 'rt') as f:
+            golden = yaml.safe_load(f)
+        if golden['params'] != run_params:
+            click.echo('Parameters differ from golden results, outputs will not be checked.')
+            golden = None
+    elif not update_golden:
+        click.echo('No golden results for preset "%s".' % preset)
+    if workdir is None:
+        tmpdir = tempfile.mkdtemp(prefix='aakbar-bench-')
+        workdir = tmpdir
+    else:
+        tmpdir = None
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    workdir = os.path.abspath(workdir)
+    rows = []
+    new_golden = {'params': run_params, 'outputs': {}}
+    failed = False
+    try:
+        click.echo('Writing %d synthetic sets of %d genes to "%s".'
+                   % (params['n_sets'], params['n_genes'], workdir))
+        sets = write_synthetic_sets(workdir, **params)
+        set_names = [name for name, setdir in sets]
+        configure(workdir, sets, simplicity)
+        date = datetime.now().isoformat(timespec='seconds')
+        for command, args, outputs in pipeline_commands(k, simplicity, cutoff, score):
+            walls = []
+            peaks = []
+            rates = []
+            for i in range(repeat):
+                walls.append(aakbar_command(['--rebuild', '--no-plots', command] + args,
+                                            workdir))
+                metrics = read_metrics(workdir, command)
+                peaks.append(metrics['peak_rss'])
+                rates.append(metrics['rates_per_second'].get('residues', 0.))
+            digests = output_digests(workdir, set_names, outputs)
+            new_golden['outputs'][command] = digests
+            if golden is None:
+                status = '-'
+            elif golden['outputs'].get(command) == digests:
+                status = 'ok'
+            else:
+                status = 'FAIL'
+                failed = True
+                for path, digest in sorted(digests.items()):
+                    if golden['outputs'].get(command, {}).get(path) != digest:
+                        click.echo('%s: "%s" differs from golden results.' % (command, path))
+            rows.append({'date': date,
+                         'label': label,
+                         'version': __version__,
+                         'preset': preset,
+                         'command': command,
+                         'runs': repeat,
+                         'wall_median_s': '%.3f' % np.median(walls),
+                         'wall_min_s': '%.3f' % min(walls),
+                         'peak_rss_mib': '%.1f' % (max(peaks)/2.**20),
+                         'residues_per_s': '%.0f' % np.median(rates),
+                         'golden': status})
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    #
+    # report results
+    #
+    click.echo('%-28s %9s %9s %9s %13s  %s' % ('command', 'median_s', 'min_s',
+                                              'peak_MiB', 'residues/s', 'golden'))
+    for row in rows:
+        click.echo('%-28s %9s %9s %9s %13s  %s' % (row['command'],
+                                                  row['wall_median_s'],
+                                                  row['wall_min_s'],
+                                                  row['peak_rss_mib'],
+                                                  row['residues_per_s'],
+                                                  row['golden']))
+    if results is not None:
+        new_file = not os.path.exists(results)
+        with open(results, 'at') as f:
+            if new_file:
+                f.write('\t'.join(RESULT_FIELDS) + '\n')
+            for row in rows:
+                f.write('\t'.join([str(row[field]) for field in RESULT_FIELDS]) + '\n')
+    if update_golden:
+        if not os.path.isdir(GOLDEN_DIR):
+            os.makedirs(GOLDEN_DIR)
+        with open(golden_path, 'wt') as f:
+            yaml.dump(new_golden, f)
+        click.echo('Wrote golden results to "%s".' % golden_path)
+    elif failed:
+        raise click.ClickException('Outputs differ from golden results.')
+
+
+if __name__ == '__main__':
+    pipeline()
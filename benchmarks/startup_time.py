@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''Benchmark cold-start cost of each aakbar command.
+
+Each command is run with --help in a fresh interpreter under
+python -X importtime, which imports the module defining the command
+without running it.  The wall time, total import time, and which heavy
+packages were imported are reported per command.
+
+Usage:
+    python benchmarks/startup_time.py [OPTIONS] [COMMANDS]...
+'''
+
+# standard library imports
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+# external packages
+import click
+import numpy as np
+
+# package imports
+from aakbar import LAZY_COMMAND_MODULES
+
+HEAVY_PACKAGES = ['numpy', 'pandas', 'matplotlib', 'pyfaidx', 'Bio', 'pkg_resources']
+
+
+def parse_importtime(stderr):
+    '''Parse python -X importtime output.
+
+    :param stderr: Standard error of the run.
+    :return: Tuple of (total import time in s, dictionary of cumulative
+             import time in s of each top-level package imported).
+    '''
+    total = 0.
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1)//2
+        cumulative = int(cumulative_us)/1.E6
+        if depth == 0:
+            total += cumulative
+        package = name.strip().split('.')[0]
+        if package not in packages or depth == 0:
+            packages[package] = max(packages.get(package, 0.), cumulative)
+    return total, packages
+
+
+def time_command(args, cwd):
+    '''Run aakbar once under -X importtime.
+
+    :param args: Arguments to aakbar.
+    :param cwd: Working directory.
+    :return: Tuple of (wall time in s, total import time in s,
+             dictionary of per-package import times).
+    '''
+    start = time.time()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'aakbar',
+                             '--no_log'] + args,
+                            cwd=cwd,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    wall = time.time() - start
+    if result.returncode != 0:
+        raise click.ClickException('"aakbar %s" failed:\n%s' % (' '.join(args),
+                                                                  result.stderr[-2000:]))
+    return (wall,) + parse_importtime(result.stderr)
+
+
+@click.command()
+@click.option('--repeat', default=5, show_default=True,
+              help='Runs per command; the median is reported.')
+@click.argument('commands', nargs=-1)
+def startup_time(repeat, commands):
+    '''Report cold-start time of COMMANDS, default all.'''
+    if not commands:
+        commands = sorted([name for names in LAZY_COMMAND_MODULES.values()
+                           for name in names])
+    runs = [('(none)', ['--version'])] + [(name, [name, '--help']) for name in commands]
+    click.echo('%-28s %8s %8s  %s' % ('command', 'wall_ms', 'import_ms',
+                                     'heavy packages imported (ms)'))
+    with tempfile.TemporaryDirectory() as cwd:
+        for name, args in runs:
+            walls = []
+            imports = []
+            for i in range(repeat):
+                wall, total, packages = time_command(args, cwd)
+                walls.append(wall)
+                imports.append(total)
+            heavy = ['%s %.0f' % (package, packages[package]*1000.)
+                     for package in HEAVY_PACKAGES if package in packages]
+            click.echo('%-28s %8.0f %8.0f  %s' % (name,
+                                                np.median(walls)*1000.,
+                                                np.median(imports)*1000.,
+                                                ', '.join(heavy) or '-'))
+
+
+if __name__ == '__main__':
+    startup_time()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''Deterministic synthetic proteomes for benchmarks.
+
+A random ancestral core proteome is mutated independently for each set,
+so that k-mers of core genes are shared between sets in proportion to
+how little they diverge.  The remaining genes of each set are random
+and unique to it.  Low-complexity runs drawn from a few residues are
+spliced into genes, to exercise simplicity masking.
+
+The same parameters and seed always give the same files.
+
+Usage:
+    python -m benchmarks.synthetic [OPTIONS] OUTDIR
+'''
+
+# standard library imports
+import os
+
+# external packages
+import click
+import numpy as np
+
+# package imports
+from aakbar.packing import PACKED_ALPHABET
+
+STANDARD_RESIDUES = np.frombuffer(PACKED_ALPHABET[1:], dtype=np.uint8)
+FASTA_LINE_LENGTH = 60
+LOW_COMPLEXITY_RUN = (8, 24) # residues, low and high
+LOW_COMPLEXITY_LETTERS = 2 # residues per run
+DEFAULT_FILENAME = 'protein.faa'
+DEFAULT_PARAMS = {'n_sets': 4,
+                  'n_genes': 500,
+                  'gene_length': 300,
+                  'shared_fraction': 0.8,
+                  'divergence': 0.05,
+                  'low_complexity': 0.05,
+                  'seed': 1}
+
+
+def random_gene(rng, length):
+    '''Random residues of a gene.
+
+    :param rng: numpy RandomState.
+    :param length: Number of residues.
+    :return: Array of residue codes (uint8).
+    '''
+    return rng.choice(STANDARD_RESIDUES, size=length)
+
+
+def mutate(rng, gene, rate):
+    '''Substitute residues at random.
+
+    :param rng: numpy RandomState.
+    :param gene: Array of residue codes.
+    :param rate: Substitution rate.
+    :return: Mutated copy of gene.
+    '''
+    gene = gene.copy()
+    mutated = rng.random_sample(len(gene)) < rate
+    gene[mutated] = rng.choice(STANDARD_RESIDUES, size=mutated.sum())
+    return gene
+
+
+def add_low_complexity(rng, gene, fraction):
+    '''Overwrite runs of a gene with residues drawn from a few letters.
+
+    :param rng: numpy RandomState.
+    :param gene: Array of residue codes.
+    :param fraction: Expected fraction of residues in runs.
+    :return: Modified copy of gene.
+    '''
+    gene = gene.copy()
+    mean_run = sum(LOW_COMPLEXITY_RUN)/2.
+    n_runs = rng.poisson(fraction*len(gene)/mean_run)
+    for i in range(n_runs):
+        run_length = min(rng.randint(*LOW_COMPLEXITY_RUN), len(gene))
+        start = rng.randint(len(gene) - run_length + 1)
+        letters = rng.choice(STANDARD_RESIDUES, size=LOW_COMPLEXITY_LETTERS)
+        gene[start:start+run_length] = rng.choice(letters, size=run_length)
+    return gene
+
+
+def gene_lengths(rng, n_genes, gene_length):
+    '''Gene lengths varying around a mean.
+
+    :param rng: numpy RandomState.
+    :param n_genes: Number of genes.
+    :param gene_length: Mean length.
+    :return: Array of lengths.
+    '''
+    return rng.randint(gene_length//2, gene_length*3//2 + 1, size=n_genes)
+
+
+def synthetic_sets(n_sets, n_genes, gene_length, shared_fraction,
+                   divergence, low_complexity, seed):
+    '''Generate the proteomes of a group of sets.
+
+    :param n_sets: Number of sets.
+    :param n_genes: Genes per set.
+    :param gene_length: Mean residues per gene.
+    :param shared_fraction: Fraction of genes of each set descended from
+                            a shared core.
+    :param divergence: Substitution rate of core genes in each set.
+    :param low_complexity: Fraction of residues in low-complexity runs.
+    :param seed: Random seed.
+    :return: List, one per set, of lists of gene strings.
+    '''
+    rng = np.random.RandomState(seed)
+    n_core = int(round(n_genes*shared_fraction))
+    core = [random_gene(rng, length)
+            for length in gene_lengths(rng, n_core, gene_length)]
+    sets = []
+    for i in range(n_sets):
+        genes = [mutate(rng, gene, divergence) for gene in core]
+        genes += [random_gene(rng, length)
+                  for length in gene_lengths(rng, n_genes - n_core, gene_length)]
+        genes = [add_low_complexity(rng, gene, low_complexity) for gene in genes]
+        order = rng.permutation(len(genes))
+        sets.append([genes[j].tobytes().decode('ascii') for j in order])
+    return sets
+
+
+def write_fasta(path, name, genes):
+    '''Write genes as FASTA.
+
+    :param path: Output path.
+    :param name: Set name, used in record IDs.
+    :param genes: List of gene strings.
+    :return: None
+    '''
+    with open(path, 'wt') as fh:
+        for i, gene in enumerate(genes):
+            fh.write('>%s_%05d synthetic protein\n' % (name, i))
+            for j in range(0, len(gene), FASTA_LINE_LENGTH):
+                fh.write(gene[j:j+FASTA_LINE_LENGTH] + '\n')
+
+
+def write_synthetic_sets(outdir, filename=DEFAULT_FILENAME, **params):
+    '''Write a synthetic proteome in a directory per set.
+
+    :param outdir: Directory in which set directories are made.
+    :param filename: Name of FASTA file in each set directory.
+    :param params: Parameters of synthetic_sets, defaulting to DEFAULT_PARAMS.
+    :return: List of (set name, set directory) tuples.
+    '''
+    set_params = dict(DEFAULT_PARAMS)
+    set_params.update(params)
+    sets = []
+    for i, genes in enumerate(synthetic_sets(**set_params)):
+        name = 'syn%02d' % i
+        setdir = os.path.join(outdir, name)
+        if not os.path.isdir(setdir):
+            os.makedirs(setdir)
+        write_fasta(os.path.join(setdir, filename), name, genes)
+        sets.append((name, setdir))
+    return sets
+
+
+@click.command()
+@click.option('--n_sets', default=DEFAULT_PARAMS['n_sets'], show_default=True,
+              help='Number of sets (genomes).')
+@click.option('--n_genes', default=DEFAULT_PARAMS['n_genes'], show_default=True,
+              help='Genes per set.')
+@click.option('--gene_length', default=DEFAULT_PARAMS['gene_length'], show_default=True,
+              help='Mean residues per gene.')
+@click.option('--shared_fraction', default=DEFAULT_PARAMS['shared_fraction'],
+              show_default=True, help='Fraction of genes from a shared core.')
+@click.option('--divergence', default=DEFAULT_PARAMS['divergence'], show_default=True,
+              help='Substitution rate of core genes in each set.')
+@click.option('--low_complexity', default=DEFAULT_PARAMS['low_complexity'],
+              show_default=True, help='Fraction of residues in low-complexity runs.')
+@click.option('--seed', default=DEFAULT_PARAMS['seed'], show_default=True,
+              help='Random seed.')
+@click.option('--filename', default=DEFAULT_FILENAME, show_default=True,
+              help='Name of FASTA file in each set directory.')
+@click.argument('outdir', type=click.Path())
+def synthetic(outdir, filename, **params):
+    '''Write a synthetic proteome for each set in OUTDIR.'''
+    for name, setdir in write_synthetic_sets(outdir, filename=filename, **params):
+        click.echo('%s\t%s' % (name, setdir))
+
+
+if __name__ == '__main__':
+    synthetic()